@@ -7,9 +7,9 @@ __version__="0.0.2"
 
 import os
 
-from .logger import get_logger
+from .logger import LazyLogger
 
-logger = get_logger(
+logger = LazyLogger(
     os.environ.get('VASSAL_DEPLOYER_LOG'),
     os.environ.get('VASSAL_DEPLOYER_STDOUT', False)
 )
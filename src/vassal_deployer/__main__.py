@@ -3,8 +3,12 @@
 cli entry point for vassal deployer
 
 """
+import sys
+import time
 import argparse
 from .deploy import deploy
+from .vassal_config import PIP_MODES
+from .fleet import parse_port_range
 
 
 def build_parser():
@@ -23,10 +27,41 @@ def build_parser():
     )
     parser.add_argument(
         '--input-vassals', '-i',
-        help='directory containing vassals configs with extra deployer conf section',
+        help=(
+            'directory containing vassals configs with extra deployer conf section, '
+            'can be given more than once'
+        ),
         required=True,
+        action='append',
         dest='vassals_in'
     )
+    parser.add_argument(
+        '--recursive', '-r',
+        help='also find vassal configs in subdirectories of the input directories',
+        default=False,
+        action='store_true',
+        dest='recursive'
+        )
+    parser.add_argument(
+        '--include',
+        help='glob pattern of the vassal configs to deploy, can be given more than once (default: *.ini)',
+        default=None,
+        action='append',
+        dest='include'
+        )
+    parser.add_argument(
+        '--exclude',
+        help='glob pattern of vassal configs or subdirectories to skip, can be given more than once',
+        default=None,
+        action='append',
+        dest='exclude'
+        )
+    parser.add_argument(
+        '--parse-cache',
+        help='file to cache parsed vassal configs in, so unchanged configs load without reparsing',
+        default=None,
+        dest='parse_cache'
+        )
     parser.add_argument(
         '--sites-enabled',
         help='nginx sites-enabled directory location',
@@ -51,24 +86,405 @@ def build_parser():
         default='uwsgi_vassals',
         dest='nginx_site'
         )
+    parser.add_argument(
+        '--nginx-includes',
+        help='write the nginx site as a server block that includes a file per vassal',
+        default=False,
+        action='store_true',
+        dest='nginx_includes'
+        )
+    parser.add_argument(
+        '--nginx-cache-dir',
+        help='directory for the nginx cache zones of vassals setting cache_zone',
+        default=None,
+        dest='nginx_cache_dir'
+        )
+    parser.add_argument(
+        '--auto-size',
+        help='size uwsgi workers, threads and cheaper settings from the CPUs and memory of the node',
+        default=False,
+        action='store_true',
+        dest='auto_size'
+        )
+    parser.add_argument(
+        '--socket-dir',
+        help='directory to give each vassal a unix socket in, instead of a tcp socket',
+        default=None,
+        dest='socket_dir'
+        )
+    parser.add_argument(
+        '--socket-mode',
+        help='permissions of the sockets in --socket-dir (default: 660)',
+        default='660',
+        dest='socket_mode'
+        )
+    parser.add_argument(
+        '--socket-owner',
+        help='user[:group] owning the sockets in --socket-dir, eg the nginx user',
+        default=None,
+        dest='socket_owner'
+        )
+    parser.add_argument(
+        '--port-range',
+        help='START-END range to assign the tcp vassals ports from, kept stable across runs',
+        default=None,
+        type=parse_port_range,
+        dest='port_range'
+        )
+    parser.add_argument(
+        '--jobs', '-j',
+        help='number of vassals to provision concurrently',
+        default=1,
+        type=int,
+        dest='jobs'
+        )
+    parser.add_argument(
+        '--venv-cache',
+        help='directory used to share virtualenv builds between vassals',
+        default=None,
+        dest='venv_cache'
+        )
+    parser.add_argument(
+        '--venv-cache-size',
+        help='size cap of the virtualenv cache in MB',
+        default=None,
+        type=int,
+        dest='venv_cache_size'
+        )
+    parser.add_argument(
+        '--venv-cache-hardlink',
+        help='hardlink files from the virtualenv cache instead of copying them',
+        default=False,
+        action='store_true',
+        dest='venv_cache_hardlink'
+        )
+    parser.add_argument(
+        '--pip-mode',
+        help=(
+            'run pip once per requirement (each), once per vassal (batch) '
+            'or once per vassal from a generated requirements file (file)'
+        ),
+        default='each',
+        choices=PIP_MODES,
+        dest='pip_mode'
+        )
+    parser.add_argument(
+        '--incremental',
+        help='skip vassals whose templates are unchanged since the last deploy',
+        default=False,
+        action='store_true',
+        dest='incremental'
+        )
+    parser.add_argument(
+        '--wheelhouse',
+        help='directory to prefetch the wheels of all vassals into and install from',
+        default=None,
+        dest='wheelhouse'
+        )
+    parser.add_argument(
+        '--offline',
+        help='install from the wheels already in --wheelhouse without fetching any',
+        default=False,
+        action='store_true',
+        dest='offline'
+        )
+    parser.add_argument(
+        '--reload-command',
+        help='command to run once all configs are written, eg "nginx -s reload"',
+        default=None,
+        dest='reload_command'
+        )
+    parser.add_argument(
+        '--timings-out',
+        help='file to write a json report of the time taken by each deploy phase to',
+        default=None,
+        dest='timings_out'
+        )
+    parser.add_argument(
+        '--layers-dir',
+        help='directory to build base layer virtualenvs of common requirements in',
+        default=None,
+        dest='layers_dir'
+        )
+    parser.add_argument(
+        '--layer-min-vassals',
+        help='minimum number of vassals sharing requirements to build a base layer for them',
+        default=2,
+        type=int,
+        dest='layer_min_vassals'
+        )
+    parser.add_argument(
+        '--backend',
+        help='provision with a pool of threads or with asyncio subprocesses',
+        default='threads',
+        choices=['threads', 'async'],
+        dest='backend'
+        )
+    parser.add_argument(
+        '--host-limit',
+        help='with the async backend, maximum concurrent pip runs per package index host',
+        default=2,
+        type=int,
+        dest='host_limit'
+        )
+    parser.add_argument(
+        '--state-dir',
+        help='directory of the deploy state database recording each run',
+        default=None,
+        dest='state_dir'
+        )
+    parser.add_argument(
+        '--plan',
+        help='print the actions and config diffs a deploy would make, without changing anything',
+        default=False,
+        action='store_true',
+        dest='plan'
+        )
+    parser.add_argument(
+        '--watch',
+        help='keep running and redeploy templates as they change',
+        default=False,
+        action='store_true',
+        dest='watch'
+        )
+    parser.add_argument(
+        '--watch-interval',
+        help='seconds between polls of the templates when inotify is not available',
+        default=1.0,
+        type=float,
+        dest='watch_interval'
+        )
+    parser.add_argument(
+        '--debounce',
+        help='seconds without template changes to wait for before redeploying',
+        default=2.0,
+        type=float,
+        dest='debounce'
+        )
 
     opts = parser.parse_args()
     return opts
 
 
+def build_cache_parser(argv=None):
+    """
+    build command line parser for the venv cache subcommand
+
+    """
+    parser = argparse.ArgumentParser(
+        prog='vassal_deployer cache',
+        description='inspect and prune the shared virtualenv cache'
+    )
+    parser.add_argument(
+        'action',
+        choices=['list', 'prune', 'clear'],
+        help='list entries, prune to --max-size or clear the cache'
+    )
+    parser.add_argument(
+        '--venv-cache',
+        help='virtualenv cache directory',
+        required=True,
+        dest='venv_cache'
+        )
+    parser.add_argument(
+        '--max-size',
+        help='size in MB to prune the cache down to',
+        default=None,
+        type=int,
+        dest='max_size'
+        )
+
+    opts = parser.parse_args(argv)
+    return opts
+
+
+def build_status_parser(argv=None):
+    """
+    build command line parser for the status subcommand
+
+    """
+    parser = argparse.ArgumentParser(
+        prog='vassal_deployer status',
+        description='show the deploy history recorded in the state dir'
+    )
+    parser.add_argument(
+        '--state-dir',
+        help='directory of the deploy state database',
+        required=True,
+        dest='state_dir'
+        )
+    parser.add_argument(
+        '--runs',
+        help='number of recent runs to average durations over',
+        default=10,
+        type=int,
+        dest='runs'
+        )
+    parser.add_argument(
+        '--vassal',
+        help='show the phases of the recent runs of this vassal',
+        default=None,
+        dest='vassal'
+        )
+
+    opts = parser.parse_args(argv)
+    return opts
+
+
+def megabytes(size):
+    """convert a size in MB to bytes"""
+    if size is None:
+        return None
+    return size * 1024 * 1024
+
+
+def local_time(timestamp):
+    """format a timestamp for the subcommand listings"""
+    return time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(timestamp))
+
+
+def cache_main(argv=None):
+    """
+    parse cache subcommand args and run the action
+    """
+    from .venv_cache import VenvCache
+    opts = build_cache_parser(argv)
+    cache = VenvCache(opts.venv_cache)
+    if opts.action == 'list':
+        entries = cache.entries()
+        for entry in entries:
+            print("{key}  {size:>8.1f}MB  {last_used}  {python}  {reqs}".format(
+                key=entry['key'][:12],
+                size=entry.get('size', 0) / (1024.0 * 1024.0),
+                last_used=local_time(entry.get('last_used', 0)),
+                python=entry.get('python'),
+                reqs=','.join(entry.get('requirements', []))
+            ))
+        print("{} entries, {:.1f}MB total".format(
+            len(entries), cache.size() / (1024.0 * 1024.0)
+        ))
+    elif opts.action == 'prune':
+        if opts.max_size is None:
+            print("prune requires --max-size")
+            sys.exit(2)
+        evicted = cache.prune(megabytes(opts.max_size))
+        print("evicted {} entries".format(len(evicted)))
+    else:
+        cache.clear()
+
+
+def status_main(argv=None):
+    """
+    parse status subcommand args and print the vassal status
+    table, or the phase history of one vassal
+    """
+    from .state import StateStore
+    opts = build_status_parser(argv)
+    store = StateStore(opts.state_dir)
+    if opts.vassal:
+        for record in store.history(opts.vassal, opts.runs):
+            print("{started}  {host}  {result}  {duration:.2f}s  template {template}  venv {venv}".format(
+                started=local_time(record['started']),
+                host=record['host'],
+                result=record['result'],
+                duration=record['duration'],
+                template=(record['template_hash'] or '-')[:12],
+                venv=(record['venv_fingerprint'] or '-')[:12]
+            ))
+            for phase, duration, result in record['phases']:
+                print("    {:<30} {:>8.2f}s  {}".format(phase, duration, result))
+            if record['error']:
+                print("    {}".format(record['error']))
+        return
+    statuses = store.vassal_status(opts.runs)
+    for status in statuses:
+        print("{name}  {host}  {result:<5}  last {duration:>7.2f}s  avg {average:>7.2f}s  "
+              "runs {runs}  template {template}  venv {venv}{drift}".format(
+                  name=status['name'],
+                  host=status['host'],
+                  result=status['result'],
+                  duration=status['duration'],
+                  average=status['average'],
+                  runs=status['runs'],
+                  template=(status['template_hash'] or '-')[:12],
+                  venv=(status['venv_fingerprint'] or '-')[:12],
+                  drift='  DRIFT' if status['drift'] else ''
+              ))
+    runs = store.runs(1)
+    print("{} vassals, {} drifted, last run {}".format(
+        len(statuses),
+        len([s for s in statuses if s['drift']]),
+        local_time(runs[0]['started']) if runs else 'never'
+    ))
+
+
 def main():
     """
-    parse cli args and run deploy
+    parse cli args and run deploy, or dispatch to the
+    cache and status subcommands
     """
+    if sys.argv[1:2] == ['cache']:
+        return cache_main(sys.argv[2:])
+    if sys.argv[1:2] == ['status']:
+        return status_main(sys.argv[2:])
     opts = build_parser()
-    deploy(
+    args = (
         opts.vassals_in,
         opts.vassals_out,
         opts.nginx_site,
         opts.nginx_port,
         opts.sites_available,
         opts.sites_enabled
+    )
+    # options shared by deploy and plan
+    common = dict(
+        recursive=opts.recursive,
+        include=opts.include,
+        exclude=opts.exclude,
+        parse_cache=opts.parse_cache,
+        nginx_includes=opts.nginx_includes,
+        nginx_cache_dir=opts.nginx_cache_dir,
+        auto_size=opts.auto_size,
+        socket_dir=opts.socket_dir,
+        socket_mode=opts.socket_mode,
+        socket_owner=opts.socket_owner,
+        port_range=opts.port_range
+    )
+    options = dict(
+        jobs=opts.jobs,
+        venv_cache=opts.venv_cache,
+        venv_cache_size=megabytes(opts.venv_cache_size),
+        venv_cache_hardlink=opts.venv_cache_hardlink,
+        pip_mode=opts.pip_mode,
+        incremental=opts.incremental,
+        wheelhouse=opts.wheelhouse,
+        offline=opts.offline,
+        reload_command=opts.reload_command,
+        timings_out=opts.timings_out,
+        layers_dir=opts.layers_dir,
+        layer_min_vassals=opts.layer_min_vassals,
+        backend=opts.backend,
+        host_limit=opts.host_limit,
+        state_dir=opts.state_dir,
+        **common
+    )
+    if opts.plan:
+        from .plan import plan
+        result = plan(*args, incremental=opts.incremental, **common)
+        sys.stdout.write(result.report())
+        return
+    if opts.watch:
+        from .watch import WatchDeployer
+        watcher = WatchDeployer(
+            *args,
+            interval=opts.watch_interval,
+            debounce=opts.debounce,
+            **options
         )
+        watcher.run()
+        return
+    deploy(*args, **options)
+
 
 if __name__ == '__main__':  # pragma: no cover
     main()
@@ -0,0 +1,278 @@
+#!/usr/bin/env python
+"""
+async_provision
+
+asyncio provisioning backend that runs virtualenv and pip as
+async subprocesses, streaming their output line by line into the
+vassal_deployer logger.
+
+A global semaphore caps how many vassals are provisioned at once and
+a semaphore per package index host caps how many pip runs hit the same
+index concurrently, so a single deploy process can drive many installs
+without a thread per vassal.
+
+Requires python 3.5+
+
+"""
+import os
+import asyncio
+import functools
+from urllib.parse import urlparse
+
+from .files import makedirs
+from .timing import null_timer
+from .vassal_config import PipInstallError
+from .wheelhouse import index_option
+from . import logger
+
+
+DEFAULT_INDEX_HOST = 'pypi.org'
+
+
+class CommandError(Exception):
+    """
+    Raised when a virtualenv or pip subprocess fails, with the
+    tail of its output
+    """
+    def __init__(self, args, returncode, output):
+        self.args_list = list(args)
+        self.returncode = returncode
+        self.output = output
+        super(CommandError, self).__init__(
+            "{} exited with {}: {}".format(
+                ' '.join(self.args_list), returncode, '\n'.join(output[-5:])
+            )
+        )
+
+
+def index_hosts(pip_options):
+    """
+    find the package index hosts pip_options will hit
+
+    :param pip_options: list of pip options
+    :returns: sorted list of hosts, empty for --no-index installs
+    """
+    if '--no-index' in pip_options:
+        return []
+    hosts = set()
+    default_index = True
+    for i, opt in enumerate(pip_options):
+        name, _, value = opt.partition('=')
+        option = index_option(name)
+        if option is None:
+            continue
+        if not value and i + 1 < len(pip_options):
+            value = pip_options[i + 1]
+        if option == '--index-url':
+            default_index = False
+        parsed = urlparse(value if '://' in value else '//' + value)
+        hosts.add(parsed.netloc or value)
+    if default_index:
+        hosts.add(DEFAULT_INDEX_HOST)
+    return sorted(hosts)
+
+
+class AsyncProvisioner(object):
+    """
+    Provision vassals concurrently on an asyncio event loop
+
+    :param jobs: maximum number of vassals provisioned at once
+    :param host_limit: maximum number of concurrent pip runs
+        against the same package index host
+    :param virtualenv: virtualenv command to create virtualenvs with
+    """
+
+    def __init__(self, jobs=4, host_limit=2, virtualenv='virtualenv'):
+        self.jobs = max(1, int(jobs or 1))
+        self.host_limit = max(1, int(host_limit or 1))
+        self.virtualenv = virtualenv
+        self._semaphore = None
+        self._host_semaphores = {}
+
+    def _host_semaphore(self, host):
+        if host not in self._host_semaphores:
+            self._host_semaphores[host] = asyncio.Semaphore(self.host_limit)
+        return self._host_semaphores[host]
+
+    async def run_command(self, label, args, cwd=None):
+        """
+        run args as a subprocess, logging each line of its output
+        as it is produced
+
+        :param label: prefix for the logged lines, eg the vassal name
+        :param args: command and arguments list
+        :returns: list of the output lines
+        """
+        logger.info("[{}] running {}".format(label, ' '.join(args)))
+        proc = await asyncio.create_subprocess_exec(
+            *args,
+            cwd=cwd,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.STDOUT
+        )
+        output = []
+        while True:
+            line = await proc.stdout.readline()
+            if not line:
+                break
+            text = line.decode('utf-8', 'replace').rstrip()
+            output.append(text)
+            logger.info("[{}] {}".format(label, text))
+        returncode = await proc.wait()
+        if returncode:
+            raise CommandError(args, returncode, output)
+        return output
+
+    async def make_virtualenv(self, vassal):
+        """create the virtualenv of vassal unless it already exists"""
+        venv = vassal.uwsgi_virtualenv
+        logger.info("Making venv: {}".format(venv))
+        if os.path.isfile(os.path.join(venv, 'bin', 'pip')):
+            return
+        makedirs(vassal.uwsgi_home)
+        await self.run_command(
+            vassal.basename,
+            [self.virtualenv, '-p', vassal.app_python, venv]
+        )
+
+    async def pip(self, vassal, requirements, pip_options):
+        """
+        run pip install for requirements in the vassal virtualenv,
+        holding the semaphores of the index hosts it uses
+        """
+        semaphores = [self._host_semaphore(h) for h in index_hosts(pip_options)]
+        for semaphore in semaphores:
+            await semaphore.acquire()
+        try:
+            await self.run_command(
+                vassal.basename,
+                [
+                    os.path.join(vassal.uwsgi_virtualenv, 'bin', 'python'),
+                    '-m', 'pip', 'install', '--disable-pip-version-check'
+                ] + list(requirements) + list(pip_options)
+            )
+        finally:
+            for semaphore in reversed(semaphores):
+                semaphore.release()
+
+    async def pip_install(self, vassal, requirements=None, pip_options=None, timer=None):
+        """
+        install the requirements of vassal in a single pip run,
+        retrying them one at a time if it fails to report which
+        requirements could not be installed
+        """
+        reqs = vassal.requirements_list if requirements is None else list(requirements)
+        if not reqs:
+            return
+        if pip_options is None:
+            pip_options = vassal.pip_options
+        timer = timer or null_timer
+        try:
+            with timer('pip_install batch'):
+                await self.pip(vassal, reqs, pip_options)
+            return
+        except CommandError as ex:
+            logger.error(
+                "batched install failed in {}: {}, retrying each requirement".format(
+                    vassal.uwsgi_virtualenv, ex
+                )
+            )
+        failures = {}
+        for req in reqs:
+            try:
+                with timer("pip_install {}".format(req)):
+                    await self.pip(vassal, [req], pip_options)
+            except CommandError as ex:
+                failures[req] = ex
+        if failures:
+            raise PipInstallError(vassal.uwsgi_virtualenv, failures)
+
+    @staticmethod
+    def _blocking(func, *args):
+        """run a blocking call in the default executor"""
+        loop = asyncio.get_event_loop()
+        return loop.run_in_executor(None, functools.partial(func, *args))
+
+    async def provision(
+            self,
+            vassal,
+            vassals_dir,
+            cache=None,
+            manifest=None,
+            wheelhouse=None,
+            timings=None,
+            layers=None,
+            sizing=None,
+            rewrite_unchanged=False,
+            **options):
+        """
+        async counterpart of deploy.provision_vassal. Requirements are
+        always installed in one pip run per vassal, so the pip_mode
+        option is ignored
+
+        :returns: None on success or the exception raised while provisioning
+        """
+        timer = timings.timer(vassal.basename) if timings else null_timer
+        settings = sizing.settings_for(vassal) if sizing is not None else {}
+        async with self._semaphore:
+            try:
+                if manifest is not None and manifest.is_current(vassal):
+                    logger.info("vassal unchanged, skipping: {}".format(vassal.config_file))
+                    if rewrite_unchanged:
+                        vassal.write(vassals_dir, **settings)
+                    return None
+                restored = False
+                if cache is not None:
+                    with timer('restore_cache'):
+                        restored = await self._blocking(cache.restore, vassal)
+                if not restored:
+                    with timer('make_virtualenv'):
+                        await self.make_virtualenv(vassal)
+                    requirements = None
+                    if layers is not None:
+                        with timer('link_layer'):
+                            requirements = layers.link(vassal)
+                    pip_options = None
+                    if wheelhouse is not None:
+                        pip_options = wheelhouse.install_options(vassal)
+                    await self.pip_install(vassal, requirements, pip_options, timer)
+                    if cache is not None:
+                        with timer('store_cache'):
+                            await self._blocking(cache.store, vassal)
+                with timer('write'):
+                    vassal.write(vassals_dir, **settings)
+            except Exception as ex:
+                logger.exception(
+                    "failed to deploy vassal {}: {}".format(vassal.config_file, ex)
+                )
+                if manifest is not None:
+                    manifest.discard(vassal)
+                return ex
+        if manifest is not None:
+            manifest.record(vassal)
+        return None
+
+    async def _provision_all(self, vassals, vassals_dir, **options):
+        self._semaphore = asyncio.Semaphore(self.jobs)
+        self._host_semaphores = {}
+        return await asyncio.gather(*[
+            self.provision(v, vassals_dir, **options) for v in vassals
+        ])
+
+    def provision_all(self, vassals, vassals_dir, **options):
+        """
+        provision all vassals on a new event loop
+
+        :param vassals: list of loaded VassalConfig instances
+        :param vassals_dir: file system path to write the vassal configs to
+        :param options: keyword args passed through to provision
+        :returns: list of results from provision, in the same
+            order as vassals
+        """
+        loop = asyncio.new_event_loop()
+        try:
+            return loop.run_until_complete(
+                self._provision_all(vassals, vassals_dir, **options)
+            )
+        finally:
+            loop.close()
@@ -4,42 +4,380 @@ deploy
 
 """
 import os
+import sys
+import fnmatch
+
 from .vassal_config import VassalConfig
-from .nginx_config import NginxSite
+from .nginx_config import group_sites, SiteRegistry
+from .venv_cache import VenvCache
+from .manifest import DeployManifest
+from .wheelhouse import Wheelhouse
+from .files import makedirs, run_reload
+from .timing import DeployTimings, null_timer
+from .layers import LayerManager
+from .fleet import FleetIndex, PortAllocator
 from . import logger
 
 
-def list_vassals_configs(directory):
+class DeployError(Exception):
+    """
+    Raised at the end of a deploy when one or more vassals
+    failed to provision. failures maps each failing vassal config
+    file to the exception it raised
     """
-    find all *.ini files in the given directory path
+    def __init__(self, failures):
+        self.failures = failures
+        msg = "{} vassal(s) failed to deploy: {}".format(
+            len(failures), ', '.join(sorted(failures))
+        )
+        super(DeployError, self).__init__(msg)
+
 
-    :param directory: file system path containing *.ini files
+DEFAULT_INCLUDE = ('*.ini',)
+STRING_TYPES = (str, type(u''))
 
-    :returns: list of abs path ini files found
+
+def match_any(path, patterns):
     """
-    result = []
-    for f in os.listdir(directory):
-        if f.endswith('.ini'):
-            result.append(
-                os.path.join(directory, f)
-            )
-    return result
+    check a path relative to its input directory against glob
+    patterns. Patterns without a / match the last part of the path
+
+    :param path: relative path using / separators
+    :param patterns: list of glob patterns
+    """
+    name = path.rsplit('/', 1)[-1]
+    return any(
+        fnmatch.fnmatchcase(path if '/' in p else name, p)
+        for p in patterns
+    )
+
+
+def matches_patterns(path, include=None, exclude=None):
+    """
+    check a template path, relative to its input directory,
+    against include and exclude glob patterns
+
+    :param path: relative path using / separators
+    :param include: glob patterns, defaults to *.ini
+    :param exclude: glob patterns of paths to leave out
+    """
+    if exclude and match_any(path, exclude):
+        return False
+    return match_any(path, include or DEFAULT_INCLUDE)
+
+
+def _entries(directory):
+    """
+    the (name, path, is_dir) tuples of the entries of directory,
+    sorted by name. Uses os.scandir where available to avoid a
+    stat per entry, falling back to os.listdir on python 2
+    """
+    if hasattr(os, 'scandir'):
+        entries = [(e.name, e.path, e.is_dir()) for e in os.scandir(directory)]
+    else:
+        entries = []
+        for name in os.listdir(directory):
+            path = os.path.join(directory, name)
+            entries.append((name, path, os.path.isdir(path)))
+    return sorted(entries)
+
+
+def _scan(root, relpath, recursive, include, exclude):
+    """
+    yield the matching files under root/relpath, sorted by
+    name within each directory
+    """
+    directory = os.path.join(root, relpath) if relpath else root
+    subdirs = []
+    for name, path, is_dir in _entries(directory):
+        rel = "{}/{}".format(relpath, name) if relpath else name
+        if is_dir:
+            if recursive and not (exclude and match_any(rel, exclude)):
+                subdirs.append(rel)
+            continue
+        if matches_patterns(rel, include, exclude):
+            yield path
+    for rel in subdirs:
+        for path in _scan(root, rel, recursive, include, exclude):
+            yield path
+
+
+def list_vassals_configs(directory, recursive=False, include=None, exclude=None):
+    """
+    find the template files in the given directory path or paths
+
+    :param directory: file system path containing *.ini files, or
+        a list of such paths
+    :param recursive: also search the subdirectories
+    :param include: glob patterns of the files to include,
+        defaults to *.ini
+    :param exclude: glob patterns of files or subdirectories to skip
+
+    :returns: generator of the abs path of each file found, sorted by
+        name within each directory, with the files of a directory
+        before those of its subdirectories
+
+    """
+    directories = [directory] if isinstance(directory, STRING_TYPES) else directory
+    for root in directories:
+        for path in _scan(root, '', recursive, include, exclude):
+            yield path
 
 
-def make_vassals(directory):
+def make_vassals(directory, **discovery):
     """
-    Find the *.ini files in the given directory and wrap each
-    one in a VassalConfig object
+    Find the template files in the given directory path or paths
+    and wrap each one in a VassalConfig object. Templates whose
+    file name was already found are skipped, as the rendered
+    configs are written to the vassals dir by file name
 
-    :param directory: file system path containing *.ini files
-    :returns: list of VassalConfig instances, one per found file
+    :param directory: file system path containing *.ini files,
+        or a list of such paths
+    :param discovery: recursive, include and exclude keyword args
+        passed through to list_vassals_configs
+    :returns: generator of VassalConfig instances, one per found file
 
     """
-    vassals = []
-    for vc in list_vassals_configs(directory):
+    seen = set()
+    for vc in list_vassals_configs(directory, **discovery):
+        name = os.path.basename(vc)
+        if name in seen:
+            logger.warning(
+                'skipping vassal config with duplicate name: {}'.format(vc)
+            )
+            continue
+        seen.add(name)
         logger.info('found vassal config: {}'.format(vc))
-        vassals.append(VassalConfig(vc))
-    return vassals
+        yield VassalConfig(vc)
+
+
+def load_vassals(vassals, timings=None, cache=None):
+    """
+    load all vassals
+
+    :param vassals: iterable of VassalConfig instances, eg the
+        generator from make_vassals
+    :param timings: optional DeployTimings to record the load times in
+    :param cache: optional loaded ParseCache to load unchanged
+        templates from
+    :returns: tuple of the list of loaded vassals and a dict
+        mapping the config file of each vassal that failed to
+        load to its exception
+
+    """
+    loaded = []
+    failures = {}
+    for vassal in vassals:
+        timer = timings.timer(vassal.basename) if timings else null_timer
+        try:
+            with timer('load'):
+                vassal.load(cache=cache)
+        except Exception as ex:
+            logger.exception(
+                "failed to load vassal {}: {}".format(vassal.config_file, ex)
+            )
+            failures[vassal.config_file] = ex
+            continue
+        loaded.append(vassal)
+    return loaded, failures
+
+
+def assign_sockets(vassals, socket_dir, mode=None, owner=None):
+    """
+    give vassals unix sockets in socket_dir, creating it if needed
+
+    :param vassals: list of loaded VassalConfig instances
+    :param socket_dir: directory to create the sockets in
+    :param mode: optional chmod-socket permissions
+    :param owner: optional chown-socket user[:group]
+    """
+    makedirs(socket_dir)
+    for vassal in vassals:
+        vassal.assign_socket(socket_dir, mode, owner)
+
+
+def check_fleet(
+        vassals, vassals_dir, site_name, site_port, port_range=None, save=True):
+    """
+    assign ports from port_range to the tcp vassals if given, then
+    check no two vassals share a socket or URL prefix in a site
+
+    :param vassals: list of loaded VassalConfig instances
+    :param vassals_dir: directory the port allocations are kept in
+    :param site_name: default nginx site name
+    :param site_port: default nginx port number
+    :param port_range: optional tuple of the first and last port
+    :param save: write the port allocations back
+    :returns: tuple of the vassals that passed and a dict mapping
+        the config file of each failing vassal to its FleetConflict
+    """
+    failures = {}
+    if port_range:
+        ports = PortAllocator(vassals_dir, port_range)
+        ports.load()
+        failures.update(ports.allocate(vassals))
+        if save:
+            ports.save()
+    index = FleetIndex(site_name, site_port)
+    failures.update(
+        index.check([v for v in vassals if v.config_file not in failures])
+    )
+    return [v for v in vassals if v.config_file not in failures], failures
+
+
+def open_parse_cache(path):
+    """
+    the loaded ParseCache stored at path, or None if path is None
+    """
+    if path is None:
+        return None
+    from .parse_cache import ParseCache
+    cache = ParseCache(path)
+    cache.load()
+    return cache
+
+
+def provision_vassal(
+        vassal,
+        vassals_dir,
+        cache=None,
+        pip_mode='each',
+        manifest=None,
+        wheelhouse=None,
+        timings=None,
+        layers=None,
+        sizing=None,
+        rewrite_unchanged=False):
+    """
+    build the virtualenv of a loaded vassal, install its
+    requirements and write its rendered config
+
+    :param vassal: loaded VassalConfig instance
+    :param vassals_dir: file system path to write the vassal config to
+    :param cache: optional VenvCache to restore the virtualenv from,
+        or to store it in once built
+    :param pip_mode: how to run pip, see VassalConfig.pip_install
+    :param manifest: optional DeployManifest, vassals it records as
+        unchanged are skipped and provisioned vassals are recorded in it
+    :param wheelhouse: optional prefetched Wheelhouse to install the
+        requirements from
+    :param timings: optional DeployTimings to record each phase in
+    :param layers: optional LayerManager with built base layers, the
+        vassal's layer is linked into its virtualenv and only the
+        requirements not in it are installed
+    :param sizing: optional planned WorkerSizing, the vassal config is
+        rendered with its workers settings
+    :param rewrite_unchanged: still render the config of a vassal the
+        manifest records as unchanged, for deploy options that change
+        the rendered config without changing the template
+
+    :returns: None on success or the exception raised while provisioning
+
+    """
+    timer = timings.timer(vassal.basename) if timings else null_timer
+    settings = sizing.settings_for(vassal) if sizing is not None else {}
+    try:
+        if manifest is not None and manifest.is_current(vassal):
+            logger.info("vassal unchanged, skipping: {}".format(vassal.config_file))
+            if rewrite_unchanged:
+                vassal.write(vassals_dir, **settings)
+            return None
+        restored = False
+        if cache is not None:
+            with timer('restore_cache'):
+                restored = cache.restore(vassal)
+        if not restored:
+            with timer('make_virtualenv'):
+                vassal.make_virtualenv()
+            requirements = None
+            if layers is not None:
+                with timer('link_layer'):
+                    requirements = layers.link(vassal)
+            pip_options = None
+            if wheelhouse is not None:
+                pip_options = wheelhouse.install_options(vassal)
+            vassal.pip_install(
+                mode=pip_mode,
+                pip_options=pip_options,
+                timer=timer,
+                requirements=requirements
+            )
+            if cache is not None:
+                with timer('store_cache'):
+                    cache.store(vassal)
+        with timer('write'):
+            vassal.write(vassals_dir, **settings)
+    except Exception as ex:
+        logger.exception(
+            "failed to deploy vassal {}: {}".format(vassal.config_file, ex)
+        )
+        if manifest is not None:
+            manifest.discard(vassal)
+        return ex
+    if manifest is not None:
+        manifest.record(vassal)
+    return None
+
+
+def provision_vassals(vassals, vassals_dir, jobs=1, **options):
+    """
+    provision all vassals, using a pool of jobs worker threads
+    when jobs > 1
+
+    :param vassals: list of VassalConfig instances
+    :param vassals_dir: file system path to write the vassal configs to
+    :param jobs: number of vassals to provision concurrently
+    :param options: keyword args passed through to provision_vassal
+
+    :returns: list of results from provision_vassal, in the same
+        order as vassals
+
+    """
+    jobs = max(1, int(jobs or 1))
+    if jobs == 1 or len(vassals) < 2:
+        return [provision_vassal(v, vassals_dir, **options) for v in vassals]
+
+    from multiprocessing.pool import ThreadPool
+
+    pool = ThreadPool(min(jobs, len(vassals)))
+    try:
+        return pool.map(
+            lambda v: provision_vassal(v, vassals_dir, **options),
+            vassals,
+            chunksize=1
+        )
+    finally:
+        pool.close()
+        pool.join()
+
+
+def rewrite_vassals(vassals, vassals_dir, sizing=None, timings=None):
+    """
+    render the configs of vassals that are deployed but not being
+    provisioned, for deploy options that change the rendered config
+    of every vassal, eg the worker split of auto sizing. Unchanged
+    configs are left alone
+
+    :param vassals: list of loaded VassalConfig instances
+    :param vassals_dir: file system path to write the vassal configs to
+    :param sizing: optional planned WorkerSizing
+    :param timings: optional DeployTimings to record the writes in
+    :returns: dict mapping the config file of each vassal that failed
+        to write to its exception
+    """
+    failures = {}
+    for vassal in vassals:
+        timer = timings.timer(vassal.basename) if timings else null_timer
+        settings = sizing.settings_for(vassal) if sizing is not None else {}
+        try:
+            with timer('write'):
+                vassal.write(vassals_dir, **settings)
+        except Exception as ex:
+            logger.exception(
+                "failed to write vassal {}: {}".format(vassal.config_file, ex)
+            )
+            failures[vassal.config_file] = ex
+    return failures
 
 
 def deploy(
@@ -48,7 +386,34 @@ def deploy(
         site_name,
         site_port,
         sites_available=None,
-        sites_enabled=None):
+        sites_enabled=None,
+        jobs=1,
+        venv_cache=None,
+        venv_cache_size=None,
+        venv_cache_hardlink=False,
+        pip_mode='each',
+        incremental=False,
+        wheelhouse=None,
+        offline=False,
+        only=None,
+        recursive=False,
+        include=None,
+        exclude=None,
+        parse_cache=None,
+        nginx_includes=False,
+        nginx_cache_dir=None,
+        auto_size=False,
+        socket_dir=None,
+        socket_mode='660',
+        socket_owner=None,
+        port_range=None,
+        reload_command=None,
+        timings_out=None,
+        layers_dir=None,
+        layer_min_vassals=2,
+        backend='threads',
+        host_limit=2,
+        state_dir=None):
     """
     _deploy_
 
@@ -56,26 +421,210 @@ def deploy(
     write the rendered vassal configs to the vassals_dir,
     set up the virtualenvs as needed and build the nginx site config
 
-    :param templates_dir: file system path containing uwsgi *.ini files
+    Vassals are grouped into nginx sites by the site, site_port and
+    server_name settings of their templates, the others go in the
+    site_name site. Vassals that fail to provision are left out of the
+    nginx sites, and a DeployError listing them is raised once the sites
+    have been written for the remaining vassals. The files of sites
+    written by earlier deploys that are no longer built are removed
+
+    :param templates_dir: file system path containing uwsgi *.ini files,
+        or a list of such paths
     :param vassals_dir: file system path to write the vassal configs
         to for deployment
-    :param site_name: nginx site name
-    :param site_port: nginx port number
+    :param site_name: default nginx site name
+    :param site_port: default nginx port number
     :param sites_available: Path to nginx sites available dir
         (defaults to /etc/nginx/sites-available)
     :param sites_enabled: Path to nginx sites enabled dir
         (defaults to /etc/nginx/sites-enabled)
+    :param jobs: number of vassals to provision concurrently
+        (defaults to 1)
+    :param venv_cache: optional directory of a VenvCache used to share
+        virtualenv builds between vassals with the same python,
+        requirements and pip options
+    :param venv_cache_size: optional size cap in bytes for venv_cache
+    :param venv_cache_hardlink: hardlink files from venv_cache into the
+        restored virtualenvs instead of copying them
+    :param pip_mode: each to run pip once per requirement, batch
+        to install all of a vassal's requirements in one pip run or
+        file to do so via a generated requirements file
+    :param incremental: skip vassals whose templates and virtualenvs
+        are unchanged since the last deploy, as recorded in a
+        DeployManifest in vassals_dir
+    :param wheelhouse: optional directory of a shared Wheelhouse the
+        requirements of all vassals are prefetched into before the
+        vassals install them from it without index access
+    :param offline: install from the wheels already in wheelhouse
+        without prefetching them
+    :param only: optional collection of template paths to provision,
+        the other vassals are loaded and included in the nginx site
+        without being provisioned. With auto_size, socket_dir or
+        port_range their configs are still rendered again
+    :param recursive: also discover templates in the subdirectories
+        of templates_dir
+    :param include: glob patterns of the template files to deploy,
+        defaults to *.ini
+    :param exclude: glob patterns of template files or subdirectories
+        to leave out
+    :param parse_cache: optional file to cache the parsed templates
+        in, so unchanged templates load without configparser
+    :param nginx_includes: write the nginx site as a server block
+        including an upstream and a location file per vassal, only
+        rewriting the files that changed
+    :param nginx_cache_dir: directory for the nginx cache zones of
+        vassals setting cache_zone
+    :param auto_size: size the uwsgi workers, threads and cheaper
+        settings of each vassal from the CPUs and memory of the node,
+        split across the vassals by their weight
+    :param socket_dir: optional directory to give each vassal not already
+        using a unix socket a socket in, named after its template
+    :param socket_mode: permissions of the sockets in socket_dir
+    :param socket_owner: optional user[:group] to own the sockets in
+        socket_dir, eg the user nginx runs as
+    :param port_range: optional tuple of the first and last port to
+        assign the tcp vassals, kept stable across runs by an
+        allocation table in vassals_dir
+    :param reload_command: optional command, eg nginx -s reload, run
+        once after all the config files have been written
+    :param timings_out: optional path to write a json report of the
+        time taken by each phase of each vassal to. A summary table
+        is logged at the end of every deploy
+    :param layers_dir: optional directory to build shared base layer
+        virtualenvs in, for the requirement subsets common to at least
+        layer_min_vassals vassals. Each vassal virtualenv then links its
+        layer and installs only the remaining requirements
+    :param layer_min_vassals: minimum number of vassals sharing a layer
+    :param backend: threads to provision with a pool of jobs threads
+        using virtualenvapi, or async to run virtualenv and pip as
+        asyncio subprocesses with their output streamed to the log
+    :param host_limit: with the async backend, maximum number of
+        concurrent pip runs against the same package index host
+    :param state_dir: optional directory of a StateStore to record
+        the template hash, installed requirement versions, virtualenv
+        fingerprint and phase timings of each vassal in
 
     """
-    vassals = make_vassals(templates_dir)
-    site = NginxSite(site_name, site_port, sites_available, sites_enabled)
+    timings = DeployTimings()
+    templates = open_parse_cache(parse_cache)
+    vassals, failures = load_vassals(
+        make_vassals(
+            templates_dir,
+            recursive=recursive,
+            include=include,
+            exclude=exclude
+        ),
+        timings,
+        templates
+    )
+    if templates is not None:
+        templates.save()
+    if socket_dir:
+        assign_sockets(vassals, socket_dir, socket_mode, socket_owner)
+    loaded = vassals
+    vassals, conflicts = check_fleet(
+        vassals, vassals_dir, site_name, site_port, port_range
+    )
+    failures.update(conflicts)
 
-    for vassal in vassals:
-        vassal.load()
-        vassal.make_virtualenv()
-        vassal.pip_install()
-        vassal.write(vassals_dir)
-        site.add_vassal(vassal)
-
-    site.write_available()
-    site.link_enabled()
+    cache = None
+    if venv_cache:
+        cache = VenvCache(
+            venv_cache, max_size=venv_cache_size, hardlink=venv_cache_hardlink
+        )
+
+    manifest = None
+    if incremental:
+        manifest = DeployManifest(vassals_dir)
+        manifest.load()
+
+    pending = vassals
+    if only is not None:
+        pending = [v for v in vassals if v.config_file in only]
+
+    wheels = None
+    if wheelhouse:
+        wheels = Wheelhouse(wheelhouse, offline=offline)
+        prefetch = pending
+        if manifest is not None:
+            prefetch = [v for v in pending if not manifest.is_current(v)]
+        wheels.prefetch(prefetch)
+
+    layers = None
+    if layers_dir:
+        layers = LayerManager(layers_dir, layer_min_vassals)
+        layers.plan(vassals)
+        with timings.timer(site_name)('build_layers'):
+            layers.build(wheels)
+
+    sizing = None
+    if auto_size:
+        from .sizing import WorkerSizing
+        sizing = WorkerSizing()
+        sizing.plan(vassals)
+
+    options = dict(
+        cache=cache,
+        pip_mode=pip_mode,
+        manifest=manifest,
+        wheelhouse=wheels,
+        timings=timings,
+        layers=layers,
+        sizing=sizing,
+        rewrite_unchanged=bool(sizing or socket_dir or port_range)
+    )
+    if backend == 'async':
+        if sys.version_info < (3, 5):
+            raise ValueError("the async backend requires python 3.5+")
+        from .async_provision import AsyncProvisioner
+        provisioner = AsyncProvisioner(jobs, host_limit)
+        results = provisioner.provision_all(pending, vassals_dir, **options)
+    else:
+        results = provision_vassals(pending, vassals_dir, jobs, **options)
+    for vassal, error in zip(pending, results):
+        if error is not None:
+            failures[vassal.config_file] = error
+    if only is not None and options['rewrite_unchanged']:
+        # the worker split and port allocations cover all the vassals
+        failures.update(rewrite_vassals(
+            [v for v in vassals if v.config_file not in only],
+            vassals_dir,
+            sizing,
+            timings
+        ))
+    sites = group_sites(
+        [v for v in vassals if v.config_file not in failures],
+        site_name,
+        site_port,
+        sites_available,
+        sites_enabled,
+        nginx_includes,
+        nginx_cache_dir
+    )
+    for site in sites:
+        timer = timings.timer(site.site_name)
+        with timer('nginx_write'):
+            site.write_available()
+        with timer('nginx_link'):
+            site.link_enabled()
+    timer = timings.timer(site_name)
+    registry = SiteRegistry(sites[0].sites_available)
+    registry.load()
+    registry.retire(sites)
+    registry.save()
+    if manifest is not None:
+        manifest.retain(vassals)
+        manifest.save()
+    if reload_command:
+        with timer('reload'):
+            run_reload(reload_command)
+
+    for line in timings.summary().splitlines():
+        logger.info(line)
+    if timings_out:
+        timings.write(timings_out)
+    if state_dir:
+        from .state import StateStore
+        StateStore(state_dir).record_run(loaded, failures, timings)
+    if failures:
+        raise DeployError(failures)
@@ -0,0 +1,144 @@
+#!/usr/bin/env python
+"""
+files
+
+Helpers to replace config files and symlinks atomically so that
+nginx and the uwsgi emperor never see a half written config
+
+"""
+import os
+import errno
+import tempfile
+
+from . import logger
+
+
+replace = getattr(os, 'replace', os.rename)
+
+
+def makedirs(path):
+    """
+    create directory path and its parents, leaving it alone if it
+    already exists, even when a concurrent worker has just created it
+    """
+    try:
+        os.makedirs(path)
+    except OSError as ex:
+        if ex.errno != errno.EEXIST or not os.path.isdir(path):
+            raise
+
+
+def sidecar_path(directory, suffix):
+    """
+    path of a deployer file kept next to directory instead of in it,
+    eg <vassals_dir>.manifest, so the uwsgi emperor scanning the
+    vassals dir never takes it for a vassal config
+
+    :param directory: directory the file belongs to
+    :param suffix: suffix appended to the directory path
+    """
+    return os.path.normpath(os.path.abspath(directory)) + suffix
+
+
+def compare_chunks(path, chunks, binary=False):
+    """
+    read path alongside the chunks as they are generated,
+    stopping at the first difference
+
+    :param path: existing file to compare
+    :param chunks: iterator of strings, or bytes in binary mode
+    :param binary: compare bytes instead of strings
+    :returns: tuple of True if path holds exactly the chunks and
+        the list of the chunks consumed from the iterator
+    """
+    consumed = []
+    with open(path, 'rb' if binary else 'r') as handle:
+        try:
+            for chunk in chunks:
+                consumed.append(chunk)
+                if handle.read(len(chunk)) != chunk:
+                    return False, consumed
+            return not handle.read(1), consumed
+        except ValueError:
+            # not text in the expected encoding, so it differs
+            return False, consumed
+
+
+def atomic_write(path, content, mode=0o644, only_changed=False):
+    """
+    write content to path via a temp file in the same directory
+    that is moved over path once it is complete
+
+    :param path: file to write
+    :param content: string to write to it, bytes to write in binary
+        mode or an iterable of strings that are streamed to the file
+    :param mode: file mode for new files, existing files keep their mode
+    :param only_changed: leave path untouched if it already has
+        the same content. The content is compared with the file as
+        it is generated, so no temp file is written for unchanged files
+    :returns: True if path was written
+    """
+    dirname, basename = os.path.split(os.path.abspath(path))
+    binary = isinstance(content, bytes)
+    if isinstance(content, (str, bytes)):
+        content = [content]
+    chunks = iter(content)
+    head = []
+    exists = os.path.exists(path)
+    if exists:
+        mode = os.stat(path).st_mode & 0o7777
+        if only_changed:
+            unchanged, head = compare_chunks(path, chunks, binary)
+            if unchanged:
+                return False
+    fd, tmp = tempfile.mkstemp(dir=dirname, prefix='.{}.'.format(basename), suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb' if binary else 'w') as handle:
+            handle.writelines(head)
+            handle.writelines(chunks)
+            handle.flush()
+            os.fsync(handle.fileno())
+        os.chmod(tmp, mode)
+        replace(tmp, path)
+    except Exception:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+    return True
+
+
+def atomic_symlink(target, link_name):
+    """
+    point link_name at target, replacing any existing file
+    or link at link_name atomically
+
+    :param target: path the link points to
+    :param link_name: path of the link
+    """
+    if os.path.islink(link_name) and os.readlink(link_name) == target:
+        return
+    dirname, basename = os.path.split(os.path.abspath(link_name))
+    tmp = os.path.join(
+        dirname, '.{}.{}.tmp'.format(basename, os.getpid())
+    )
+    if os.path.lexists(tmp):
+        os.remove(tmp)
+    os.symlink(target, tmp)
+    try:
+        replace(tmp, link_name)
+    except Exception:
+        os.remove(tmp)
+        raise
+
+
+def run_reload(command):
+    """
+    run the reload command, eg nginx -s reload, once all the
+    config files are in place
+
+    :param command: command line string to run
+    """
+    import shlex
+    import subprocess
+    logger.info("running reload command: {}".format(command))
+    subprocess.check_call(shlex.split(command))
@@ -0,0 +1,252 @@
+#!/usr/bin/env python
+"""
+fleet
+
+Cross checks between all the vassals of a deploy.
+
+A FleetIndex is built in a single pass over the loaded vassals and finds
+vassals that would bind the same uwsgi socket or claim the same URL
+prefix in an nginx site. The first vassal keeps the socket or prefix and
+the later ones fail, instead of the second uwsgi silently failing to
+bind and nginx routing its requests to the wrong app. Prefixes nested
+in another vassal's prefix, eg /api/v2 under /api, are legal in nginx
+but shadow part of the outer app, so they are logged as warnings.
+
+A PortAllocator assigns the tcp vassals ports from a range, keeping
+each vassal on the same port across runs through a json allocation
+table kept next to the vassals directory, as <vassals_dir>.ports.
+
+"""
+import os
+import json
+
+from .files import atomic_write, sidecar_path
+from .nginx_config import site_for
+from . import logger
+
+
+class FleetConflict(Exception):
+    """
+    Raised for a vassal that conflicts with another vassal of the
+    fleet, eg by using the same socket
+    """
+
+
+def socket_key(vassal):
+    """
+    what the uwsgi socket of vassal binds, so sockets that can't
+    both be bound compare equal: the path of a unix socket, or the
+    port of a tcp socket on any host
+    """
+    if vassal.is_unix_socket:
+        path = vassal.uwsgi_socket
+        if path.startswith('unix:'):
+            path = path[len('unix:'):]
+        return ('unix', os.path.normpath(path))
+    return ('tcp', vassal.uwsgi_port)
+
+
+def url_prefix(url):
+    """normalized URL prefix, without a trailing /"""
+    return '/' + url.strip('/')
+
+
+def parent_prefixes(prefix):
+    """the prefixes prefix is nested in, eg /a/b is in /a and /"""
+    parts = prefix.strip('/').split('/')
+    result = ['/' + '/'.join(parts[:i]) for i in range(len(parts) - 1, 0, -1)]
+    if prefix != '/':
+        result.append('/')
+    return result
+
+
+class FleetIndex(object):
+    """
+    Index of the sockets and URL prefixes claimed by the vassals
+    of a deploy. Prefixes are claimed in the nginx site the vassal
+    goes in, as grouped by nginx_config.group_sites
+
+    :param site_name: default nginx site name
+    :param site_port: default nginx port number
+    """
+
+    def __init__(self, site_name, site_port):
+        self.site_name = site_name
+        self.site_port = site_port
+        self.sockets = {}
+        self.prefixes = {}
+        self._nested = {}
+
+    def add(self, vassal):
+        """
+        add vassal to the index, unless it conflicts with a vassal
+        already in it
+
+        :param vassal: loaded VassalConfig instance
+        :raises: FleetConflict if the socket or URL prefix of vassal
+            is missing or already taken
+        """
+        try:
+            socket = socket_key(vassal)
+        except (KeyError, IndexError, ValueError):
+            raise FleetConflict(
+                "{} has no valid uwsgi socket".format(vassal.config_file)
+            )
+        if not vassal.app_url:
+            raise FleetConflict(
+                "{} has no app_url".format(vassal.config_file)
+            )
+        owner = self.sockets.get(socket)
+        if owner is not None:
+            raise FleetConflict(
+                "{} uses socket {} of {}".format(
+                    vassal.config_file, vassal.uwsgi_socket, owner.config_file
+                )
+            )
+        site, _ = site_for(vassal, self.site_name, self.site_port)
+        prefix = url_prefix(vassal.app_url)
+        owner = self.prefixes.get((site, prefix))
+        if owner is not None:
+            raise FleetConflict(
+                "{} uses app_url {} of {}".format(
+                    vassal.config_file, prefix, owner.config_file
+                )
+            )
+        for parent in parent_prefixes(prefix):
+            outer = self.prefixes.get((site, parent))
+            if outer is not None:
+                self.warn_nested(vassal, outer)
+                break
+        inner = self._nested.get((site, prefix))
+        if inner is not None:
+            self.warn_nested(inner, vassal)
+        self.sockets[socket] = vassal
+        self.prefixes[(site, prefix)] = vassal
+        for parent in parent_prefixes(prefix):
+            self._nested.setdefault((site, parent), vassal)
+
+    @staticmethod
+    def warn_nested(inner, outer):
+        """log that the prefix of inner vassal shadows part of outer"""
+        logger.warning(
+            "app_url {} of {} is nested in app_url {} of {}".format(
+                inner.app_url, inner.config_file, outer.app_url, outer.config_file
+            )
+        )
+
+    def check(self, vassals):
+        """
+        index vassals in order, the first vassal to claim a socket
+        or prefix keeps it
+
+        :param vassals: list of loaded VassalConfig instances
+        :returns: dict mapping the config file of each conflicting
+            vassal to its FleetConflict
+        """
+        failures = {}
+        for vassal in vassals:
+            try:
+                self.add(vassal)
+            except FleetConflict as ex:
+                logger.error(str(ex))
+                failures[vassal.config_file] = ex
+        return failures
+
+
+def parse_port_range(value):
+    """
+    parse a START-END port range
+
+    :returns: tuple of the first and last port
+    """
+    start, _, end = value.partition('-')
+    start, end = int(start), int(end or start)
+    if not 0 < start <= end < 65536:
+        raise ValueError("invalid port range: {}".format(value))
+    return start, end
+
+
+class PortAllocator(object):
+    """
+    Assigns tcp ports from a range to vassals, persisting the
+    allocations next to the vassals directory so they stay stable
+
+    :param vassals_dir: directory the rendered vassal configs
+        are written to
+    :param port_range: tuple of the first and last port to assign
+    """
+    SUFFIX = '.ports'
+    VERSION = 1
+
+    def __init__(self, vassals_dir, port_range):
+        self.path = sidecar_path(vassals_dir, self.SUFFIX)
+        self.start, self.end = port_range
+        self.ports = {}
+
+    def load(self):
+        """
+        read the allocation table, starting from an empty table
+        if it is missing, unreadable or from a different version
+        """
+        self.ports = {}
+        if not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path, 'r') as handle:
+                data = json.load(handle)
+        except (IOError, OSError, ValueError) as ex:
+            logger.warning(
+                "ignoring unreadable port allocations {}: {}".format(self.path, ex)
+            )
+            return
+        if data.get('version') != self.VERSION:
+            return
+        self.ports = data.get('ports', {})
+
+    def save(self):
+        """write the allocation table"""
+        atomic_write(
+            self.path,
+            json.dumps(
+                {'version': self.VERSION, 'ports': self.ports},
+                indent=2,
+                sort_keys=True
+            ),
+            only_changed=True
+        )
+
+    def allocate(self, vassals):
+        """
+        give each tcp vassal its recorded port if it is still in the
+        range, otherwise the lowest free port. Allocations of vassals
+        that are not deployed any more are released
+
+        :param vassals: list of loaded VassalConfig instances
+        :returns: dict mapping the config file of each vassal left
+            without a port to its FleetConflict
+        """
+        tcp = [v for v in vassals if not v.is_unix_socket]
+        ports = {}
+        used = set()
+        for vassal in tcp:
+            port = self.ports.get(vassal.basename)
+            if port is not None and self.start <= port <= self.end \
+                    and port not in used:
+                ports[vassal.basename] = port
+                used.add(port)
+        free = (p for p in range(self.start, self.end + 1) if p not in used)
+        failures = {}
+        for vassal in tcp:
+            if vassal.basename not in ports:
+                port = next(free, None)
+                if port is None:
+                    failures[vassal.config_file] = FleetConflict(
+                        "no free port in {}-{} for {}".format(
+                            self.start, self.end, vassal.config_file
+                        )
+                    )
+                    continue
+                ports[vassal.basename] = port
+            vassal.assign_port(ports[vassal.basename])
+        self.ports = ports
+        return failures
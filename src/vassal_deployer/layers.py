@@ -0,0 +1,269 @@
+#!/usr/bin/env python
+"""
+layers
+
+Shared base environments for requirement sets common to many vassals.
+
+The requirements of the vassals using the same python and pip options
+are analysed to find the subsets of requirements shared by at least
+min_vassals of them. Each such subset is built once as a base layer
+virtualenv, and the vassal virtualenvs get a .pth file that adds the
+layer's site-packages to their path, so only the requirements not in
+the layer (the delta) get installed into the vassal virtualenv itself.
+Packages installed in the vassal virtualenv take precedence over those
+in its layer.
+
+"""
+import os
+import re
+import sys
+import glob
+import json
+import hashlib
+from collections import OrderedDict
+
+from .files import atomic_write
+from . import logger
+
+
+PTH_FILE = 'vassal_deployer_layer.pth'
+COMPLETE_MARKER = '.layer-complete'
+
+
+PYTHON_VERSIONS = {}
+
+
+def python_version(python):
+    """
+    the X.Y version of a python interpreter, taken from its name,
+    eg python3.9, or else by running it. Falls back to the version
+    of the deployer's python if it can't be run
+
+    :param python: python interpreter name or path
+    """
+    match = re.search(r'(\d+\.\d+)$', os.path.basename(python))
+    if match:
+        return match.group(1)
+    if python not in PYTHON_VERSIONS:
+        import subprocess
+        try:
+            output = subprocess.check_output([
+                python, '-c',
+                'import sys; print("%d.%d" % sys.version_info[:2])'
+            ])
+            version = output.decode('utf-8').strip()
+        except (OSError, subprocess.CalledProcessError):
+            version = '{}.{}'.format(*sys.version_info[:2])
+        PYTHON_VERSIONS[python] = version
+    return PYTHON_VERSIONS[python]
+
+
+def site_packages(venv, python='python'):
+    """
+    path of the site-packages dir of a virtualenv, or of the one
+    python will create in it if the virtualenv isn't built yet
+
+    :param venv: virtualenv path
+    :param python: python interpreter of the virtualenv
+    """
+    matches = sorted(
+        glob.glob(os.path.join(venv, 'lib', 'python*', 'site-packages'))
+    )
+    if matches:
+        return matches[-1]
+    return os.path.join(
+        venv, 'lib', 'python{}'.format(python_version(python)), 'site-packages'
+    )
+
+
+class Layer(object):
+    """
+    A base layer virtualenv holding requirements shared by
+    several vassals
+
+    :param python: python interpreter of the layer
+    :param pip_options: list of pip options used to install the layer
+    :param requirements: list of requirement strings in the layer
+    :param layers_dir: directory the layer virtualenvs are built in
+    """
+
+    def __init__(self, python, pip_options, requirements, layers_dir):
+        self.app_python = python
+        self.pip_options = list(pip_options)
+        self.requirements_list = sorted(requirements)
+        digest = hashlib.sha256(json.dumps(
+            [python, self.pip_options, self.requirements_list]
+        ).encode('utf-8'))
+        self.key = digest.hexdigest()[:16]
+        self.path = os.path.join(layers_dir, self.key)
+
+    @property
+    def site_packages(self):
+        """site-packages dir of the layer"""
+        return site_packages(self.path, self.app_python)
+
+    @property
+    def is_built(self):
+        """True if the layer has been fully built"""
+        return os.path.exists(os.path.join(self.path, COMPLETE_MARKER))
+
+    def build(self, pip_options=None):
+        """
+        build the layer virtualenv and install its requirements
+        in a single pip run
+
+        :param pip_options: optional pip options to use instead
+            of those of the layer, eg to install from a wheelhouse
+        """
+        import subprocess
+        from virtualenvapi.manage import VirtualEnvironment
+        from virtualenvapi.exceptions import PackageInstallationException
+        if self.is_built:
+            return
+        if pip_options is None:
+            pip_options = self.pip_options
+        logger.info("building base layer {}: {}".format(
+            self.path, ', '.join(self.requirements_list)
+        ))
+        env = VirtualEnvironment(self.path, python=self.app_python)
+        env.open_or_create()
+        try:
+            env._execute_pip(
+                ['install'] + self.requirements_list + list(pip_options)
+            )
+        except subprocess.CalledProcessError as ex:
+            raise PackageInstallationException(
+                (ex.returncode, ex.output, ','.join(self.requirements_list))
+            )
+        atomic_write(
+            os.path.join(self.path, COMPLETE_MARKER),
+            '\n'.join(self.requirements_list) + '\n'
+        )
+
+
+def plan_layers(vassals, layers_dir, min_vassals=2):
+    """
+    find the common requirement subsets among vassals
+
+    Requirements used by at least min_vassals vassals with the same
+    python and pip options are common. Each vassal's set of common
+    requirements that is shared by at least min_vassals vassals becomes
+    a layer, vassals whose common set isn't shared that widely use the
+    largest layer contained in their requirements, if any.
+
+    :param vassals: list of loaded VassalConfig instances
+    :param layers_dir: directory the layer virtualenvs are built in
+    :param min_vassals: minimum number of vassals sharing a layer
+    :returns: dict mapping each vassal config file to its Layer
+
+    """
+    groups = OrderedDict()
+    for vassal in vassals:
+        key = (vassal.app_python, tuple(vassal.pip_options))
+        groups.setdefault(key, []).append(vassal)
+
+    assignments = {}
+    for (python, pip_options), members in groups.items():
+        counts = {}
+        for vassal in members:
+            for req in set(vassal.requirements_list):
+                counts[req] = counts.get(req, 0) + 1
+        common = set(r for r, c in counts.items() if c >= min_vassals)
+
+        shared = OrderedDict()
+        for vassal in members:
+            subset = frozenset(vassal.requirements_list) & common
+            if subset:
+                shared.setdefault(subset, []).append(vassal)
+        candidates = dict(
+            (subset, Layer(python, pip_options, subset, layers_dir))
+            for subset, users in shared.items() if len(users) >= min_vassals
+        )
+        by_size = sorted(candidates, key=len, reverse=True)
+        for vassal in members:
+            reqs = frozenset(vassal.requirements_list)
+            for subset in by_size:
+                if subset <= reqs:
+                    assignments[vassal.config_file] = candidates[subset]
+                    break
+    return assignments
+
+
+class LayerManager(object):
+    """
+    Plans, builds and links base layers for a set of vassals
+
+    :param layers_dir: directory the layer virtualenvs are built in
+    :param min_vassals: minimum number of vassals sharing a layer
+    """
+
+    def __init__(self, layers_dir, min_vassals=2):
+        self.layers_dir = layers_dir
+        self.min_vassals = min_vassals
+        self.assignments = {}
+
+    def plan(self, vassals):
+        """assign layers to vassals"""
+        self.assignments = plan_layers(
+            vassals, self.layers_dir, self.min_vassals
+        )
+
+    def layers(self):
+        """the distinct layers assigned to vassals"""
+        result = OrderedDict()
+        for layer in self.assignments.values():
+            result.setdefault(layer.key, layer)
+        return list(result.values())
+
+    def build(self, wheelhouse=None):
+        """
+        build all assigned layers. Vassals whose layer fails to
+        build fall back to installing all their requirements
+
+        :param wheelhouse: optional prefetched Wheelhouse to install from
+        """
+        failed = set()
+        for layer in self.layers():
+            options = None
+            if wheelhouse is not None:
+                options = wheelhouse.install_options(layer)
+            try:
+                layer.build(options)
+            except Exception as ex:
+                logger.error(
+                    "failed to build base layer {}: {}".format(layer.path, ex)
+                )
+                failed.add(layer.key)
+        for config_file, layer in list(self.assignments.items()):
+            if layer.key in failed:
+                del self.assignments[config_file]
+
+    def layer_for(self, vassal):
+        """the Layer assigned to vassal, or None"""
+        return self.assignments.get(vassal.config_file)
+
+    def link(self, vassal):
+        """
+        link the layer of vassal into its virtualenv with a
+        .pth file, removing any stale link if it has no layer
+
+        :returns: list of the requirements left to install in
+            the vassal virtualenv
+        """
+        layer = self.layer_for(vassal)
+        pth = os.path.join(site_packages(vassal.uwsgi_virtualenv), PTH_FILE)
+        if layer is None:
+            if os.path.exists(pth):
+                os.remove(pth)
+            return vassal.requirements_list
+        logger.info("linking base layer {} into {}".format(
+            layer.path, vassal.uwsgi_virtualenv
+        ))
+        atomic_write(
+            pth,
+            "import site; site.addsitedir({!r})\n".format(layer.site_packages)
+        )
+        return [
+            r for r in vassal.requirements_list
+            if r not in layer.requirements_list
+        ]
@@ -1,9 +1,11 @@
 #!/usr/bin/env python
 """
 logger setup
+
+logging is only imported and the handlers only set up the first
+time the logger is used, to keep the CLI startup fast
 """
 import sys
-import logging
 
 
 _LOGGERS = {
@@ -13,27 +15,26 @@ _LOGGERS = {
 }
 
 
-STDOUT_FORMATTER = logging.Formatter(
-    "%(asctime)s;%(message)s",
-    datefmt="%Y-%m-%d %H:%M:%S"
-)
-
-FILE_FORMATTER = logging.Formatter(
-    "%(asctime)s;%(levelname)s;%(message)s",
-    datefmt="%Y-%m-%d %H:%M:%S"
-)
+STDOUT_FORMAT = "%(asctime)s;%(message)s"
+FILE_FORMAT = "%(asctime)s;%(levelname)s;%(message)s"
+DATE_FORMAT = "%Y-%m-%d %H:%M:%S"
 
 
 def get_logger(logfile=None, stdout=True):
     if _LOGGERS['LOGGER']:
         return _LOGGERS['LOGGER']
 
+    import logging
+    import logging.handlers
+
     log = logging.getLogger('vassal_deployer')
     log.setLevel(logging.DEBUG)
     if stdout and (_LOGGERS['STDOUT_HANDLER'] is None):
         so_handler = logging.StreamHandler(stream=sys.stdout)
         so_handler.setLevel(logging.DEBUG)
-        so_handler.setFormatter(STDOUT_FORMATTER)
+        so_handler.setFormatter(
+            logging.Formatter(STDOUT_FORMAT, datefmt=DATE_FORMAT)
+        )
         _LOGGERS['STDOUT_HANDLER'] = so_handler
         if so_handler not in log.handlers:
             log.addHandler(so_handler)
@@ -41,10 +42,26 @@ def get_logger(logfile=None, stdout=True):
     if logfile and (_LOGGERS['FILE_HANDLER'] is None):
         handler = logging.handlers.WatchedFileHandler(logfile)
         handler.setLevel(logging.DEBUG)
-        handler.setFormatter(FILE_FORMATTER)
+        handler.setFormatter(
+            logging.Formatter(FILE_FORMAT, datefmt=DATE_FORMAT)
+        )
         _LOGGERS['FILE_HANDLER'] = handler
         if handler not in log.handlers:
             log.addHandler(handler)
 
     _LOGGERS['LOGGER'] = log
     return _LOGGERS['LOGGER']
+
+
+class LazyLogger(object):
+    """
+    Stand in for the vassal_deployer logger that calls
+    get_logger with the given settings on first use
+    """
+
+    def __init__(self, logfile=None, stdout=True):
+        self.logfile = logfile
+        self.stdout = stdout
+
+    def __getattr__(self, name):
+        return getattr(get_logger(self.logfile, self.stdout), name)
@@ -0,0 +1,112 @@
+#!/usr/bin/env python
+"""
+manifest
+
+Record of what the last deploy wrote to a vassals directory, used
+to skip vassals whose templates have not changed since then.
+
+The manifest is stored as a json file next to the vassals directory,
+as <vassals_dir>.manifest, since the uwsgi emperor would take any
+.ini/.json file in the directory for a vassal config. It maps each
+rendered vassal config to the hash of the [uwsgi] and [vassaldeployer]
+sections of its template and the virtualenv built for it
+
+"""
+import os
+import json
+import threading
+
+from .files import atomic_write, sidecar_path
+from . import logger
+
+
+class DeployManifest(object):
+    """
+    Manifest of the vassals deployed to vassals_dir
+
+    :param vassals_dir: directory the rendered vassal configs
+        are written to
+    """
+    SUFFIX = '.manifest'
+    VERSION = 1
+
+    def __init__(self, vassals_dir):
+        self.vassals_dir = vassals_dir
+        self.path = sidecar_path(vassals_dir, self.SUFFIX)
+        self.vassals = {}
+        self._lock = threading.Lock()
+
+    def load(self):
+        """
+        read the manifest file, starting from an empty
+        manifest if it is missing, unreadable or from a
+        different manifest version
+        """
+        self.vassals = {}
+        if not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path, 'r') as handle:
+                data = json.load(handle)
+        except (IOError, OSError, ValueError) as ex:
+            logger.warning(
+                "ignoring unreadable deploy manifest {}: {}".format(self.path, ex)
+            )
+            return
+        if data.get('version') != self.VERSION:
+            return
+        self.vassals = data.get('vassals', {})
+
+    def save(self):
+        """write the manifest file"""
+        with self._lock:
+            content = json.dumps(
+                {'version': self.VERSION, 'vassals': self.vassals},
+                indent=2,
+                sort_keys=True
+            )
+        atomic_write(self.path, content)
+
+    def is_current(self, vassal):
+        """
+        check if vassal is unchanged since it was recorded: the
+        template hash and virtualenv match and both the virtualenv
+        and the rendered config still exist
+
+        :param vassal: loaded VassalConfig instance
+        """
+        entry = self.vassals.get(vassal.basename)
+        if not entry:
+            return False
+        return (
+            entry.get('hash') == vassal.template_hash and
+            entry.get('virtualenv') == vassal.uwsgi_virtualenv and
+            os.path.isdir(vassal.uwsgi_virtualenv) and
+            os.path.exists(os.path.join(self.vassals_dir, vassal.basename))
+        )
+
+    def record(self, vassal):
+        """
+        record a successfully deployed vassal
+
+        :param vassal: loaded VassalConfig instance
+        """
+        with self._lock:
+            self.vassals[vassal.basename] = {
+                'config_file': vassal.config_file,
+                'hash': vassal.template_hash,
+                'virtualenv': vassal.uwsgi_virtualenv,
+            }
+
+    def discard(self, vassal):
+        """forget a vassal so it gets fully redeployed next time"""
+        with self._lock:
+            self.vassals.pop(vassal.basename, None)
+
+    def retain(self, vassals):
+        """forget all recorded vassals that are not in vassals"""
+        keep = set(v.basename for v in vassals)
+        with self._lock:
+            for name in list(self.vassals):
+                if name not in keep:
+                    del self.vassals[name]
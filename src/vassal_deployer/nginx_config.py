@@ -5,8 +5,23 @@ nginx_config
 Wrapper to build an nginx site config from a set of
 uwsgi vassal configurations
 
+In include mode the site config is a stable server block that
+includes a small upstream and location file per vassal from the
+<site>.d directory next to it, so a change to one vassal only
+rewrites that vassal's files
+
+The sites written by a deploy are recorded in a SiteRegistry kept
+next to the sites available dir, as <sites_available>.sites, so the
+config, link and include dir of a site no vassal asks for any more
+are removed instead of being left enabled
+
 """
 import os
+import json
+import glob
+import shutil
+from collections import OrderedDict
+from .files import atomic_write, atomic_symlink, makedirs, sidecar_path
 from . import logger
 
 
@@ -18,19 +33,35 @@ class NginxSite(object):
 
     Instantiate with the site name and port and optional locations of
     the nginx sites available and sites enabled dirs.
+    Set includes to write a file per vassal that the site
+    config includes, instead of a single config file.
+    The server_name defaults to the site name.
+
+    Vassal cache zones are created in cache_dir, zones listed in
+    external_zones are defined by another site and left out.
 
     """
+    UPSTREAM_SUFFIX = '.upstream.conf'
+    LOCATION_SUFFIX = '.location.conf'
+    DEFAULT_CACHE_DIR = '/var/cache/nginx/vassal_deployer'
 
     def __init__(
             self,
             site_name,
             site_port,
             sites_available=None,
-            sites_enabled=None):
+            sites_enabled=None,
+            includes=False,
+            server_name=None,
+            cache_dir=None):
         self.site_name = site_name
         self.site_port = site_port
+        self.server_name = server_name or site_name
         self.sites_available = sites_available or '/etc/nginx/sites-available'
         self.sites_enabled = sites_enabled or '/etc/nginx/sites-enabled'
+        self.includes = includes
+        self.cache_dir = cache_dir or self.DEFAULT_CACHE_DIR
+        self.external_zones = set()
         self._vassals = []
         self._conf_file = "{}.conf".format(site_name)
 
@@ -42,7 +73,7 @@ class NginxSite(object):
             "    listen {};\n"
             "    server_tokens off;\n"
             "    server_name {};\n\n"
-        ).format(self.site_port, self.site_name)
+        ).format(self.site_port, self.server_name)
         return nginx_conf
 
     @property
@@ -59,29 +90,338 @@ class NginxSite(object):
         """
         self._vassals.append(vassal_conf)
 
+    def cache_zones(self):
+        """
+        the cache zones used by the vassals of the site
+
+        :returns: OrderedDict mapping each zone to the first vassal
+            using it, whose settings define the zone
+        """
+        zones = OrderedDict()
+        for vassal in self._vassals:
+            if vassal.cache_zone:
+                zones.setdefault(vassal.cache_zone, vassal)
+        return zones
+
+    def cache_paths(self):
+        """uwsgi_cache_path definitions of the cache zones of the site"""
+        return "".join(
+            vassal.nginx_cache_path(self.cache_dir)
+            for zone, vassal in self.cache_zones().items()
+            if zone not in self.external_zones
+        )
+
+    def iter_configuration(self):
+        """
+        generate the nginx configuration in chunks, with the cache
+        zones and an upstream block per vassal followed by the
+        server block
+        """
+        cache_paths = self.cache_paths()
+        if cache_paths:
+            yield cache_paths + "\n"
+        for i, vassal in enumerate(self._vassals):
+            if i:
+                yield "\n"
+            yield vassal.nginx_upstream()
+        if self._vassals:
+            yield "\n"
+        yield self.conf_header
+        for i, vassal in enumerate(self._vassals):
+            if i:
+                yield "\n"
+            yield vassal.nginx_config()
+        yield self.conf_footer
+
     def configuration(self):
         """
-        build the nginx configuration string
+        build the nginx configuration string, with an upstream
+        block per vassal followed by the server block
+        """
+        return ''.join(self.iter_configuration())
+
+    @property
+    def include_dir(self):
+        """directory of the per vassal files in include mode"""
+        return os.path.join(self.sites_available, "{}.d".format(self.site_name))
+
+    def include_configuration(self):
+        """
+        the site configuration for include mode, which only changes
+        with the site name, port, include dir and cache zones
+        """
+        cache_paths = self.cache_paths()
+        return (
+            "{cache_paths}"
+            "include {upstreams};\n\n"
+            "{header}"
+            "    include {locations};\n"
+            "{footer}"
+        ).format(
+            upstreams=os.path.join(self.include_dir, '*' + self.UPSTREAM_SUFFIX),
+            locations=os.path.join(self.include_dir, '*' + self.LOCATION_SUFFIX),
+            header=self.conf_header,
+            footer=self.conf_footer,
+            cache_paths=cache_paths + "\n" if cache_paths else ""
+        )
+
+    def files(self):
+        """
+        the files that make up the site
+
+        :returns: list of (path, content) tuples, where content
+            is a string or an iterable of strings
+        """
+        if not self.includes:
+            return [(self.available_file, self.iter_configuration())]
+        result = [(self.available_file, self.include_configuration())]
+        for vassal in self._vassals:
+            base = os.path.join(self.include_dir, vassal.upstream_name)
+            result.append((base + self.UPSTREAM_SUFFIX, vassal.nginx_upstream()))
+            result.append((base + self.LOCATION_SUFFIX, vassal.nginx_config()))
+        return result
+
+    def stale_files(self, paths=None):
+        """
+        include files in the include dir that don't belong to
+        any of the vassals of the site
+
+        :param paths: the paths of the site files, from files()
+        """
+        if paths is None:
+            paths = [f[0] for f in self.files()]
+        paths = set(paths)
+        stale = []
+        for suffix in (self.UPSTREAM_SUFFIX, self.LOCATION_SUFFIX):
+            pattern = os.path.join(self.include_dir, '*' + suffix)
+            stale.extend(p for p in glob.glob(pattern) if p not in paths)
+        return sorted(stale)
+
+    @property
+    def available_file(self):
+        """path of the site config in sites available"""
+        return os.path.join(self.sites_available, self._conf_file)
+
+    @property
+    def enabled_file(self):
+        """path of the site config link in sites enabled"""
+        return os.path.join(self.sites_enabled, self._conf_file)
+
+    def needs_cache_dir(self):
+        """
+        check if the site defines cache zones in a cache dir that
+        doesn't exist yet, nginx only creates the zone dirs in it
         """
-        conf = "{}".format(self.conf_header)
-        conf += "\n".join(v.nginx_config() for v in self._vassals)
-        conf += self.conf_footer
-        return conf
+        return bool(self.cache_paths()) and not os.path.isdir(self.cache_dir)
 
     def write_available(self):
         """
-        write the nginx config to the sites available directory
+        write the nginx config to the sites available directory,
+        streaming it to disk and leaving unchanged files alone.
+        The cache dir is created for the cache zones of the site.
+        In include mode the include files of vassals no longer in
+        the site are removed
+
+        :returns: list of the paths written or removed
         """
-        avail_file = os.path.join(self.sites_available, self._conf_file)
-        logger.info("writing sites available: {}".format(avail_file))
-        with open(avail_file, 'w') as handle:
-            handle.write(self.configuration())
+        changed = []
+        if self.needs_cache_dir():
+            logger.info("creating nginx cache dir: {}".format(self.cache_dir))
+            makedirs(self.cache_dir)
+        files = self.files()
+        if self.includes:
+            makedirs(self.include_dir)
+        for path, content in files:
+            if atomic_write(path, content, only_changed=True):
+                logger.info("writing sites available: {}".format(path))
+                changed.append(path)
+        if self.includes:
+            for path in self.stale_files([f[0] for f in files]):
+                logger.info("removing stale include: {}".format(path))
+                os.remove(path)
+                changed.append(path)
+        return changed
 
     def link_enabled(self):
         """
         link the config file for the site from sites-available to sites-enabled
         """
-        avail_file = os.path.join(self.sites_available, self._conf_file)
-        enabled_file = os.path.join(self.sites_enabled, self._conf_file)
+        avail_file = self.available_file
+        enabled_file = self.enabled_file
         logger.info("linking {} to {}".format(avail_file, enabled_file))
-        os.system("ln -sf {} {}".format(avail_file, enabled_file))
+        atomic_symlink(avail_file, enabled_file)
+
+
+def site_for(vassal, site_name, site_port):
+    """
+    the nginx site a vassal goes in: the site named by its site or
+    server_name setting, a <site_name>_<port> site if it only sets
+    site_port, or else the default site_name site
+
+    :param vassal: loaded VassalConfig instance
+    :param site_name: default nginx site name
+    :param site_port: default nginx port number
+    :returns: tuple of the site name and the port the vassal asks for
+    """
+    name = vassal.nginx_site or vassal.server_name
+    if not name:
+        name = site_name
+        if vassal.nginx_port is not None:
+            name = "{}_{}".format(site_name, vassal.nginx_port)
+    return name, vassal.nginx_port or site_port
+
+
+def group_sites(
+        vassals,
+        site_name,
+        site_port,
+        sites_available=None,
+        sites_enabled=None,
+        includes=False,
+        cache_dir=None):
+    """
+    split vassals into nginx sites by their site, site_port and
+    server_name settings, keeping template order within each site.
+    Vassals without any of them go in the default site, which is
+    always built so its config is kept up to date. Cache zones used
+    in several sites are only defined by the first of them
+
+    :param vassals: list of loaded VassalConfig instances
+    :param site_name: default nginx site name
+    :param site_port: default nginx port number
+    :param sites_available: Path to nginx sites available dir
+    :param sites_enabled: Path to nginx sites enabled dir
+    :param includes: build the sites in include mode
+    :param cache_dir: directory to create the cache zones in
+    :returns: list of NginxSite instances, default site first
+    """
+    sites = OrderedDict()
+    zone_sites = {}
+    sites[site_name] = NginxSite(
+        site_name, site_port, sites_available, sites_enabled, includes,
+        cache_dir=cache_dir
+    )
+    for vassal in vassals:
+        name, port = site_for(vassal, site_name, site_port)
+        site = sites.get(name)
+        if site is None:
+            server_name = vassal.server_name
+            if not (server_name or vassal.nginx_site):
+                # a dedicated port for the default site's server name
+                server_name = site_name
+            site = NginxSite(
+                name, port, sites_available, sites_enabled, includes,
+                server_name=server_name, cache_dir=cache_dir
+            )
+            sites[name] = site
+        elif (port, vassal.server_name or site.server_name) != (
+                site.site_port, site.server_name):
+            logger.warning(
+                "{} asks for port {} and server name {} in site {}, "
+                "using the site's port {} and server name {}".format(
+                    vassal.config_file, port, vassal.server_name, name,
+                    site.site_port, site.server_name
+                )
+            )
+        site.add_vassal(vassal)
+        if vassal.cache_zone:
+            owner = zone_sites.setdefault(vassal.cache_zone, name)
+            if owner != name:
+                site.external_zones.add(vassal.cache_zone)
+    return list(sites.values())
+
+
+class SiteRegistry(object):
+    """
+    Record of the nginx sites written by the deployer, used to
+    retire the files of sites that are no longer built
+
+    :param sites_available: nginx sites available dir the
+        sites are written to
+    """
+    SUFFIX = '.sites'
+    VERSION = 1
+
+    def __init__(self, sites_available):
+        self.path = sidecar_path(sites_available, self.SUFFIX)
+        self.sites = {}
+
+    def load(self):
+        """
+        read the registry, starting from an empty registry
+        if it is missing, unreadable or from a different version
+        """
+        self.sites = {}
+        if not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path, 'r') as handle:
+                data = json.load(handle)
+        except (IOError, OSError, ValueError) as ex:
+            logger.warning(
+                "ignoring unreadable site registry {}: {}".format(self.path, ex)
+            )
+            return
+        if data.get('version') != self.VERSION:
+            return
+        self.sites = data.get('sites', {})
+
+    def save(self):
+        """write the registry"""
+        atomic_write(
+            self.path,
+            json.dumps(
+                {'version': self.VERSION, 'sites': self.sites},
+                indent=2,
+                sort_keys=True
+            ),
+            only_changed=True
+        )
+
+    @staticmethod
+    def entry(site):
+        """the files of site, links first and include dir last"""
+        return [
+            site.enabled_file,
+            site.available_file,
+            site.include_dir if site.includes else None
+        ]
+
+    def stale(self, sites):
+        """
+        the recorded site files that none of sites produces any
+        more and that still exist
+
+        :param sites: list of the NginxSite instances of the deploy
+        :returns: list of paths, links before the files they point
+            to and include dirs last
+        """
+        current = set()
+        for site in sites:
+            current.update(self.entry(site))
+        stale = [[], [], []]
+        for name in sorted(self.sites):
+            for i, path in enumerate(self.sites[name]):
+                if path and path not in current and os.path.lexists(path):
+                    stale[i].append(path)
+        return stale[0] + stale[1] + stale[2]
+
+    def retire(self, sites):
+        """
+        remove the stale site files and record sites as the
+        sites of the deployer
+
+        :param sites: list of the NginxSite instances of the deploy
+        :returns: list of the paths removed
+        """
+        removed = self.stale(sites)
+        for path in removed:
+            logger.info("removing retired site file: {}".format(path))
+            if os.path.isdir(path) and not os.path.islink(path):
+                shutil.rmtree(path)
+            else:
+                os.remove(path)
+        self.sites = dict(
+            (site.site_name, self.entry(site)) for site in sites
+        )
+        return removed
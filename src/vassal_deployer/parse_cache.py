@@ -0,0 +1,122 @@
+#!/usr/bin/env python
+"""
+parse_cache
+
+On disk cache of parsed vassal templates, so that unchanged templates
+load without running configparser on every deploy, plan or watch pass.
+
+Each entry is keyed by the template path and validated against the
+mtime, size and sha256 of the template file. The cache is stored with
+marshal, stamped with the cache format, the VassalConfig parse version
+and the python version (marshal data is specific to it), and a cache
+with a different stamp is discarded rather than trusted.
+
+"""
+import os
+import sys
+import marshal
+import hashlib
+
+from .files import atomic_write, makedirs
+from .vassal_config import PARSE_VERSION
+from . import logger
+
+
+CACHE_VERSION = 1
+
+
+def cache_stamp():
+    """stamp identifying caches this process can read"""
+    return (CACHE_VERSION, PARSE_VERSION, tuple(sys.version_info[:2]))
+
+
+class ParseCache(object):
+    """
+    Cache of the parsed sections of vassal templates
+
+    :param path: file to store the cache in
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.entries = {}
+        self._seen = set()
+        self._dirty = False
+
+    def load(self):
+        """
+        read the cache file, starting from an empty cache if it is
+        missing, unreadable or has a different stamp
+        """
+        self.entries = {}
+        self._seen = set()
+        self._dirty = False
+        if not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path, 'rb') as handle:
+                data = marshal.load(handle)
+        except (IOError, OSError, EOFError, ValueError, TypeError) as ex:
+            logger.warning(
+                "ignoring unreadable parse cache {}: {}".format(self.path, ex)
+            )
+            return
+        if not isinstance(data, dict) or data.get('stamp') != cache_stamp():
+            logger.info("discarding stale parse cache {}".format(self.path))
+            return
+        self.entries = data.get('entries', {})
+
+    def save(self):
+        """
+        write the cache file if it changed, keeping only the
+        entries of the templates looked up since load
+        """
+        stale = set(self.entries) - self._seen
+        if not (self._dirty or stale):
+            return
+        for path in stale:
+            del self.entries[path]
+        dirname = os.path.dirname(os.path.abspath(self.path))
+        makedirs(dirname)
+        atomic_write(
+            self.path,
+            marshal.dumps({'stamp': cache_stamp(), 'entries': self.entries})
+        )
+        self._dirty = False
+
+    @staticmethod
+    def fingerprint(path):
+        """mtime, size and sha256 of the template at path"""
+        stat = os.stat(path)
+        with open(path, 'rb') as handle:
+            digest = hashlib.sha256(handle.read()).hexdigest()
+        mtime = getattr(stat, 'st_mtime_ns', None)
+        if mtime is None:  # python 2
+            mtime = int(stat.st_mtime * 1e9)
+        return (mtime, stat.st_size, digest)
+
+    def get(self, path, fingerprint):
+        """
+        the cached sections of the template at path, or None
+        if it isn't cached or has changed since
+
+        :param path: template path
+        :param fingerprint: fingerprint of the template
+        """
+        self._seen.add(path)
+        entry = self.entries.get(path)
+        if entry is None or tuple(entry[0]) != fingerprint:
+            return None
+        return entry[1]
+
+    def put(self, path, fingerprint, sections):
+        """
+        cache the parsed sections of the template at path
+
+        :param path: template path
+        :param fingerprint: fingerprint of the template before parsing
+        :param sections: dict mapping section names to option dicts
+        """
+        self._seen.add(path)
+        self.entries[path] = (fingerprint, sections)
+        self._dirty = True
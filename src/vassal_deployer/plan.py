@@ -0,0 +1,307 @@
+#!/usr/bin/env python
+"""
+plan
+
+Dry run of a deploy that reports what it would change without
+building anything or writing any files.
+
+The templates are loaded and rendered as deploy would render them,
+the rendered vassal configs and nginx site are diffed against the files
+on disk and the virtualenvs are checked for the requirements missing
+from them by scanning the dist-info/egg-info dirs in their
+site-packages, which takes milliseconds rather than the minutes a
+real deploy spends in virtualenv and pip.
+
+"""
+import os
+import re
+import difflib
+
+from .deploy import make_vassals, load_vassals, open_parse_cache, check_fleet
+from .nginx_config import group_sites, SiteRegistry
+from .manifest import DeployManifest
+from .layers import site_packages, PTH_FILE
+
+
+METADATA_SUFFIXES = ('.dist-info', '.egg-info')
+REQUIREMENT_RE = re.compile(r'^\s*([A-Za-z0-9][A-Za-z0-9._-]*)(?:\[[^\]]*\])?\s*(.*)$')
+ADDSITEDIR_RE = re.compile(r"addsitedir\((['\"])(.*)\1\)")
+
+
+def normalize_name(name):
+    """normalized project name, as pip compares them"""
+    return re.sub(r'[-_.]+', '-', name).lower()
+
+
+def parse_requirement(requirement):
+    """
+    split a requirement string into its normalized project name
+    and its pinned version, if it is pinned with ==
+
+    :returns: tuple of name and version or None, or (None, None)
+        for requirements that aren't plain project names, eg urls
+    """
+    match = REQUIREMENT_RE.match(requirement)
+    if not match:
+        return None, None
+    name, spec = match.groups()
+    pinned = None
+    if spec.startswith('==') and ',' not in spec:
+        pinned = spec[2:].split(';', 1)[0].strip()
+    return normalize_name(name), pinned
+
+
+def installed_packages(venv):
+    """
+    find the packages installed in a virtualenv, including those
+    in a base layer linked into it
+
+    :param venv: path of the virtualenv
+    :returns: dict mapping normalized project names to versions
+    """
+    dirs = [site_packages(venv)]
+    pth = os.path.join(dirs[0], PTH_FILE)
+    if os.path.exists(pth):
+        with open(pth) as handle:
+            match = ADDSITEDIR_RE.search(handle.read())
+        if match:
+            dirs.append(match.group(2))
+    result = {}
+    for directory in dirs:
+        if not os.path.isdir(directory):
+            continue
+        for entry in os.listdir(directory):
+            base, ext = os.path.splitext(entry)
+            if ext not in METADATA_SUFFIXES or '-' not in base:
+                continue
+            name, version = base.split('-', 1)
+            if ext == '.egg-info':
+                version = version.split('-py', 1)[0]
+            result.setdefault(normalize_name(name), version)
+    return result
+
+
+def missing_requirements(requirements, installed):
+    """
+    the requirements that are not installed, or are pinned to a
+    different version than the installed one. Requirements that
+    can't be checked by name, eg urls, are always reported
+
+    :param requirements: list of requirement strings
+    :param installed: dict from installed_packages
+    """
+    missing = []
+    for req in requirements:
+        name, pinned = parse_requirement(req)
+        version = installed.get(name)
+        if version is None or (pinned is not None and pinned != version):
+            missing.append(req)
+    return missing
+
+
+def file_diff(path, content):
+    """
+    unified diff of the file at path against content
+
+    :returns: list of diff lines, empty if the file is up to date
+    """
+    current = []
+    if os.path.exists(path):
+        with open(path) as handle:
+            current = handle.read().splitlines(True)
+    return list(difflib.unified_diff(
+        current,
+        content.splitlines(True),
+        fromfile=path if current else '/dev/null',
+        tofile=path
+    ))
+
+
+class DeployPlan(object):
+    """
+    The actions and file diffs a deploy would make
+    """
+
+    def __init__(self):
+        self.actions = []
+        self.diffs = []
+
+    def add(self, action, target, detail=None):
+        """add an action, eg install, for target"""
+        self.actions.append((action, target, detail))
+
+    def add_diff(self, lines):
+        """add the lines of a file diff"""
+        self.diffs.extend(lines)
+
+    @property
+    def changed(self):
+        """True if the deploy would change anything"""
+        return any(a[0] != 'skip' for a in self.actions)
+
+    def report(self):
+        """the action list followed by the diffs, as a string"""
+        width = max([len(a[0]) for a in self.actions] + [0])
+        lines = []
+        for action, target, detail in self.actions:
+            line = "{}  {}".format(action.ljust(width), target)
+            if detail:
+                line += "  ({})".format(detail)
+            lines.append(line)
+        if not self.changed:
+            lines.append("nothing to do")
+        text = '\n'.join(lines) + '\n'
+        if self.diffs:
+            text += '\n' + ''.join(
+                l if l.endswith('\n') else l + '\n' for l in self.diffs
+            )
+        return text
+
+
+def plan(
+        templates_dir,
+        vassals_dir,
+        site_name,
+        site_port,
+        sites_available=None,
+        sites_enabled=None,
+        incremental=False,
+        only=None,
+        recursive=False,
+        include=None,
+        exclude=None,
+        parse_cache=None,
+        nginx_includes=False,
+        nginx_cache_dir=None,
+        auto_size=False,
+        socket_dir=None,
+        socket_mode='660',
+        socket_owner=None,
+        port_range=None):
+    """
+    work out what deploy would do with the same arguments, without
+    changing anything
+
+    :param templates_dir: file system path containing uwsgi *.ini files,
+        or a list of such paths
+    :param vassals_dir: file system path the vassal configs are written to
+    :param site_name: default nginx site name
+    :param site_port: default nginx port number
+    :param sites_available: Path to nginx sites available dir
+    :param sites_enabled: Path to nginx sites enabled dir
+    :param incremental: report the vassals the deploy manifest records
+        as unchanged as skipped
+    :param only: optional collection of template paths to provision
+    :param recursive: also discover templates in subdirectories
+    :param include: glob patterns of the template files to include
+    :param exclude: glob patterns of template files or subdirectories
+        to leave out
+    :param parse_cache: optional file of a ParseCache to load
+        unchanged templates from. The cache is only read, never saved
+    :param nginx_includes: plan the nginx site as a server block
+        including a file per vassal
+    :param nginx_cache_dir: directory for the nginx cache zones
+    :param auto_size: render the vassal configs with workers sized
+        for the node
+    :param socket_dir: optional directory to assign the vassals
+        unix sockets in
+    :param socket_mode: permissions of the sockets in socket_dir
+    :param socket_owner: optional user[:group] to own the sockets
+    :param port_range: optional tuple of the first and last port to
+        assign the tcp vassals
+    :returns: DeployPlan instance
+    """
+    result = DeployPlan()
+    templates = open_parse_cache(parse_cache)
+    vassals, failures = load_vassals(
+        make_vassals(
+            templates_dir,
+            recursive=recursive,
+            include=include,
+            exclude=exclude
+        ),
+        cache=templates
+    )
+    for config_file, ex in sorted(failures.items()):
+        result.add('error', config_file, str(ex))
+
+    manifest = None
+    if incremental:
+        manifest = DeployManifest(vassals_dir)
+        manifest.load()
+
+    if socket_dir:
+        if not os.path.exists(socket_dir):
+            result.add('create', socket_dir, 'socket dir')
+        for vassal in vassals:
+            vassal.assign_socket(socket_dir, socket_mode, socket_owner)
+    vassals, conflicts = check_fleet(
+        vassals, vassals_dir, site_name, site_port, port_range, save=False
+    )
+    for config_file, ex in sorted(conflicts.items()):
+        result.add('error', config_file, str(ex))
+
+    sizing = None
+    if auto_size:
+        from .sizing import WorkerSizing
+        sizing = WorkerSizing()
+        sizing.plan(vassals)
+
+    for vassal in vassals:
+        if only is not None and vassal.config_file not in only:
+            continue
+        if manifest is not None and manifest.is_current(vassal):
+            result.add('skip', vassal.config_file, 'unchanged')
+            continue
+        venv = vassal.uwsgi_virtualenv
+        if not os.path.exists(os.path.join(venv, 'bin', 'python')):
+            result.add('create', venv, 'virtualenv')
+            missing = vassal.requirements_list
+        else:
+            missing = missing_requirements(
+                vassal.requirements_list, installed_packages(venv)
+            )
+        if missing:
+            result.add('install', venv, ', '.join(missing))
+        diff = file_diff(
+            os.path.join(vassals_dir, vassal.basename),
+            vassal.uwsgi_config(
+                **(sizing.settings_for(vassal) if sizing is not None else {})
+            )
+        )
+        if diff:
+            result.add('write', os.path.join(vassals_dir, vassal.basename))
+            result.add_diff(diff)
+
+    sites = group_sites(
+        vassals,
+        site_name,
+        site_port,
+        sites_available,
+        sites_enabled,
+        nginx_includes,
+        nginx_cache_dir
+    )
+    cache_dirs = set()
+    for site in sites:
+        if site.needs_cache_dir() and site.cache_dir not in cache_dirs:
+            cache_dirs.add(site.cache_dir)
+            result.add('create', site.cache_dir, 'nginx cache dir')
+        files = site.files()
+        for path, content in files:
+            if not isinstance(content, str):
+                content = ''.join(content)
+            diff = file_diff(path, content)
+            if diff:
+                result.add('write', path)
+                result.add_diff(diff)
+        if site.includes:
+            for path in site.stale_files([f[0] for f in files]):
+                result.add('remove', path)
+        if os.path.realpath(site.enabled_file) != os.path.realpath(site.available_file):
+            result.add('link', site.enabled_file, site.available_file)
+    registry = SiteRegistry(sites[0].sites_available)
+    registry.load()
+    for path in registry.stale(sites):
+        result.add('remove', path, 'retired site')
+    return result
@@ -0,0 +1,153 @@
+#!/usr/bin/env python
+"""
+sizing
+
+Automatic uwsgi worker and thread sizing from the resources of the node.
+
+The CPUs available to the deployer (respecting cgroup v1/v2 quotas and
+the scheduler affinity mask) and the memory limit (cgroup or MemTotal)
+are split across the vassals in proportion to their weight. Each vassal
+gets enough workers for its CPU share, capped by its memory share when
+it declares how much memory a worker needs, and clamped to its
+min_workers and max_workers. The workers are run with the uwsgi
+cheaper subsystem so idle vassals scale down to min_workers.
+
+"""
+import os
+from collections import OrderedDict
+
+from . import logger
+
+
+CGROUP_ROOT = '/sys/fs/cgroup'
+MEMINFO = '/proc/meminfo'
+# cgroup v1 reports no memory limit as a huge page aligned number
+UNLIMITED_MEMORY = 1 << 60
+
+
+def _read(path):
+    """stripped content of path, or None if it can't be read"""
+    try:
+        with open(path) as handle:
+            return handle.read().strip()
+    except (IOError, OSError):
+        return None
+
+
+def cgroup_cpus(cgroup_root=CGROUP_ROOT):
+    """
+    CPU quota of the cgroup as a number of CPUs, or None if unlimited
+
+    :param cgroup_root: mount point of the cgroup filesystem
+    """
+    content = _read(os.path.join(cgroup_root, 'cpu.max'))
+    if content:
+        quota, _, period = content.partition(' ')
+        if quota == 'max':
+            return None
+        return float(quota) / float(period or 100000)
+    quota = _read(os.path.join(cgroup_root, 'cpu', 'cpu.cfs_quota_us'))
+    period = _read(os.path.join(cgroup_root, 'cpu', 'cpu.cfs_period_us'))
+    if quota and period and int(quota) > 0:
+        return float(quota) / float(period)
+    return None
+
+
+def cpu_count(cgroup_root=CGROUP_ROOT):
+    """
+    number of CPUs the deployer may use: the affinity mask,
+    limited by the cgroup CPU quota
+
+    :param cgroup_root: mount point of the cgroup filesystem
+    """
+    if hasattr(os, 'sched_getaffinity'):
+        cpus = float(len(os.sched_getaffinity(0)))
+    else:  # pragma: no cover
+        import multiprocessing
+        cpus = float(multiprocessing.cpu_count())
+    quota = cgroup_cpus(cgroup_root)
+    if quota is not None:
+        cpus = min(cpus, quota)
+    return max(cpus, 1.0)
+
+
+def memory_limit(cgroup_root=CGROUP_ROOT, meminfo=MEMINFO):
+    """
+    memory the deployer may use in bytes: the cgroup limit if
+    there is one, otherwise the total memory of the node, or
+    None if neither can be found
+
+    :param cgroup_root: mount point of the cgroup filesystem
+    :param meminfo: path of /proc/meminfo
+    """
+    limits = []
+    for path in (
+            os.path.join(cgroup_root, 'memory.max'),
+            os.path.join(cgroup_root, 'memory', 'memory.limit_in_bytes')):
+        content = _read(path)
+        if content and content.isdigit() and int(content) < UNLIMITED_MEMORY:
+            limits.append(int(content))
+    content = _read(meminfo) or ''
+    for line in content.splitlines():
+        if line.startswith('MemTotal:'):
+            limits.append(int(line.split()[1]) * 1024)
+    return min(limits) if limits else None
+
+
+class WorkerSizing(object):
+    """
+    Split the CPUs and memory of the node across vassals by weight
+
+    :param cpus: CPUs to split, detected if None
+    :param memory: memory in bytes to split, detected if None
+    """
+
+    def __init__(self, cpus=None, memory=None):
+        self.cpus = cpus if cpus is not None else cpu_count()
+        self.memory = memory if memory is not None else memory_limit()
+        self.total_weight = 0.0
+
+    def plan(self, vassals):
+        """
+        add up the weights of all the vassals sharing the node
+
+        :param vassals: list of loaded VassalConfig instances
+        """
+        self.total_weight = sum(v.weight for v in vassals)
+        logger.info("sizing workers for {} CPUs and {} MB across {} vassals".format(
+            self.cpus,
+            self.memory // (1024 * 1024) if self.memory else 'unknown',
+            len(vassals)
+        ))
+
+    def workers_for(self, vassal):
+        """number of workers for vassal"""
+        share = float(vassal.weight) / (self.total_weight or vassal.weight or 1.0)
+        workers = int(round(self.cpus * share * vassal.workers_per_cpu))
+        if vassal.worker_memory and self.memory:
+            budget = self.memory * share
+            workers = min(workers, int(budget // (vassal.worker_memory * 1024 * 1024)))
+        if vassal.max_workers is not None:
+            workers = min(workers, vassal.max_workers)
+        return max(workers, vassal.min_workers, 1)
+
+    def settings_for(self, vassal):
+        """
+        the uwsgi settings sizing the workers of vassal, to render
+        into its config
+
+        :returns: OrderedDict of uwsgi options
+        """
+        workers = self.workers_for(vassal)
+        settings = OrderedDict()
+        settings['workers'] = workers
+        settings['threads'] = vassal.threads
+        if vassal.threads > 1:
+            settings['enable-threads'] = 'true'
+        cheaper = min(vassal.min_workers, workers - 1)
+        if cheaper >= 1:
+            settings['cheaper-algo'] = 'spare'
+            settings['cheaper'] = cheaper
+            settings['cheaper-initial'] = cheaper
+            settings['cheaper-step'] = 1
+        return settings
@@ -0,0 +1,286 @@
+#!/usr/bin/env python
+"""
+state
+
+SQLite store of the history of deploys on a node.
+
+Each deploy run records, for every vassal, the hash of its template,
+the versions of its requirements installed in its virtualenv, a
+fingerprint of everything installed in the virtualenv and the
+duration and result of each phase. The history shows which apps are
+slow to provision, and a virtualenv whose fingerprint changes while
+its template does not, or that differs from the same template on
+another host sharing the state dir, has drifted.
+
+"""
+import os
+import json
+import socket
+import hashlib
+
+from .files import makedirs
+from .plan import installed_packages, parse_requirement
+from . import logger
+
+
+SCHEMA_VERSION = 1
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    host TEXT NOT NULL,
+    started REAL NOT NULL,
+    duration REAL NOT NULL,
+    vassals INTEGER NOT NULL,
+    failures INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS vassals (
+    run_id INTEGER NOT NULL REFERENCES runs(id),
+    name TEXT NOT NULL,
+    config_file TEXT NOT NULL,
+    template_hash TEXT,
+    venv_fingerprint TEXT,
+    requirements TEXT,
+    duration REAL NOT NULL,
+    result TEXT NOT NULL,
+    error TEXT,
+    PRIMARY KEY (run_id, name)
+);
+CREATE TABLE IF NOT EXISTS phases (
+    run_id INTEGER NOT NULL REFERENCES runs(id),
+    name TEXT NOT NULL,
+    phase TEXT NOT NULL,
+    duration REAL NOT NULL,
+    result TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS vassals_name ON vassals(name, run_id);
+"""
+
+
+def resolved_requirements(requirements, installed):
+    """
+    the installed version of each requirement
+
+    :param requirements: list of requirement strings
+    :param installed: dict from plan.installed_packages
+    :returns: dict mapping project names to versions, None for
+        requirements that are not installed. Url requirements
+        are left out
+    """
+    result = {}
+    for req in requirements:
+        if '://' in req:
+            continue
+        name, _ = parse_requirement(req)
+        if name is not None:
+            result[name] = installed.get(name)
+    return result
+
+
+def venv_fingerprint(installed):
+    """hash of the packages installed in a virtualenv"""
+    return hashlib.sha256(
+        json.dumps(sorted(installed.items())).encode('utf-8')
+    ).hexdigest()
+
+
+class StateStore(object):
+    """
+    Deploy history kept in a SQLite database in state_dir
+
+    :param state_dir: directory of the state database, created
+        if needed
+    """
+    FILENAME = 'vassal_deployer.sqlite'
+
+    def __init__(self, state_dir):
+        self.state_dir = state_dir
+        self.path = os.path.join(state_dir, self.FILENAME)
+
+    def connect(self):
+        """
+        open the database, creating the schema on first use. A
+        database with a different schema version is rebuilt
+        """
+        import sqlite3
+        makedirs(self.state_dir)
+        conn = sqlite3.connect(self.path, timeout=30)
+        version = conn.execute('PRAGMA user_version').fetchone()[0]
+        if version not in (0, SCHEMA_VERSION):
+            logger.warning(
+                "rebuilding deploy state {} with schema {}".format(
+                    self.path, SCHEMA_VERSION
+                )
+            )
+            conn.executescript(
+                'DROP TABLE IF EXISTS phases;'
+                'DROP TABLE IF EXISTS vassals;'
+                'DROP TABLE IF EXISTS runs;'
+            )
+        conn.executescript(SCHEMA)
+        conn.execute('PRAGMA user_version = {}'.format(SCHEMA_VERSION))
+        return conn
+
+    def record_run(self, vassals, failures, timings, host=None):
+        """
+        record a deploy run in a single transaction
+
+        :param vassals: list of loaded VassalConfig instances
+        :param failures: dict mapping failed config files to errors,
+            including templates that failed to load
+        :param timings: DeployTimings of the run
+        :param host: host name to record, defaults to this host
+        :returns: id of the recorded run
+        """
+        report = timings.report()
+        entries = report['vassals']
+        rows = []
+        for vassal in vassals:
+            installed = {}
+            if os.path.isdir(vassal.uwsgi_virtualenv):
+                installed = installed_packages(vassal.uwsgi_virtualenv)
+            error = failures.get(vassal.config_file)
+            rows.append((
+                vassal.basename,
+                vassal.config_file,
+                vassal.template_hash,
+                venv_fingerprint(installed) if installed else None,
+                json.dumps(
+                    resolved_requirements(vassal.requirements_list, installed),
+                    sort_keys=True
+                ),
+                error
+            ))
+        loaded = set(v.config_file for v in vassals)
+        for config_file, error in sorted(failures.items()):
+            if config_file not in loaded:
+                rows.append((
+                    os.path.basename(config_file), config_file,
+                    None, None, None, error
+                ))
+
+        conn = self.connect()
+        try:
+            with conn:
+                cursor = conn.execute(
+                    'INSERT INTO runs (host, started, duration, vassals, failures) '
+                    'VALUES (?, ?, ?, ?, ?)',
+                    (
+                        host or socket.gethostname(),
+                        report['started'],
+                        report['duration'],
+                        len(rows),
+                        len(failures)
+                    )
+                )
+                run_id = cursor.lastrowid
+                conn.executemany(
+                    'INSERT INTO vassals VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                    [
+                        (
+                            run_id, name, config_file, template_hash,
+                            fingerprint, requirements,
+                            entries.get(name, {}).get('total', 0.0),
+                            'ok' if error is None else 'error',
+                            None if error is None else str(error)
+                        )
+                        for (name, config_file, template_hash,
+                             fingerprint, requirements, error) in rows
+                    ]
+                )
+                conn.executemany(
+                    'INSERT INTO phases VALUES (?, ?, ?, ?, ?)',
+                    [
+                        (run_id, name, p['phase'], p['duration'], p['result'])
+                        for name, entry in entries.items()
+                        for p in entry['phases']
+                    ]
+                )
+        finally:
+            conn.close()
+        return run_id
+
+    def runs(self, limit=10):
+        """
+        the most recent runs, newest first
+
+        :returns: list of dicts
+        """
+        return self._query(
+            'SELECT * FROM runs ORDER BY id DESC LIMIT ?', (limit,)
+        )
+
+    def vassal_status(self, runs=10):
+        """
+        the latest record of each vassal on each host, with its
+        average duration over its last runs and whether its
+        virtualenv has drifted: its fingerprint changed over its last
+        runs with the same template hash, or differs from
+        another host's latest record for the same template hash
+
+        :param runs: number of runs to average the durations over
+        :returns: list of dicts, slowest average first
+        """
+        rows = self._query(
+            'SELECT v.*, r.host, r.started FROM vassals v '
+            'JOIN runs r ON r.id = v.run_id ORDER BY v.run_id DESC'
+        )
+        history = {}
+        for row in rows:
+            history.setdefault((row['host'], row['name']), []).append(row)
+        latest = dict((key, records[0]) for key, records in history.items())
+
+        result = []
+        for (host, name), records in history.items():
+            current = records[0]
+            recent = records[:runs]
+            fingerprints = set(
+                r['venv_fingerprint'] for r in recent
+                if r['template_hash'] == current['template_hash']
+                and r['venv_fingerprint']
+            )
+            fingerprints.update(
+                r['venv_fingerprint'] for (h, n), r in latest.items()
+                if n == name and h != host and r['venv_fingerprint']
+                and r['template_hash'] == current['template_hash']
+            )
+            status = dict(current)
+            status['requirements'] = json.loads(current['requirements'] or '{}')
+            status['average'] = sum(r['duration'] for r in recent) / len(recent)
+            status['runs'] = len(records)
+            status['drift'] = len(fingerprints) > 1
+            result.append(status)
+        result.sort(key=lambda s: s['average'], reverse=True)
+        return result
+
+    def history(self, name, limit=10):
+        """
+        the phases of the most recent runs of vassal name, newest first
+
+        :returns: list of dicts of the vassal record of each run with
+            a phases list of (phase, duration, result) tuples
+        """
+        records = self._query(
+            'SELECT v.*, r.host, r.started FROM vassals v '
+            'JOIN runs r ON r.id = v.run_id WHERE v.name = ? '
+            'ORDER BY v.run_id DESC LIMIT ?',
+            (name, limit)
+        )
+        for record in records:
+            record['phases'] = [
+                (p['phase'], p['duration'], p['result'])
+                for p in self._query(
+                    'SELECT * FROM phases WHERE run_id = ? AND name = ? '
+                    'ORDER BY rowid', (record['run_id'], name)
+                )
+            ]
+        return records
+
+    def _query(self, sql, params=()):
+        """run a query, returning the rows as dicts"""
+        import sqlite3
+        conn = self.connect()
+        try:
+            conn.row_factory = sqlite3.Row
+            return [dict(row) for row in conn.execute(sql, params)]
+        finally:
+            conn.close()
@@ -0,0 +1,138 @@
+#!/usr/bin/env python
+"""
+timing
+
+Per vassal, per phase timing of a deploy, reported as json and as
+a summary table at the end of the run
+
+"""
+import json
+import time
+import threading
+import contextlib
+from collections import OrderedDict
+
+from .files import atomic_write
+
+
+@contextlib.contextmanager
+def null_timer(phase):
+    """timer that records nothing"""
+    yield
+
+
+def phase_group(phase):
+    """summary column for a phase, eg pip_install for pip_install requests"""
+    return phase.split(' ', 1)[0]
+
+
+class DeployTimings(object):
+    """
+    Collects the duration and result of each phase of a deploy,
+    keyed by the vassal (or site) name the phase ran for.
+    Safe to use from the provisioning worker threads
+    """
+
+    def __init__(self):
+        self.started = time.time()
+        self.records = []
+        self._lock = threading.Lock()
+
+    def record(self, name, phase, duration, result='ok'):
+        """record a completed phase"""
+        with self._lock:
+            self.records.append({
+                'name': str(name),
+                'phase': phase,
+                'duration': duration,
+                'result': result,
+            })
+
+    @contextlib.contextmanager
+    def phase(self, name, phase):
+        """
+        context manager timing a phase for name, recording an
+        error result if the phase raises
+        """
+        start = time.time()
+        try:
+            yield
+        except Exception:
+            self.record(name, phase, time.time() - start, 'error')
+            raise
+        self.record(name, phase, time.time() - start)
+
+    def timer(self, name):
+        """timer for the phases of name, called with the phase name"""
+        return lambda phase: self.phase(name, phase)
+
+    def report(self):
+        """
+        build the report dict, with the phases and total time
+        of each vassal in the order they were first recorded
+        """
+        with self._lock:
+            records = list(self.records)
+        names = OrderedDict()
+        for rec in records:
+            entry = names.setdefault(
+                rec['name'], {'phases': [], 'total': 0.0, 'result': 'ok'}
+            )
+            entry['phases'].append({
+                'phase': rec['phase'],
+                'duration': rec['duration'],
+                'result': rec['result'],
+            })
+            entry['total'] += rec['duration']
+            if rec['result'] != 'ok':
+                entry['result'] = rec['result']
+        return {
+            'started': self.started,
+            'duration': time.time() - self.started,
+            'vassals': names,
+        }
+
+    def write(self, path):
+        """write the json report to path"""
+        atomic_write(path, json.dumps(self.report(), indent=2))
+
+    def summary(self):
+        """
+        summary table of the time spent in each group of phases
+        per vassal, slowest vassal first
+        """
+        report = self.report()
+        columns = []
+        rows = []
+        for name, entry in report['vassals'].items():
+            groups = OrderedDict()
+            for phase in entry['phases']:
+                group = phase_group(phase['phase'])
+                if group not in columns:
+                    columns.append(group)
+                groups[group] = groups.get(group, 0.0) + phase['duration']
+            rows.append((name, groups, entry['total'], entry['result']))
+        rows.sort(key=lambda r: r[2], reverse=True)
+
+        width = max([len('vassal')] + [len(r[0]) for r in rows])
+        col_widths = [max(len(c), 8) for c in columns]
+        lines = [
+            '  '.join(
+                ['vassal'.ljust(width)] +
+                [c.rjust(w) for c, w in zip(columns, col_widths)] +
+                ['total'.rjust(8), 'result']
+            )
+        ]
+        for name, groups, total, result in rows:
+            cells = []
+            for col, w in zip(columns, col_widths):
+                if col in groups:
+                    cells.append("{:.2f}".format(groups[col]).rjust(w))
+                else:
+                    cells.append('-'.rjust(w))
+            lines.append('  '.join(
+                [name.ljust(width)] + cells +
+                ["{:.2f}".format(total).rjust(8), result]
+            ))
+        lines.append("deploy took {:.2f}s".format(report['duration']))
+        return '\n'.join(lines)
@@ -36,7 +36,12 @@ listening on the specified socket
 
 """
 import os
-from virtualenvapi.manage import VirtualEnvironment
+import re
+import json
+import hashlib
+from .files import atomic_write, makedirs
+from .layers import site_packages
+from .timing import null_timer
 from . import logger
 
 
@@ -45,32 +50,103 @@ try:
 except ImportError:  # pragma: no cover
     import configparser
 
+try:
+    intern
+except NameError:  # pragma: no cover
+    from sys import intern
+
+
+PIP_MODES = ('each', 'batch', 'file')
+UNIX_SOCKET_PREFIXES = ('/', '.', '@', 'unix:')
+DEFAULT_CACHE_KEY = '$scheme$host$request_uri'
+PACKAGE_PREFIX = 'pkg:'
+DEFAULT_STATIC_EXPIRES = '7d'
+
+# bump when load changes what it keeps from a template, so
+# parse caches written by older versions are discarded
+PARSE_VERSION = 1
+
+
+class PipInstallError(Exception):
+    """
+    Raised when requirements fail to install into a vassal
+    virtualenv. failures maps each requirement that could not be
+    installed to the pip error for it
+    """
+    def __init__(self, virtualenv, failures):
+        self.virtualenv = virtualenv
+        self.failures = failures
+        msg = "failed to install {} in {}".format(
+            ', '.join(failures), virtualenv
+        )
+        super(PipInstallError, self).__init__(msg)
+
 
 class VassalConfig(dict):
     """
     Representation of a uwsgi vassal config, taking a
     templated uwsgi vassal config with additional directives controlled
     by a vassaldeployer section
+
+    Only the uwsgi and vassaldeployer sections are kept once loaded,
+    with their option names and values interned, since the same
+    settings repeat across the templates of a large fleet
     """
     SECTION = 'vassaldeployer'
+    SECTIONS = ('uwsgi', SECTION)
+
+    __slots__ = ('config_file', 'basename', 'template_hash')
 
     def __init__(self, conf_file):
         self.config_file = conf_file
         self.basename = os.path.basename(self.config_file)
+        self.template_hash = None
+
+    def load(self, cache=None):
+        """
+        read the ini file and hash the uwsgi and vassaldeployer
+        sections of the template
+
+        :param cache: optional ParseCache to load the sections from
+            if the template is unchanged, or to store them in
+        """
+        sections = None
+        if cache is not None:
+            fingerprint = cache.fingerprint(self.config_file)
+            sections = cache.get(self.config_file, fingerprint)
+        if sections is None:
+            sections = self.parse()
+            if cache is not None:
+                cache.put(self.config_file, fingerprint, sections)
+        for section, options in sections.items():
+            values = self.setdefault(intern(section), {})
+            for option, value in options.items():
+                values.setdefault(intern(option), intern(value))
+        self.template_hash = hashlib.sha256(json.dumps(
+            {
+                'uwsgi': self.get('uwsgi', {}),
+                self.SECTION: self.get(self.SECTION, {})
+            },
+            sort_keys=True
+        ).encode('utf-8')).hexdigest()
 
-    def load(self):
+    def parse(self):
         """
-        read the ini file
+        parse the ini file with configparser
+
+        :returns: dict mapping the uwsgi and vassaldeployer
+            sections to dicts of their options
         """
-        self.parser = configparser.RawConfigParser()
-        self.parser.read(self.config_file)
-        for section in self.parser.sections():
-            self.setdefault(section, {})
-            for option in self.parser.options(section):
-                self[section].setdefault(
-                    option,
-                    self.parser.get(section, option)
+        parser = configparser.RawConfigParser()
+        parser.read(self.config_file)
+        sections = {}
+        for section in self.SECTIONS:
+            if parser.has_section(section):
+                sections[section] = dict(
+                    (option, parser.get(section, option))
+                    for option in parser.options(section)
                 )
+        return sections
 
     def uwsgi_config(self, **settings):
         """
@@ -83,6 +159,26 @@ class VassalConfig(dict):
         content += '\n'.join("{}={}".format(k, v) for k, v in iter(values.items()))
         return content
 
+    def nginx_upstream(self):
+        """
+        make the upstream block for the vassal, pooling
+        connections to the uwsgi socket
+
+        this goes in the http context of the nginx conf, outside
+        the server block
+        """
+        server = self.nginx_server
+        if self.max_fails is not None:
+            server += " max_fails={}".format(self.max_fails)
+        if self.fail_timeout is not None:
+            server += " fail_timeout={}".format(self.fail_timeout)
+        conf = "upstream {} {{\n".format(self.upstream_name)
+        conf += "    server {};\n".format(server)
+        if self.keepalive is not None:
+            conf += "    keepalive {};\n".format(self.keepalive)
+        conf += "}\n"
+        return conf
+
     def nginx_config(self):
         """
         make the location section of the nginx conf
@@ -95,15 +191,76 @@ class VassalConfig(dict):
           for more details.
 
         """
-        conf = "location {}".format(self.app_url)
+        conf = self.nginx_static_config()
+        conf += "location {}".format(self.app_url)
         conf += "{\n"
         conf += "    include uwsgi_params;\n"
-        conf += "    uwsgi_pass 127.0.0.1:{};\n".format(self.uwsgi_port)
+        conf += "    uwsgi_pass {};\n".format(self.upstream_name)
         conf += "    uwsgi_param SCRIPT_NAME {};\n".format(self.app_url)
         conf += "    uwsgi_modifier1 30;\n"
+        conf += self.nginx_cache_config()
         conf += "}\n"
         return conf
 
+    def nginx_static_config(self):
+        """
+        make a location section per static mapping of the vassal,
+        serving the files straight from disk so they don't tie up
+        the uwsgi workers
+
+        ^~ stops regex locations from taking the static requests,
+        and both paths end in / so the alias can't be walked out of
+        """
+        conf = ""
+        for prefix, directory in self.static_locations:
+            conf += "location ^~ {}/ {{\n".format(prefix.rstrip('/'))
+            conf += "    alias {}/;\n".format(directory.rstrip('/'))
+            conf += "    sendfile on;\n"
+            conf += "    expires {};\n".format(self.static_expires)
+            conf += "    gzip_static on;\n"
+            conf += "}\n"
+        return conf
+
+    def nginx_cache_path(self, cache_dir):
+        """
+        make the uwsgi_cache_path definition of the cache zone of
+        the vassal, which goes in the http context of the nginx conf
+
+        :param cache_dir: directory the cache zone dirs are created in
+        """
+        conf = "uwsgi_cache_path {} levels=1:2 keys_zone={}:{}".format(
+            os.path.join(cache_dir, self.cache_zone),
+            self.cache_zone,
+            self.section.get('cache_zone_size', '10m')
+        )
+        if self.section.get('cache_max_size'):
+            conf += " max_size={}".format(self.section['cache_max_size'])
+        if self.section.get('cache_inactive'):
+            conf += " inactive={}".format(self.section['cache_inactive'])
+        conf += " use_temp_path=off;\n"
+        return conf
+
+    def nginx_cache_config(self):
+        """
+        make the uwsgi_cache directives of the location of the
+        vassal, if it has a cache zone
+
+        the cache lock and stale responses keep a burst of misses
+        for an expired response from all reaching the workers
+        """
+        if not self.cache_zone:
+            return ""
+        conf = "    uwsgi_cache {};\n".format(self.cache_zone)
+        conf += "    uwsgi_cache_key {};\n".format(self.cache_key)
+        for valid in self.cache_valid:
+            conf += "    uwsgi_cache_valid {};\n".format(valid)
+        if self.cache_bypass:
+            conf += "    uwsgi_cache_bypass {};\n".format(self.cache_bypass)
+            conf += "    uwsgi_no_cache {};\n".format(self.cache_bypass)
+        conf += "    uwsgi_cache_lock on;\n"
+        conf += "    uwsgi_cache_use_stale error timeout updating;\n"
+        return conf
+
     @property
     def uwsgi_socket(self):
         """uwsgi socket location, linked to nginx"""
@@ -122,11 +279,55 @@ class VassalConfig(dict):
             self['uwsgi']['virtualenv'] = venv
         return self['uwsgi']['virtualenv']
 
+    @property
+    def is_unix_socket(self):
+        """True if the uwsgi socket is a unix domain socket"""
+        return self['uwsgi'].get('socket', '').startswith(UNIX_SOCKET_PREFIXES)
+
     @property
     def uwsgi_port(self):
-        """uwsgi port, linked to nginx"""
+        """uwsgi port, linked to nginx, None for unix sockets"""
+        if self.is_unix_socket:
+            return None
         return int(self.uwsgi_socket.split(':', 1)[1])
 
+    @property
+    def nginx_server(self):
+        """address nginx passes requests for the vassal to"""
+        if self.is_unix_socket:
+            path = self.uwsgi_socket
+            if path.startswith('unix:'):
+                path = path[len('unix:'):]
+            return "unix:{}".format(path)
+        return "127.0.0.1:{}".format(self.uwsgi_port)
+
+    def assign_socket(self, socket_dir, mode=None, owner=None):
+        """
+        switch the vassal to a unix socket in socket_dir named after
+        its template, unless it already uses a unix socket
+
+        :param socket_dir: directory to create the sockets in
+        :param mode: optional chmod-socket permissions, eg 660
+        :param owner: optional chown-socket user[:group], eg the nginx user
+        """
+        if self.is_unix_socket:
+            return
+        name = os.path.splitext(self.basename)[0]
+        self['uwsgi']['socket'] = os.path.join(socket_dir, "{}.sock".format(name))
+        if mode:
+            self['uwsgi']['chmod-socket'] = mode
+        if owner:
+            self['uwsgi']['chown-socket'] = owner
+
+    def assign_port(self, port):
+        """
+        switch the tcp socket of the vassal to port, keeping its host
+
+        :param port: port number to listen on
+        """
+        host = self['uwsgi'].get('socket', '').rpartition(':')[0]
+        self['uwsgi']['socket'] = "{}:{}".format(host or '127.0.0.1', port)
+
     @property
     def section(self):
         """get the template section"""
@@ -147,6 +348,144 @@ class VassalConfig(dict):
         """app requirements to install"""
         return self.section.get('requirements', '')
 
+    @property
+    def nginx_site(self):
+        """name of the nginx site the vassal belongs to, if not the default"""
+        return self.section.get('site')
+
+    @property
+    def nginx_port(self):
+        """port of the nginx site of the vassal, if not the default"""
+        port = self.section.get('site_port')
+        if port is None:
+            return None
+        return int(port)
+
+    @property
+    def server_name(self):
+        """server_name of the nginx site of the vassal, if not the default"""
+        return self.section.get('server_name')
+
+    @property
+    def upstream_name(self):
+        """
+        name of the nginx upstream block for the vassal. Templates
+        not named <letters, digits and _>.ini get a short hash of
+        their file name appended, so eg app-1.ini, app.1.ini and
+        app_1.ini don't end up with the same upstream
+        """
+        name, ext = os.path.splitext(self.basename)
+        safe = re.sub(r'[^A-Za-z0-9_]', '_', name)
+        if safe != name or ext != '.ini':
+            safe += '_' + hashlib.sha256(
+                self.basename.encode('utf-8')
+            ).hexdigest()[:8]
+        return "vassal_{}".format(safe)
+
+    @property
+    def keepalive(self):
+        """idle upstream connections nginx keeps open to the vassal"""
+        return self.section.get('keepalive')
+
+    @property
+    def max_fails(self):
+        """failed attempts before nginx marks the vassal unavailable"""
+        return self.section.get('max_fails')
+
+    @property
+    def fail_timeout(self):
+        """time nginx considers the vassal unavailable after max_fails"""
+        return self.section.get('fail_timeout')
+
+    @property
+    def cache_zone(self):
+        """name of the nginx cache zone for the vassal's responses"""
+        return self.section.get('cache_zone')
+
+    @property
+    def cache_valid(self):
+        """list of uwsgi_cache_valid settings, eg 200 302 10m"""
+        return [
+            x.strip()
+            for x in self.section.get('cache_valid', '').split(',') if x.strip()
+        ]
+
+    @property
+    def cache_key(self):
+        """key of cached responses"""
+        return self.section.get('cache_key', DEFAULT_CACHE_KEY)
+
+    @property
+    def cache_bypass(self):
+        """variables that skip the cache when any is set, eg $cookie_session"""
+        return self.section.get('cache_bypass')
+
+    @property
+    def static_locations(self):
+        """
+        list of (url prefix, directory) pairs of the static mappings,
+        eg /static:/opt/app/static. Directories starting with pkg:
+        are resolved in the site-packages of the vassal virtualenv,
+        eg /static:pkg:some_package/static
+        """
+        result = []
+        for entry in self.section.get('static', '').split(','):
+            prefix, _, directory = entry.strip().partition(':')
+            if not (prefix and directory):
+                continue
+            if directory.startswith(PACKAGE_PREFIX):
+                directory = os.path.join(
+                    site_packages(self.uwsgi_virtualenv, self.app_python),
+                    directory[len(PACKAGE_PREFIX):]
+                )
+            result.append((prefix, directory))
+        return result
+
+    @property
+    def static_expires(self):
+        """nginx expires setting of the static files"""
+        return self.section.get('static_expires', DEFAULT_STATIC_EXPIRES)
+
+    @property
+    def weight(self):
+        """share of the node the vassal gets when sizing workers"""
+        return float(self.section.get('weight', 1))
+
+    @property
+    def min_workers(self):
+        """workers the vassal keeps running when idle"""
+        return int(self.section.get('min_workers', 1))
+
+    @property
+    def max_workers(self):
+        """upper bound on the sized workers of the vassal"""
+        value = self.section.get('max_workers')
+        return None if value is None else int(value)
+
+    @property
+    def workers_per_cpu(self):
+        """workers per CPU of the vassal's share of the node"""
+        return float(self.section.get('workers_per_cpu', 2))
+
+    @property
+    def worker_memory(self):
+        """memory in MB a worker of the vassal needs, if known"""
+        value = self.section.get('worker_memory')
+        return None if value is None else int(value)
+
+    @property
+    def threads(self):
+        """threads per worker"""
+        return int(self.section.get('threads', self['uwsgi'].get('threads', 1)))
+
+    @property
+    def requirements_list(self):
+        """app requirements as a list of pip requirement strings"""
+        return [
+            x.strip()
+            for x in self.app_requirements.split(',') if x.strip()
+        ]
+
     @property
     def pip_options(self):
         """extra options to pass to pip install"""
@@ -156,31 +495,117 @@ class VassalConfig(dict):
         """
         execute the virtualenv command using the appropriate python
         """
+        from virtualenvapi.manage import VirtualEnvironment
         logger.info("Making venv: {}".format(self.uwsgi_virtualenv))
-        if not os.path.exists(self.uwsgi_home):
-            os.makedirs(self.uwsgi_home)
+        makedirs(self.uwsgi_home)
         env = VirtualEnvironment(self.uwsgi_virtualenv, python=self.app_python)
         env.open_or_create()
 
-    def pip_install(self):
+    def pip_install(
+            self, mode='each', pip_options=None, timer=None, requirements=None):
         """
         pip install the requirements list
+
+        :param mode: each to run pip once per requirement, batch to
+            install all requirements in a single pip run or file to
+            do the same via a generated requirements file in the
+            virtualenv. If a batched install fails the requirements
+            are retried one at a time to report which of them failed
+        :param pip_options: list of pip options to use instead of the
+            pip_options of the template, eg to install from a wheelhouse
+        :param timer: optional DeployTimings timer, called with the
+            name of each pip phase
+        :param requirements: list of requirements to install instead of
+            the full requirements list, eg the delta over a base layer
+
         """
-        reqs = [
-            x.strip()
-            for x in self.app_requirements.split(',') if x.strip()
-        ]
+        if mode not in PIP_MODES:
+            raise ValueError(
+                "unknown pip mode {}, expected one of {}".format(
+                    mode, ', '.join(PIP_MODES)
+                )
+            )
+        reqs = self.requirements_list
+        if requirements is not None:
+            reqs = list(requirements)
         if not reqs:
             # no reqs specified
             return
+        from virtualenvapi.manage import VirtualEnvironment
+        from virtualenvapi.exceptions import PackageInstallationException
+        if pip_options is None:
+            pip_options = self.pip_options
+        timer = timer or null_timer
         env = VirtualEnvironment(self.uwsgi_virtualenv)
+        if mode == 'each':
+            for req in reqs:
+                logger.info("installing {} in {}".format(req, self.uwsgi_virtualenv))
+                with timer("pip_install {}".format(req)):
+                    env.install(req, options=list(pip_options))
+            return
+
+        logger.info("installing {} in {}".format(', '.join(reqs), self.uwsgi_virtualenv))
+        try:
+            with timer("pip_install {}".format(mode)):
+                self._install_batch(env, reqs, pip_options, mode)
+        except PackageInstallationException as ex:
+            logger.error(
+                "batched install failed in {}: {}, retrying each requirement".format(
+                    self.uwsgi_virtualenv, ex
+                )
+            )
+            self._install_each(env, reqs, pip_options, timer)
+
+    def _install_batch(self, env, reqs, pip_options, mode):
+        """
+        install reqs in a single pip run, from a generated
+        requirements file if mode is file
+        """
+        import subprocess
+        from virtualenvapi.exceptions import PackageInstallationException
+        if mode == 'file':
+            req_file = os.path.join(
+                self.uwsgi_virtualenv, 'vassal-requirements.txt'
+            )
+            with open(req_file, 'w') as handle:
+                handle.write('\n'.join(reqs) + '\n')
+            env.install(
+                '-r {}'.format(req_file),
+                options=list(pip_options)
+            )
+            return
+        try:
+            env._execute_pip(['install'] + reqs + list(pip_options))
+        except subprocess.CalledProcessError as ex:
+            raise PackageInstallationException(
+                (ex.returncode, ex.output, ','.join(reqs))
+            )
+
+    def _install_each(self, env, reqs, pip_options, timer):
+        """
+        install reqs one at a time, raising a PipInstallError
+        listing all of the failed requirements
+        """
+        from virtualenvapi.exceptions import PackageInstallationException
+        failures = {}
         for req in reqs:
             logger.info("installing {} in {}".format(req, self.uwsgi_virtualenv))
-            env.install(req, options=self.pip_options)
+            try:
+                with timer("pip_install {}".format(req)):
+                    env.install(req, options=list(pip_options))
+            except PackageInstallationException as ex:
+                logger.error("failed to install {}: {}".format(req, ex))
+                failures[req] = ex
+        if failures:
+            raise PipInstallError(self.uwsgi_virtualenv, failures)
 
-    def write(self, dirname):
-        """write config for vassal into the vassals dir"""
+    def write(self, dirname, **settings):
+        """
+        write config for vassal into the vassals dir, leaving it
+        untouched if unchanged so the emperor doesn't reload the vassal
+
+        :param settings: extra uwsgi settings, eg the sized workers
+        """
         f = os.path.join(dirname, self.basename)
         logger.info("writing vassal config: {}".format(f))
-        with open(f, 'w') as handle:
-            handle.write(self.uwsgi_config())
+        atomic_write(f, self.uwsgi_config(**settings), only_changed=True)
@@ -0,0 +1,314 @@
+#!/usr/bin/env python
+"""
+venv_cache
+
+Content addressed cache of built virtualenvs shared between vassals.
+
+Vassals that use the same python interpreter, requirements and pip
+options end up with identical virtualenvs, so the first one to be built
+is copied into the cache under a hash of those fields and later vassals
+get a copy (or hardlinked copy) of the cached build instead of running
+virtualenv and pip again.
+
+Virtualenvs hardcode their own location in the scripts under bin/,
+so restored copies are relocated by rewriting the cached path to the
+new location in those files.
+
+The cache is capped in size, evicting the least recently used entries
+
+"""
+import os
+import json
+import time
+import shutil
+import hashlib
+import tempfile
+import threading
+
+from .files import atomic_write, makedirs
+from . import logger
+
+try:
+    from shutil import which
+except ImportError:  # pragma: no cover
+    from distutils.spawn import find_executable as which
+
+
+METADATA_SUFFIX = '.json'
+RELOCATE_DIRS = ('bin', 'Scripts')
+RELOCATE_FILES = ('pyvenv.cfg',)
+
+
+def tree_size(path):
+    """total size in bytes of the files under path"""
+    total = 0
+    for root, dirs, files in os.walk(path):
+        for f in files:
+            try:
+                total += os.lstat(os.path.join(root, f)).st_size
+            except OSError:
+                pass
+    return total
+
+
+def copy_tree(src, dst, hardlink=False):
+    """
+    copy the directory tree src to dst, preserving symlinks.
+
+    If hardlink is True, regular files are hardlinked instead of
+    copied where possible, except for the files that get rewritten
+    on relocation which are always copied.
+    """
+    for root, dirs, files in os.walk(src):
+        rel = os.path.relpath(root, src)
+        target_root = os.path.normpath(os.path.join(dst, rel))
+        makedirs(target_root)
+        relocatable = rel.split(os.sep)[0] in RELOCATE_DIRS
+        for name in dirs + files:
+            source = os.path.join(root, name)
+            target = os.path.join(target_root, name)
+            if os.path.islink(source):
+                os.symlink(os.readlink(source), target)
+                if name in dirs:
+                    # don't walk into symlinked dirs
+                    dirs.remove(name)
+                continue
+            if name in dirs:
+                continue
+            if hardlink and not relocatable and name not in RELOCATE_FILES:
+                try:
+                    os.link(source, target)
+                    continue
+                except OSError:
+                    pass
+            shutil.copy2(source, target)
+
+
+def relocate(venv, old_path, new_path):
+    """
+    rewrite references to old_path with new_path in the
+    scripts and config of the virtualenv at venv
+    """
+    old = old_path.encode('utf-8')
+    new = new_path.encode('utf-8')
+    candidates = [os.path.join(venv, f) for f in RELOCATE_FILES]
+    for d in RELOCATE_DIRS:
+        bindir = os.path.join(venv, d)
+        if os.path.isdir(bindir):
+            candidates.extend(
+                os.path.join(bindir, f) for f in os.listdir(bindir)
+            )
+    for f in candidates:
+        if os.path.islink(f) or not os.path.isfile(f):
+            continue
+        with open(f, 'rb') as handle:
+            content = handle.read()
+        if old not in content:
+            continue
+        mode = os.stat(f).st_mode
+        with open(f, 'wb') as handle:
+            handle.write(content.replace(old, new))
+        os.chmod(f, mode)
+
+
+class VenvCache(object):
+    """
+    Cache of virtualenv builds stored in cache_dir, keyed by a hash
+    of the python interpreter, requirements and pip options
+    of a vassal.
+
+    :param cache_dir: directory to store cached virtualenvs in
+    :param max_size: optional cap in bytes on the total cache size,
+        least recently used entries are evicted to stay under it
+    :param hardlink: hardlink files from the cache into restored
+        virtualenvs instead of copying them
+    """
+
+    def __init__(self, cache_dir, max_size=None, hardlink=False):
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+        self.hardlink = hardlink
+        self._lock = threading.Lock()
+        makedirs(self.cache_dir)
+
+    @staticmethod
+    def cache_key(python, requirements, pip_options):
+        """
+        hash the fields that determine the contents of a virtualenv
+
+        :param python: python interpreter name or path
+        :param requirements: list of requirement strings
+        :param pip_options: list of pip options
+        """
+        interpreter = which(python) or python
+        fields = {
+            'python': python,
+            'interpreter': os.path.realpath(interpreter),
+            'requirements': sorted(requirements),
+            'pip_options': list(pip_options),
+        }
+        digest = hashlib.sha256(
+            json.dumps(fields, sort_keys=True).encode('utf-8')
+        )
+        return digest.hexdigest()
+
+    def key_for(self, vassal):
+        """cache key for a loaded VassalConfig"""
+        return self.cache_key(
+            vassal.app_python,
+            vassal.requirements_list,
+            vassal.pip_options
+        )
+
+    def entry_path(self, key):
+        """path of the cached virtualenv for key"""
+        return os.path.join(self.cache_dir, key)
+
+    def _metadata_path(self, key):
+        return os.path.join(self.cache_dir, key + METADATA_SUFFIX)
+
+    def _read_metadata(self, key):
+        try:
+            with open(self._metadata_path(key), 'r') as handle:
+                return json.load(handle)
+        except (IOError, OSError, ValueError):
+            return None
+
+    def _write_metadata(self, key, metadata):
+        atomic_write(
+            self._metadata_path(key),
+            json.dumps(metadata, indent=2, sort_keys=True)
+        )
+
+    def __contains__(self, key):
+        return (
+            os.path.isdir(self.entry_path(key)) and
+            self._read_metadata(key) is not None
+        )
+
+    def entries(self):
+        """
+        list the metadata of all cache entries, least
+        recently used first
+        """
+        result = []
+        for f in os.listdir(self.cache_dir):
+            if not f.endswith(METADATA_SUFFIX):
+                continue
+            key = f[:-len(METADATA_SUFFIX)]
+            metadata = self._read_metadata(key)
+            if metadata is None or not os.path.isdir(self.entry_path(key)):
+                continue
+            metadata['key'] = key
+            result.append(metadata)
+        result.sort(key=lambda m: m.get('last_used', 0))
+        return result
+
+    def size(self):
+        """total size in bytes of the cache"""
+        return sum(m.get('size', 0) for m in self.entries())
+
+    def restore(self, vassal):
+        """
+        populate the virtualenv of vassal from the cache
+
+        :param vassal: loaded VassalConfig instance
+        :returns: True if the virtualenv was restored from the cache,
+            False if there was no cache entry or the virtualenv
+            already exists
+
+        """
+        key = self.key_for(vassal)
+        target = vassal.uwsgi_virtualenv
+        if key not in self or os.path.exists(target):
+            return False
+        with self._lock:
+            metadata = self._read_metadata(key)
+            if metadata is None:
+                return False
+            metadata['last_used'] = time.time()
+            self._write_metadata(key, metadata)
+        logger.info("restoring venv {} from cache {}".format(target, key))
+        parent = os.path.dirname(target)
+        makedirs(parent)
+        tmp = tempfile.mkdtemp(dir=parent, prefix='.venv-cache-')
+        try:
+            staging = os.path.join(tmp, 'venv')
+            copy_tree(self.entry_path(key), staging, self.hardlink)
+            relocate(staging, metadata['path'], target)
+            os.rename(staging, target)
+        finally:
+            shutil.rmtree(tmp, ignore_errors=True)
+        return True
+
+    def store(self, vassal):
+        """
+        copy the built virtualenv of vassal into the cache,
+        evicting old entries if the cache is over its size cap
+
+        :param vassal: loaded VassalConfig instance with a built venv
+        """
+        key = self.key_for(vassal)
+        if key in self:
+            return
+        source = vassal.uwsgi_virtualenv
+        logger.info("caching venv {} as {}".format(source, key))
+        tmp = tempfile.mkdtemp(dir=self.cache_dir, prefix='.tmp-')
+        try:
+            staging = os.path.join(tmp, key)
+            copy_tree(source, staging)
+            with self._lock:
+                if key in self:
+                    return
+                if os.path.exists(self.entry_path(key)):
+                    shutil.rmtree(self.entry_path(key))
+                os.rename(staging, self.entry_path(key))
+                now = time.time()
+                self._write_metadata(key, {
+                    'path': source,
+                    'python': vassal.app_python,
+                    'requirements': vassal.requirements_list,
+                    'pip_options': vassal.pip_options,
+                    'size': tree_size(self.entry_path(key)),
+                    'created': now,
+                    'last_used': now,
+                })
+        finally:
+            shutil.rmtree(tmp, ignore_errors=True)
+        if self.max_size is not None:
+            self.prune()
+
+    def remove(self, key):
+        """remove the cache entry for key"""
+        with self._lock:
+            logger.info("evicting venv cache entry {}".format(key))
+            if os.path.exists(self._metadata_path(key)):
+                os.remove(self._metadata_path(key))
+            shutil.rmtree(self.entry_path(key), ignore_errors=True)
+
+    def prune(self, max_size=None):
+        """
+        evict least recently used entries until the cache fits
+        in max_size bytes (defaults to the cache size cap)
+
+        :returns: list of evicted keys
+        """
+        if max_size is None:
+            max_size = self.max_size
+        if max_size is None:
+            return []
+        entries = self.entries()
+        total = sum(m.get('size', 0) for m in entries)
+        evicted = []
+        for metadata in entries:
+            if total <= max_size:
+                break
+            self.remove(metadata['key'])
+            total -= metadata.get('size', 0)
+            evicted.append(metadata['key'])
+        return evicted
+
+    def clear(self):
+        """remove all cache entries"""
+        for metadata in self.entries():
+            self.remove(metadata['key'])
@@ -0,0 +1,279 @@
+#!/usr/bin/env python
+"""
+watch
+
+Daemon mode that watches the vassal templates directory and
+redeploys only the templates that were added or changed, removes
+the vassals whose templates were deleted and regenerates the nginx site.
+
+Changes are detected with inotify when the optional inotify_simple
+package is installed, otherwise by polling the template mtimes.
+Bursts of changes (eg an rsync of many templates) are debounced
+into a single redeploy.
+
+"""
+import os
+import time
+
+from .deploy import (
+    deploy, list_vassals_configs, matches_patterns, DeployError, STRING_TYPES
+)
+from . import logger
+
+try:
+    import inotify_simple
+except ImportError:  # pragma: no cover
+    inotify_simple = None
+
+
+def snapshot(directory, **discovery):
+    """
+    map each vassal template in directory to its mtime and size
+
+    :param directory: file system path containing *.ini files,
+        or a list of such paths
+    :param discovery: recursive, include and exclude keyword args
+        passed through to list_vassals_configs
+    """
+    result = {}
+    for path in list_vassals_configs(directory, **discovery):
+        try:
+            stat = os.stat(path)
+        except OSError:
+            # deleted between listing and stat
+            continue
+        result[path] = (stat.st_mtime, stat.st_size)
+    return result
+
+
+def diff_snapshots(old, new):
+    """
+    compare two snapshots
+
+    :returns: tuple of sorted lists of added, changed and removed paths
+    """
+    added = sorted(set(new) - set(old))
+    removed = sorted(set(old) - set(new))
+    changed = sorted(p for p in set(old) & set(new) if old[p] != new[p])
+    return added, changed, removed
+
+
+class TemplateWatcher(object):
+    """
+    Wait for changes to the templates in a directory, using inotify
+    if available and falling back to polling every interval seconds.
+    inotify doesn't watch subdirectories, so recursive discovery
+    always polls
+
+    :param directory: templates directory to watch, or a list of them
+    :param interval: polling interval in seconds
+    :param use_inotify: set to False to force polling
+    :param discovery: recursive, include and exclude keyword args
+        passed through to list_vassals_configs
+    """
+
+    def __init__(self, directory, interval=1.0, use_inotify=True, **discovery):
+        self.directory = directory
+        self.interval = interval
+        self.discovery = discovery
+        self._inotify = None
+        self._last = snapshot(directory, **discovery)
+        if discovery.get('recursive'):
+            use_inotify = False
+        if use_inotify and inotify_simple is not None:
+            flags = inotify_simple.flags
+            self._inotify = inotify_simple.INotify()
+            directories = [directory] if isinstance(directory, STRING_TYPES) else directory
+            for path in directories:
+                self._inotify.add_watch(
+                    path,
+                    flags.CLOSE_WRITE | flags.CREATE | flags.DELETE |
+                    flags.MODIFY | flags.MOVED_FROM | flags.MOVED_TO |
+                    flags.ATTRIB
+                )
+            logger.info("watching {} with inotify".format(directory))
+        else:
+            logger.info("polling {} every {}s".format(directory, interval))
+
+    def wait(self, timeout=None):
+        """
+        block until a template changes or timeout seconds pass
+
+        :param timeout: seconds to wait, or None to wait forever
+        :returns: True if a change was seen, False on timeout
+        """
+        if self._inotify is not None:
+            events = self._inotify.read(
+                timeout=None if timeout is None else int(timeout * 1000)
+            )
+            return any(
+                not e.name or matches_patterns(
+                    e.name,
+                    self.discovery.get('include'),
+                    self.discovery.get('exclude')
+                )
+                for e in events
+            )
+        deadline = None if timeout is None else time.time() + timeout
+        while True:
+            current = snapshot(self.directory, **self.discovery)
+            if current != self._last:
+                self._last = current
+                return True
+            if deadline is not None and time.time() >= deadline:
+                return False
+            delay = self.interval
+            if deadline is not None:
+                delay = max(0, min(delay, deadline - time.time()))
+            time.sleep(delay)
+
+    def wait_quiet(self, debounce):
+        """
+        after a change, keep waiting until no further changes
+        are seen for debounce seconds
+        """
+        while self.wait(debounce):
+            pass
+
+    def close(self):
+        """release the inotify watch"""
+        if self._inotify is not None:
+            self._inotify.close()
+            self._inotify = None
+
+
+class WatchDeployer(object):
+    """
+    Run a full deploy, then redeploy the changed templates
+    every time the templates directory changes
+
+    :param templates_dir: file system path containing uwsgi *.ini files,
+        or a list of such paths
+    :param vassals_dir: file system path to write the vassal configs to
+    :param site_name: nginx site name
+    :param site_port: nginx port number
+    :param sites_available: Path to nginx sites available dir
+    :param sites_enabled: Path to nginx sites enabled dir
+    :param interval: polling interval in seconds when inotify
+        is not available
+    :param debounce: seconds without changes to wait for before
+        redeploying
+    :param options: keyword args passed through to deploy
+    """
+
+    def __init__(
+            self,
+            templates_dir,
+            vassals_dir,
+            site_name,
+            site_port,
+            sites_available=None,
+            sites_enabled=None,
+            interval=1.0,
+            debounce=2.0,
+            **options):
+        self.templates_dir = templates_dir
+        self.vassals_dir = vassals_dir
+        self.site_args = (site_name, site_port, sites_available, sites_enabled)
+        self.interval = interval
+        self.debounce = debounce
+        self.options = options
+        self.discovery = dict(
+            (k, options[k]) for k in ('recursive', 'include', 'exclude')
+            if k in options
+        )
+        self.snapshot = {}
+        self.failed = set()
+
+    def deploy(self, only=None):
+        """
+        run deploy, provisioning only the given templates and
+        retrying the ones that failed last time. Errors outside the
+        vassals, eg a failing reload command, are logged and all the
+        templates of the run are retried on the next change
+        """
+        if only is not None:
+            only = set(only) | self.failed
+        try:
+            deploy(
+                self.templates_dir,
+                self.vassals_dir,
+                *self.site_args,
+                only=only,
+                **self.options
+            )
+            self.failed = set()
+        except DeployError as ex:
+            logger.error(str(ex))
+            self.failed = set(ex.failures)
+        except Exception as ex:
+            logger.exception("deploy failed: {}".format(ex))
+            self.failed = set(self.snapshot) if only is None else only
+
+    def remove(self, template, current=None):
+        """
+        remove the rendered vassal config of a deleted template,
+        unless a remaining template has the same file name and so
+        renders to the same config
+
+        :param template: path of the deleted template
+        :param current: snapshot of the remaining templates
+        :returns: sorted list of the remaining templates with the
+            same file name, to redeploy over the rendered config
+        """
+        self.failed.discard(template)
+        name = os.path.basename(template)
+        survivors = sorted(
+            p for p in (current or {}) if os.path.basename(p) == name
+        )
+        if survivors:
+            logger.info("keeping vassal config {} of {}".format(name, survivors[0]))
+            return survivors
+        vassal = os.path.join(self.vassals_dir, name)
+        logger.info("removing vassal config: {}".format(vassal))
+        if os.path.exists(vassal):
+            os.remove(vassal)
+        return []
+
+    def sync(self):
+        """
+        compare the templates against the last snapshot and
+        redeploy the added and changed templates
+
+        :returns: True if anything changed
+        """
+        current = snapshot(self.templates_dir, **self.discovery)
+        added, changed, removed = diff_snapshots(self.snapshot, current)
+        self.snapshot = current
+        if not (added or changed or removed):
+            return False
+        logger.info("templates added: {} changed: {} removed: {}".format(
+            len(added), len(changed), len(removed)
+        ))
+        redeploy = added + changed
+        for template in removed:
+            redeploy.extend(self.remove(template, current))
+        self.deploy(only=redeploy)
+        return True
+
+    def run(self, watcher=None):
+        """
+        deploy all templates, then watch for changes until interrupted
+        """
+        watcher = watcher or TemplateWatcher(
+            self.templates_dir, self.interval, **self.discovery
+        )
+        self.snapshot = snapshot(self.templates_dir, **self.discovery)
+        self.deploy()
+        try:
+            while True:
+                if watcher.wait():
+                    watcher.wait_quiet(self.debounce)
+                    try:
+                        self.sync()
+                    except Exception as ex:
+                        logger.exception("failed to sync templates: {}".format(ex))
+        except KeyboardInterrupt:
+            logger.info("stopping watch of {}".format(self.templates_dir))
+        finally:
+            watcher.close()
@@ -0,0 +1,178 @@
+#!/usr/bin/env python
+"""
+wheelhouse
+
+Shared local wheelhouse that the requirements of all vassals are
+prefetched into before the vassal virtualenvs get built.
+
+Requirements are grouped by python interpreter (and by pip options,
+since those carry the index settings needed to fetch them), each group
+is built into wheels once with pip wheel in a throwaway build virtualenv
+and the vassals then install from the wheelhouse without any index
+access. An offline wheelhouse skips the build step and installs from the
+wheels already present, which allows air-gapped redeploys.
+
+"""
+import os
+import re
+from collections import OrderedDict
+
+from .files import makedirs
+from . import logger
+
+
+BUILD_VENV = '.build-venv'
+INDEX_OPTIONS = ('--index-url', '--extra-index-url')
+SOURCE_OPTIONS = INDEX_OPTIONS + ('--find-links', '--no-index')
+SHORT_OPTIONS = {'-i': '--index-url', '-f': '--find-links'}
+
+
+def index_option(name, options=INDEX_OPTIONS):
+    """
+    the option of options that name refers to, allowing the short
+    options and the abbreviated long options pip accepts such as
+    --extra-index, or None
+    """
+    if name in SHORT_OPTIONS:
+        name = SHORT_OPTIONS[name]
+    if not name.startswith('--'):
+        return None
+    matches = [o for o in options if o.startswith(name)]
+    return matches[0] if len(matches) == 1 else None
+
+
+def strip_index_options(pip_options):
+    """
+    pip_options without the options that set where packages are
+    found, eg --index-url and --find-links, keeping the others
+    such as --pre or --no-deps
+    """
+    result = []
+    skip_value = False
+    for opt in pip_options:
+        if skip_value:
+            skip_value = False
+            continue
+        name, sep, _ = opt.partition('=')
+        option = index_option(name, SOURCE_OPTIONS)
+        if option is None:
+            result.append(opt)
+            continue
+        skip_value = option != '--no-index' and not sep
+    return result
+
+
+def group_key(vassal):
+    """wheelhouse group of a loaded VassalConfig"""
+    return (vassal.app_python, tuple(vassal.pip_options))
+
+
+def collect_requirements(vassals):
+    """
+    collect the union of the requirements of vassals, grouped by
+    python interpreter and pip options
+
+    :param vassals: list of loaded VassalConfig instances
+    :returns: OrderedDict mapping (python, pip_options) to the list of
+        unique requirements of that group, in order of appearance
+
+    """
+    groups = OrderedDict()
+    for vassal in vassals:
+        reqs = groups.setdefault(group_key(vassal), [])
+        for req in vassal.requirements_list:
+            if req not in reqs:
+                reqs.append(req)
+    return groups
+
+
+class Wheelhouse(object):
+    """
+    Local directory of wheels shared by all vassals, with a
+    subdirectory per python interpreter
+
+    :param directory: wheelhouse directory
+    :param offline: don't build or download wheels, install only from
+        the wheels already in the wheelhouse
+    """
+
+    def __init__(self, directory, offline=False):
+        self.directory = directory
+        self.offline = offline
+        self._ready = set()
+
+    def path_for(self, python):
+        """wheel directory for the given python interpreter"""
+        name = re.sub(r'[^A-Za-z0-9._-]+', '_', python).strip('_')
+        return os.path.join(self.directory, name or 'python')
+
+    def build(self, python, pip_options, requirements):
+        """
+        build or download wheels for requirements into the wheel
+        directory of python, using a build virtualenv for that python
+
+        :param python: python interpreter
+        :param pip_options: list of pip options with the index settings
+        :param requirements: list of requirement strings
+        """
+        import subprocess
+        from virtualenvapi.manage import VirtualEnvironment
+        from virtualenvapi.exceptions import PackageWheelException
+        wheel_dir = self.path_for(python)
+        makedirs(wheel_dir)
+        logger.info("prefetching wheels into {}: {}".format(
+            wheel_dir, ', '.join(requirements)
+        ))
+        env = VirtualEnvironment(
+            os.path.join(wheel_dir, BUILD_VENV), python=python
+        )
+        env.open_or_create()
+        env.install('wheel', options=list(pip_options))
+        try:
+            env._execute_pip(
+                ['wheel', '--wheel-dir', wheel_dir] +
+                list(pip_options) +
+                list(requirements)
+            )
+        except subprocess.CalledProcessError as ex:
+            raise PackageWheelException(
+                (ex.returncode, ex.output, ','.join(requirements))
+            )
+
+    def prefetch(self, vassals):
+        """
+        build the wheels for all vassals. Groups that fail to build
+        are logged and left to install from their index as usual
+
+        :param vassals: list of loaded VassalConfig instances
+        """
+        for key, reqs in collect_requirements(vassals).items():
+            python, pip_options = key
+            if self.offline:
+                self._ready.add(key)
+                continue
+            if not reqs:
+                continue
+            try:
+                self.build(python, pip_options, reqs)
+            except Exception as ex:
+                logger.error(
+                    "failed to prefetch wheels for {}: {}".format(python, ex)
+                )
+                continue
+            self._ready.add(key)
+
+    def install_options(self, vassal):
+        """
+        pip options to install the requirements of vassal from the
+        wheelhouse with no index access, or None if its wheels
+        were not prefetched. The index options of the vassal are
+        replaced, its other pip options are kept
+
+        :param vassal: loaded VassalConfig instance
+        """
+        if group_key(vassal) not in self._ready:
+            return None
+        return strip_index_options(vassal.pip_options) + [
+            '--no-index', '--find-links', self.path_for(vassal.app_python)
+        ]
@@ -0,0 +1,5 @@
+#!/usr/bin/env python
+"""
+deploy benchmarks
+
+"""
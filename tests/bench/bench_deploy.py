@@ -0,0 +1,288 @@
+#!/usr/bin/env python
+"""
+_bench_deploy_
+
+Benchmark harness measuring how deploy, VassalConfig.load and
+NginxSite.configuration scale with the number of vassals.
+
+Synthetic fleets of N templates, modelled on the integ test fixtures,
+are deployed with stubbed virtualenv and pip backends so that only the
+deployer's own overhead is measured. Wall time, peak python memory and
+the per-phase cost reported by the deploy timings are recorded for each
+fleet size and can be saved and compared against a baseline:
+
+    python -m tests.bench.bench_deploy --sizes 10,100,1000 --output bench.json
+    python -m tests.bench.bench_deploy --baseline bench.json
+
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import tempfile
+import platform
+import tracemalloc
+
+import mock
+
+from vassal_deployer.deploy import deploy, make_vassals
+from vassal_deployer.nginx_config import NginxSite
+
+
+DEFAULT_SIZES = (10, 100, 1000, 10000)
+REQUIREMENTS = ('requests', 'arrow', 'flask', 'sqlalchemy', 'six', 'pytz')
+
+TEMPLATE = \
+"""[uwsgi]
+home={home}/app_{index}
+socket=127.0.0.1:{port}
+module=app_{index}.wsgi:APP
+master=1
+enable-threads=true
+workers=2
+die-on-term=1
+virtualenv={home}/app_{index}/venv
+
+[vassaldeployer]
+app_url=/app_{index}
+python=python
+requirements={requirements}
+"""
+
+
+class StubVirtualEnvironment(object):
+    """virtualenv backend that only creates the venv dir"""
+    def __init__(self, path, python=None, **kwargs):
+        self.path = path
+
+    def open_or_create(self):
+        if not os.path.exists(self.path):
+            os.makedirs(self.path)
+
+    def install(self, package, options=None):
+        pass
+
+    def _execute_pip(self, args, log=True):
+        return ''
+
+
+def write_templates(target_dir, home, count):
+    """write count synthetic vassal templates to target_dir"""
+    for index in range(count):
+        reqs = [
+            REQUIREMENTS[(index + i) % len(REQUIREMENTS)]
+            for i in range(1 + index % 3)
+        ]
+        with open(os.path.join(target_dir, 'app_{}.ini'.format(index)), 'w') as handle:
+            handle.write(TEMPLATE.format(
+                home=home,
+                index=index,
+                port=10000 + index,
+                requirements=','.join(reqs)
+            ))
+
+
+def measure(func):
+    """run func returning its result, wall time and peak traced memory"""
+    tracemalloc.start()
+    start = time.time()
+    try:
+        result = func()
+        elapsed = time.time() - start
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    return result, elapsed, peak
+
+
+def phase_costs(timings):
+    """total time per phase group across all vassals of a timings report"""
+    costs = {}
+    for entry in timings['vassals'].values():
+        for phase in entry['phases']:
+            group = phase['phase'].split(' ', 1)[0]
+            costs[group] = costs.get(group, 0.0) + phase['duration']
+    return costs
+
+
+def bench_size(count, jobs=1):
+    """
+    benchmark a fleet of count vassals
+
+    :returns: dict of the measurements for the fleet
+    """
+    root = tempfile.mkdtemp()
+    try:
+        dirs = {}
+        for name in ('home', 'templates', 'vassals', 'available', 'enabled'):
+            dirs[name] = os.path.join(root, name)
+            os.makedirs(dirs[name])
+        write_templates(dirs['templates'], dirs['home'], count)
+        timings_out = os.path.join(root, 'timings.json')
+
+        def load():
+            vassals = list(make_vassals(dirs['templates']))
+            for vassal in vassals:
+                vassal.load()
+            return vassals
+
+        def configuration():
+            site = NginxSite('bench', 8080, dirs['available'], dirs['enabled'])
+            for vassal in vassals:
+                site.add_vassal(vassal)
+            return site.configuration()
+
+        def run_deploy():
+            deploy(
+                dirs['templates'],
+                dirs['vassals'],
+                'bench',
+                8080,
+                dirs['available'],
+                dirs['enabled'],
+                jobs=jobs,
+                timings_out=timings_out
+            )
+
+        with mock.patch(
+                'virtualenvapi.manage.VirtualEnvironment',
+                StubVirtualEnvironment):
+            vassals, load_time, load_peak = measure(load)
+            conf, conf_time, conf_peak = measure(configuration)
+            _, deploy_time, deploy_peak = measure(run_deploy)
+
+        with open(timings_out) as handle:
+            timings = json.load(handle)
+        return {
+            'vassals': count,
+            'jobs': jobs,
+            'load': {'wall': load_time, 'peak_memory': load_peak},
+            'configuration': {
+                'wall': conf_time,
+                'peak_memory': conf_peak,
+                'size': len(conf)
+            },
+            'deploy': {
+                'wall': deploy_time,
+                'peak_memory': deploy_peak,
+                'phases': phase_costs(timings)
+            },
+        }
+    finally:
+        shutil.rmtree(root, ignore_errors=True)
+
+
+def run(sizes, jobs=1):
+    """run the benchmark for each fleet size"""
+    results = {
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'timestamp': time.time(),
+        'results': []
+    }
+    for count in sizes:
+        result = bench_size(count, jobs)
+        results['results'].append(result)
+        print(format_result(result))
+    return results
+
+
+def format_result(result):
+    """one line summary of a fleet result"""
+    return (
+        "{vassals:>6} vassals  load {load:8.3f}s  conf {conf:8.3f}s  "
+        "deploy {deploy:8.3f}s  peak {peak:8.1f}MB".format(
+            vassals=result['vassals'],
+            load=result['load']['wall'],
+            conf=result['configuration']['wall'],
+            deploy=result['deploy']['wall'],
+            peak=result['deploy']['peak_memory'] / (1024.0 * 1024.0)
+        )
+    )
+
+
+def compare(results, baseline, threshold):
+    """
+    compare wall times against a baseline run
+
+    :returns: list of (vassals, measurement, ratio) for the
+        measurements that regressed by more than threshold
+    """
+    base = dict((r['vassals'], r) for r in baseline['results'])
+    regressions = []
+    for result in results['results']:
+        previous = base.get(result['vassals'])
+        if previous is None:
+            continue
+        for key in ('load', 'configuration', 'deploy'):
+            old = previous[key]['wall']
+            new = result[key]['wall']
+            ratio = new / old if old else 1.0
+            print("{:>6} vassals  {:<13} {:8.3f}s -> {:8.3f}s  ({:+.1f}%)".format(
+                result['vassals'], key, old, new, (ratio - 1.0) * 100
+            ))
+            if ratio > 1.0 + threshold:
+                regressions.append((result['vassals'], key, ratio))
+    return regressions
+
+
+def build_parser(argv=None):
+    """build command line parser"""
+    parser = argparse.ArgumentParser(
+        description='benchmark deploy with synthetic vassal fleets'
+    )
+    parser.add_argument(
+        '--sizes',
+        help='comma separated fleet sizes',
+        default=','.join(str(s) for s in DEFAULT_SIZES)
+    )
+    parser.add_argument(
+        '--jobs',
+        help='deploy worker threads',
+        default=1,
+        type=int
+    )
+    parser.add_argument(
+        '--output',
+        help='file to store the results in',
+        default=None
+    )
+    parser.add_argument(
+        '--baseline',
+        help='results file of a previous run to compare against',
+        default=None
+    )
+    parser.add_argument(
+        '--threshold',
+        help='allowed slowdown against the baseline, eg 0.2 for 20%%',
+        default=0.2,
+        type=float
+    )
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    """run the benchmarks, store and compare the results"""
+    opts = build_parser(argv)
+    sizes = [int(s) for s in opts.sizes.split(',') if s.strip()]
+    results = run(sizes, opts.jobs)
+    if opts.output:
+        with open(opts.output, 'w') as handle:
+            json.dump(results, handle, indent=2)
+    if opts.baseline:
+        with open(opts.baseline) as handle:
+            baseline = json.load(handle)
+        regressions = compare(results, baseline, opts.threshold)
+        if regressions:
+            for count, key, ratio in regressions:
+                print("REGRESSION: {} with {} vassals is {:.2f}x slower".format(
+                    key, count, ratio
+                ))
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,15 @@
+#!/usr/bin/env python
+"""
+coroutine fakes for the async_provision tests, kept out of the
+test module so that it still compiles on python 2
+"""
+
+
+def fake_command(handler):
+    """
+    coroutine function standing in for AsyncProvisioner.run_command,
+    returning handler(args)
+    """
+    async def run_command(label, args, cwd=None):
+        return handler(args)
+    return run_command
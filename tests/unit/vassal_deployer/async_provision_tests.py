@@ -0,0 +1,114 @@
+#!/usr/bin/env python
+"""
+async_provision module tests
+"""
+import os
+import sys
+import mock
+import tempfile
+import unittest
+
+from vassal_deployer.vassal_config import PipInstallError
+
+if sys.version_info >= (3, 5):
+    import asyncio
+    from vassal_deployer.async_provision import (
+        AsyncProvisioner, CommandError, index_hosts
+    )
+    from .async_fakes import fake_command
+
+
+@unittest.skipIf(sys.version_info < (3, 5), 'asyncio backend requires python 3.5+')
+class AsyncProvisionerTests(unittest.TestCase):
+    """tests for AsyncProvisioner class"""
+    def setUp(self):
+        """set up temp dir"""
+        self.dir = tempfile.mkdtemp()
+        self.venv = os.path.join(self.dir, 'app', 'venv')
+
+    def tearDown(self):
+        """clean up tempdir"""
+        if os.path.exists(self.dir):
+            os.system('rm -rf {}'.format(self.dir))
+
+    def make_vassal(self, reqs=('requests', 'arrow'), pip_options=()):
+        return mock.Mock(
+            basename='app.ini',
+            config_file='app.ini',
+            app_python='python',
+            requirements_list=list(reqs),
+            pip_options=list(pip_options),
+            uwsgi_home=os.path.join(self.dir, 'app'),
+            uwsgi_virtualenv=self.venv
+        )
+
+    def test_index_hosts(self):
+        """test finding the index hosts of pip options"""
+        self.assertEqual(index_hosts([]), ['pypi.org'])
+        self.assertEqual(index_hosts(['--no-index', '--find-links', 'x']), [])
+        self.assertEqual(
+            index_hosts(['--extra-index=mypypi:8080', '--trusted-host', 'mypypi']),
+            ['mypypi:8080', 'pypi.org']
+        )
+        self.assertEqual(
+            index_hosts(['-i', 'https://pypi.internal/simple']),
+            ['pypi.internal']
+        )
+
+    def test_run_command(self):
+        """test output is streamed and failures raised"""
+        provisioner = AsyncProvisioner()
+        with mock.patch('vassal_deployer.async_provision.logger') as mock_log:
+            loop = asyncio.new_event_loop()
+            try:
+                output = loop.run_until_complete(provisioner.run_command(
+                    'app.ini', [sys.executable, '-c', 'print("one"); print("two")']
+                ))
+                self.assertEqual(output, ['one', 'two'])
+                mock_log.info.assert_has_calls([
+                    mock.call('[app.ini] one'), mock.call('[app.ini] two')
+                ])
+                with self.assertRaises(CommandError) as ctx:
+                    loop.run_until_complete(provisioner.run_command(
+                        'app.ini', [sys.executable, '-c', 'import sys; sys.exit(3)']
+                    ))
+                self.assertEqual(ctx.exception.returncode, 3)
+            finally:
+                loop.close()
+
+    def test_provision_all(self):
+        """test provisioning runs virtualenv and one pip run per vassal"""
+        commands = []
+
+        def run_command(args):
+            commands.append(args)
+            return []
+        provisioner = AsyncProvisioner(jobs=2)
+        provisioner.run_command = fake_command(run_command)
+        vassal = self.make_vassal()
+
+        results = provisioner.provision_all([vassal], self.dir)
+        self.assertEqual(results, [None])
+        self.assertEqual(commands[0], ['virtualenv', '-p', 'python', self.venv])
+        self.assertEqual(commands[1][-2:], ['requests', 'arrow'])
+        self.assertEqual(commands[1][1:4], ['-m', 'pip', 'install'])
+        vassal.write.assert_called_once_with(self.dir)
+
+    def test_provision_failures(self):
+        """test failed batches are retried per requirement"""
+        def run_command(args):
+            if 'arrow' in args:
+                raise CommandError(args, 1, ['no arrow'])
+            return []
+        provisioner = AsyncProvisioner()
+        provisioner.run_command = fake_command(run_command)
+        vassal = self.make_vassal()
+
+        results = provisioner.provision_all([vassal], self.dir)
+        self.failUnless(isinstance(results[0], PipInstallError))
+        self.assertEqual(list(results[0].failures), ['arrow'])
+        self.failIf(vassal.write.called)
+
+
+if __name__ == '__main__':
+    unittest.main()
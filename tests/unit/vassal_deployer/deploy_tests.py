@@ -4,12 +4,15 @@ deploy module tests
 
 """
 import os
+import json
 import mock
 import tempfile
 import unittest
+from collections import OrderedDict
 
 from vassal_deployer.deploy import (
-    deploy, list_vassals_configs, make_vassals
+    deploy, list_vassals_configs, make_vassals, provision_vassal, DeployError,
+    assign_sockets
 )
 
 
@@ -20,28 +23,77 @@ class DeployTests(unittest.TestCase):
         for i in range(1, 4):
             with open(os.path.join(self.dir, 'vassal{0}.ini'.format(i)), 'w') as handle:
                 handle.write('womp')
-
+        self.fleet_patcher = mock.patch('vassal_deployer.deploy.FleetIndex')
+        mock_index_cls = self.fleet_patcher.start()
+        mock_index_cls.return_value.check.return_value = {}
+        self.sites_patcher = mock.patch('vassal_deployer.deploy.SiteRegistry')
+        self.sites_patcher.start()
 
     def tearDown(self):
         """clean up tempdir and stop patchers"""
+        mock.patch.stopall()
         if os.path.exists(self.dir):
             os.system('rm -rf {}'.format(self.dir))
 
 
     def test_list_vassals_configs(self):
         """test listing vassal configs"""
-        confs = list_vassals_configs(self.dir)
+        confs = list(list_vassals_configs(self.dir))
         self.assertEqual(len(confs), 3)
         for c in confs:
             self.failUnless(c.endswith('.ini'))
 
+    def test_list_vassals_configs_recursive(self):
+        """test recursive discovery with patterns and several directories"""
+        other = os.path.join(self.dir, 'other')
+        for sub in ('a', 'b', 'skip'):
+            os.makedirs(os.path.join(self.dir, sub))
+            for name in ('app.ini', 'notes.txt'):
+                with open(os.path.join(self.dir, sub, sub + name), 'w') as handle:
+                    handle.write('womp')
+        os.makedirs(other)
+        with open(os.path.join(other, 'zz.ini'), 'w') as handle:
+            handle.write('womp')
+
+        confs = list_vassals_configs(self.dir)
+        self.failIf(isinstance(confs, list))
+        self.assertEqual(len(list(confs)), 3)
+
+        confs = list(list_vassals_configs(
+            [self.dir, other], recursive=True, exclude=['skip', 'vassal2.ini']
+        ))
+        rel = [os.path.relpath(c, self.dir) for c in confs]
+        self.assertEqual(rel, [
+            'vassal1.ini', 'vassal3.ini',
+            os.path.join('a', 'aapp.ini'),
+            os.path.join('b', 'bapp.ini'),
+            os.path.join('other', 'zz.ini'),
+            os.path.join('other', 'zz.ini'),
+        ])
+
+        confs = list(list_vassals_configs(
+            self.dir, recursive=True, include=['*.txt', 'vassal1.ini']
+        ))
+        rel = [os.path.relpath(c, self.dir) for c in confs]
+        self.assertEqual(rel, [
+            'vassal1.ini',
+            os.path.join('a', 'anotes.txt'),
+            os.path.join('b', 'bnotes.txt'),
+            os.path.join('skip', 'skipnotes.txt'),
+        ])
+
+        vassals = list(make_vassals([self.dir, other], recursive=True))
+        names = [v.basename for v in vassals]
+        self.assertEqual(len(names), len(set(names)))
+        self.assertEqual(len(names), 7)
+
     def test_make_vassals(self):
         """test make_vassals instances"""
-        vassals = make_vassals(self.dir)
+        vassals = list(make_vassals(self.dir))
         self.assertEqual(len(vassals), 3)
 
     @mock.patch('vassal_deployer.deploy.VassalConfig')
-    @mock.patch('vassal_deployer.deploy.NginxSite')
+    @mock.patch('vassal_deployer.nginx_config.NginxSite')
     def test_deploy(self, mock_site_cls, mock_vassal_cls):
         """test deploy function"""
         mock_site = mock.Mock()
@@ -71,6 +123,369 @@ class DeployTests(unittest.TestCase):
         self.failUnless(mock_site.write_available.called)
         self.failUnless(mock_site.link_enabled.called)
 
+    @mock.patch('vassal_deployer.deploy.VassalConfig')
+    @mock.patch('vassal_deployer.nginx_config.NginxSite')
+    def test_deploy_jobs(self, mock_site_cls, mock_vassal_cls):
+        """test deploy with a worker pool keeps template order"""
+        mock_site = mock.Mock()
+        mock_site_cls.return_value = mock_site
+        mock_vassal_cls.side_effect = lambda f: mock.Mock(config_file=f)
+
+        deploy(self.dir, self.dir, 'site-name', 8080, jobs=3)
+        added = [
+            c[0][0].config_file for c in mock_site.add_vassal.call_args_list
+        ]
+        self.assertEqual(added, list(list_vassals_configs(self.dir)))
+        self.failUnless(mock_site.write_available.called)
+
+    @mock.patch('vassal_deployer.deploy.VassalConfig')
+    @mock.patch('vassal_deployer.nginx_config.NginxSite')
+    def test_deploy_failures(self, mock_site_cls, mock_vassal_cls):
+        """test failing vassals are collected and left out of the site"""
+        mock_site = mock.Mock()
+        mock_site_cls.return_value = mock_site
+
+        def make_vassal(f):
+            vassal = mock.Mock(config_file=f)
+            if f.endswith('vassal2.ini'):
+                vassal.pip_install.side_effect = RuntimeError('pip broke')
+            return vassal
+        mock_vassal_cls.side_effect = make_vassal
+
+        with self.assertRaises(DeployError) as ctx:
+            deploy(self.dir, self.dir, 'site-name', 8080, jobs=2)
+        failures = ctx.exception.failures
+        self.assertEqual(len(failures), 1)
+        failed = os.path.join(self.dir, 'vassal2.ini')
+        self.failUnless(isinstance(failures[failed], RuntimeError))
+        self.assertEqual(mock_site.add_vassal.call_count, 2)
+        self.failUnless(mock_site.write_available.called)
+        self.failUnless(mock_site.link_enabled.called)
+
+    def test_provision_vassal_cache(self):
+        """test cache hits skip virtualenv and pip"""
+        vassal = mock.Mock()
+        cache = mock.Mock()
+        cache.restore = mock.Mock(return_value=True)
+        self.assertEqual(provision_vassal(vassal, self.dir, cache), None)
+        self.failIf(vassal.make_virtualenv.called)
+        self.failIf(vassal.pip_install.called)
+        self.failIf(cache.store.called)
+        self.failUnless(vassal.write.called)
+
+        cache.restore = mock.Mock(return_value=False)
+        self.assertEqual(provision_vassal(vassal, self.dir, cache), None)
+        self.failUnless(vassal.make_virtualenv.called)
+        kwargs = vassal.pip_install.call_args[1]
+        self.assertEqual(kwargs['mode'], 'each')
+        self.assertEqual(kwargs['pip_options'], None)
+        cache.store.assert_has_calls([mock.call(vassal)])
+
+    def test_provision_vassal_wheelhouse(self):
+        """test requirements are installed from the wheelhouse"""
+        vassal = mock.Mock()
+        wheelhouse = mock.Mock()
+        wheelhouse.install_options = mock.Mock(
+            return_value=['--no-index', '--find-links', 'WHEELS']
+        )
+        self.assertEqual(
+            provision_vassal(vassal, self.dir, wheelhouse=wheelhouse), None
+        )
+        self.assertEqual(
+            vassal.pip_install.call_args[1]['pip_options'],
+            ['--no-index', '--find-links', 'WHEELS']
+        )
+
+    @mock.patch('vassal_deployer.deploy.Wheelhouse')
+    @mock.patch('vassal_deployer.deploy.VassalConfig')
+    @mock.patch('vassal_deployer.nginx_config.NginxSite')
+    def test_deploy_wheelhouse(self, mock_site_cls, mock_vassal_cls, mock_wh_cls):
+        """test deploy prefetches wheels for the loaded vassals"""
+        mock_vassal_cls.side_effect = lambda f: mock.Mock(config_file=f)
+        mock_wh = mock.Mock()
+        mock_wh_cls.return_value = mock_wh
+
+        deploy(
+            self.dir, self.dir, 'site-name', 8080,
+            wheelhouse='WHEELS', offline=True
+        )
+        mock_wh_cls.assert_has_calls([mock.call('WHEELS', offline=True)])
+        prefetched = mock_wh.prefetch.call_args[0][0]
+        self.assertEqual(len(prefetched), 3)
+        for vassal in prefetched:
+            self.failUnless(vassal.load.called)
+
+    @mock.patch('vassal_deployer.deploy.VassalConfig')
+    @mock.patch('vassal_deployer.nginx_config.NginxSite')
+    def test_deploy_load_failure(self, mock_site_cls, mock_vassal_cls):
+        """test vassals that fail to load are reported"""
+        def make_vassal(f):
+            vassal = mock.Mock(config_file=f)
+            if f.endswith('vassal1.ini'):
+                vassal.load.side_effect = ValueError('bad ini')
+            return vassal
+        mock_vassal_cls.side_effect = make_vassal
+
+        with self.assertRaises(DeployError) as ctx:
+            deploy(self.dir, self.dir, 'site-name', 8080)
+        self.assertEqual(
+            list(ctx.exception.failures),
+            [os.path.join(self.dir, 'vassal1.ini')]
+        )
+        self.assertEqual(mock_site_cls.return_value.add_vassal.call_count, 2)
+
+    @mock.patch('vassal_deployer.deploy.VassalConfig')
+    @mock.patch('vassal_deployer.nginx_config.NginxSite')
+    def test_deploy_only(self, mock_site_cls, mock_vassal_cls):
+        """test only the given templates are provisioned"""
+        vassals = {}
+
+        def make_vassal(f):
+            vassals[f] = mock.Mock(config_file=f)
+            return vassals[f]
+        mock_vassal_cls.side_effect = make_vassal
+        only = os.path.join(self.dir, 'vassal2.ini')
+
+        deploy(self.dir, self.dir, 'site-name', 8080, only=set([only]))
+        for f, vassal in vassals.items():
+            self.failUnless(vassal.load.called)
+            self.assertEqual(vassal.make_virtualenv.called, f == only)
+        self.assertEqual(mock_site_cls.return_value.add_vassal.call_count, 3)
+
+    @mock.patch('vassal_deployer.sizing.WorkerSizing')
+    @mock.patch('vassal_deployer.deploy.VassalConfig')
+    @mock.patch('vassal_deployer.nginx_config.NginxSite')
+    def test_deploy_only_auto_size(self, mock_site_cls, mock_vassal_cls, mock_sizing_cls):
+        """test auto sizing rewrites the vassals that aren't provisioned"""
+        vassals = {}
+
+        def make_vassal(f):
+            vassals[f] = mock.Mock(config_file=f, basename=os.path.basename(f))
+            return vassals[f]
+        mock_vassal_cls.side_effect = make_vassal
+        mock_sizing = mock_sizing_cls.return_value
+        mock_sizing.settings_for.side_effect = lambda v: {'workers': 2}
+        only = os.path.join(self.dir, 'vassal2.ini')
+        deploy(self.dir, self.dir, 'site-name', 8080, only=set([only]), auto_size=True)
+        self.assertEqual(len(mock_sizing.plan.call_args[0][0]), 3)
+        for f, vassal in vassals.items():
+            self.assertEqual(vassal.make_virtualenv.called, f == only)
+            vassal.write.assert_called_once_with(self.dir, workers=2)
+
+        for vassal in vassals.values():
+            vassal.write.reset_mock()
+        deploy(self.dir, self.dir, 'site-name', 8080, only=set([only]))
+        for f, vassal in vassals.items():
+            self.assertEqual(vassal.write.called, f == only)
+
+    @mock.patch('vassal_deployer.deploy.VenvCache')
+    @mock.patch('vassal_deployer.deploy.VassalConfig')
+    @mock.patch('vassal_deployer.nginx_config.NginxSite')
+    def test_deploy_venv_cache(self, mock_site_cls, mock_vassal_cls, mock_cache_cls):
+        """test the venv cache options are passed to the cache"""
+        mock_vassal_cls.side_effect = lambda f: mock.Mock(config_file=f)
+        cache_dir = os.path.join(self.dir, 'cache')
+        deploy(
+            self.dir, self.dir, 'site-name', 8080, venv_cache=cache_dir,
+            venv_cache_size=1024, venv_cache_hardlink=True
+        )
+        mock_cache_cls.assert_called_once_with(
+            cache_dir, max_size=1024, hardlink=True
+        )
+
+    @mock.patch('vassal_deployer.state.StateStore')
+    @mock.patch('vassal_deployer.deploy.VassalConfig')
+    @mock.patch('vassal_deployer.nginx_config.NginxSite')
+    def test_deploy_state(self, mock_site_cls, mock_vassal_cls, mock_store_cls):
+        """test the run is recorded in the state dir"""
+        def make_vassal(f):
+            vassal = mock.Mock(config_file=f)
+            if f.endswith('vassal2.ini'):
+                vassal.make_virtualenv.side_effect = RuntimeError('broken')
+            return vassal
+        mock_vassal_cls.side_effect = make_vassal
+        state_dir = os.path.join(self.dir, 'state')
+        self.assertRaises(
+            DeployError, deploy, self.dir, self.dir, 'site-name', 8080,
+            state_dir=state_dir
+        )
+        mock_store_cls.assert_called_once_with(state_dir)
+        vassals, failures, timings = mock_store_cls.return_value.record_run.call_args[0]
+        self.assertEqual(len(vassals), 3)
+        self.assertEqual(list(failures), [os.path.join(self.dir, 'vassal2.ini')])
+        self.failUnless(timings.records)
+
+    @mock.patch('vassal_deployer.deploy.run_reload')
+    @mock.patch('vassal_deployer.deploy.VassalConfig')
+    @mock.patch('vassal_deployer.nginx_config.NginxSite')
+    def test_deploy_reload(self, mock_site_cls, mock_vassal_cls, mock_reload):
+        """test the reload command runs once after the site is written"""
+        mock_site = mock.Mock()
+        mock_site_cls.return_value = mock_site
+        mock_site.link_enabled.side_effect = lambda: self.failIf(mock_reload.called)
+        deploy(
+            self.dir, self.dir, 'site-name', 8080,
+            reload_command='nginx -s reload'
+        )
+        mock_reload.assert_called_once_with('nginx -s reload')
+
+    @mock.patch('vassal_deployer.deploy.VassalConfig')
+    @mock.patch('vassal_deployer.nginx_config.NginxSite')
+    def test_deploy_timings(self, mock_site_cls, mock_vassal_cls):
+        """test the timings report is written"""
+        mock_vassal_cls.side_effect = lambda f: mock.Mock(
+            config_file=f, basename=os.path.basename(f),
+            nginx_site=None, nginx_port=None, server_name=None
+        )
+        mock_site_cls.side_effect = lambda name, *args, **kwargs: mock.Mock(
+            site_name=name
+        )
+        report = os.path.join(self.dir, 'timings.json')
+        deploy(self.dir, self.dir, 'site-name', 8080, timings_out=report)
+        with open(report) as handle:
+            data = json.load(handle, object_pairs_hook=OrderedDict)
+        self.assertEqual(
+            list(data['vassals']),
+            ['vassal1.ini', 'vassal2.ini', 'vassal3.ini', 'site-name']
+        )
+        phases = [p['phase'] for p in data['vassals']['vassal1.ini']['phases']]
+        self.assertEqual(phases, ['load', 'make_virtualenv', 'write'])
+        phases = [p['phase'] for p in data['vassals']['site-name']['phases']]
+        self.assertEqual(phases, ['nginx_write', 'nginx_link'])
+
+    @mock.patch('vassal_deployer.deploy.VassalConfig')
+    def test_deploy_sites(self, mock_vassal_cls):
+        """test vassals are grouped into nginx sites and retired sites removed"""
+        self.sites_patcher.stop()
+        settings = {
+            'vassal1.ini': dict(nginx_site=None, nginx_port=None, server_name=None),
+            'vassal2.ini': dict(nginx_site='hot', nginx_port=8081, server_name='hot.example.com'),
+            'vassal3.ini': dict(nginx_site=None, nginx_port=8082, server_name=None),
+        }
+
+        def make_vassal(f):
+            name = os.path.basename(f)
+            return mock.Mock(
+                config_file=f,
+                basename=name,
+                upstream_name=name.split('.')[0],
+                nginx_upstream=mock.Mock(return_value='UPSTREAM {}\n'.format(name)),
+                nginx_config=mock.Mock(return_value='LOCATION {}\n'.format(name)),
+                cache_zone=None,
+                **settings[name]
+            )
+        mock_vassal_cls.side_effect = make_vassal
+        available = os.path.join(self.dir, 'available')
+        enabled = os.path.join(self.dir, 'enabled')
+        os.makedirs(available)
+        os.makedirs(enabled)
+        deploy(self.dir, self.dir, 'site-name', 8080, available, enabled)
+
+        self.assertEqual(sorted(os.listdir(enabled)), [
+            'hot.conf', 'site-name.conf', 'site-name_8082.conf'
+        ])
+        with open(os.path.join(available, 'hot.conf')) as handle:
+            content = handle.read()
+        self.failUnless('listen 8081;' in content)
+        self.failUnless('server_name hot.example.com;' in content)
+        self.failUnless('LOCATION vassal2.ini' in content)
+        self.failIf('vassal1.ini' in content)
+        with open(os.path.join(available, 'site-name_8082.conf')) as handle:
+            content = handle.read()
+        self.failUnless('listen 8082;' in content)
+        self.failUnless('server_name site-name;' in content)
+        self.failUnless('LOCATION vassal3.ini' in content)
+
+        settings['vassal2.ini'] = dict(nginx_site=None, nginx_port=None, server_name=None)
+        deploy(self.dir, self.dir, 'site-name', 8080, available, enabled)
+        self.assertEqual(sorted(os.listdir(enabled)), [
+            'site-name.conf', 'site-name_8082.conf'
+        ])
+        self.assertEqual(sorted(os.listdir(available)), [
+            'site-name.conf', 'site-name_8082.conf'
+        ])
+        with open(os.path.join(available, 'site-name.conf')) as handle:
+            self.failUnless('LOCATION vassal2.ini' in handle.read())
+
+    def test_provision_vassal_sizing(self):
+        """test the sized workers are rendered, even for unchanged vassals"""
+        vassal = mock.Mock()
+        sizing = mock.Mock()
+        sizing.settings_for = mock.Mock(return_value={'workers': 4})
+        self.assertEqual(provision_vassal(vassal, self.dir, sizing=sizing), None)
+        vassal.write.assert_called_once_with(self.dir, workers=4)
+
+        vassal = mock.Mock()
+        manifest = mock.Mock()
+        manifest.is_current = mock.Mock(return_value=True)
+        provision_vassal(vassal, self.dir, manifest=manifest, sizing=sizing)
+        self.failIf(vassal.write.called)
+        provision_vassal(
+            vassal, self.dir, manifest=manifest, sizing=sizing,
+            rewrite_unchanged=True
+        )
+        self.failIf(vassal.make_virtualenv.called)
+        vassal.write.assert_called_once_with(self.dir, workers=4)
+
+    @mock.patch('vassal_deployer.deploy.VassalConfig')
+    @mock.patch('vassal_deployer.nginx_config.NginxSite')
+    def test_deploy_conflicts(self, mock_site_cls, mock_vassal_cls):
+        """test vassals sharing a socket are not deployed"""
+        self.fleet_patcher.stop()
+        sockets = {'vassal1.ini': 3031, 'vassal2.ini': 3032, 'vassal3.ini': 3031}
+        vassals = {}
+
+        def make_vassal(f):
+            name = os.path.basename(f)
+            vassals[name] = mock.Mock(
+                config_file=f, basename=name, is_unix_socket=False,
+                uwsgi_socket='127.0.0.1:{}'.format(sockets[name]),
+                uwsgi_port=sockets[name], app_url='/' + name,
+                nginx_site=None, nginx_port=None, server_name=None
+            )
+            vassals[name].assign_port.side_effect = lambda port: setattr(
+                vassals[name], 'uwsgi_port', port
+            )
+            return vassals[name]
+        mock_vassal_cls.side_effect = make_vassal
+        with self.assertRaises(DeployError) as ctx:
+            deploy(self.dir, self.dir, 'site-name', 8080)
+        self.assertEqual(
+            list(ctx.exception.failures), [os.path.join(self.dir, 'vassal3.ini')]
+        )
+        self.failUnless(vassals['vassal2.ini'].write.called)
+        self.failIf(vassals['vassal3.ini'].write.called)
+        self.failIf(vassals['vassal3.ini'].make_virtualenv.called)
+
+        vassals.clear()
+        vassals_dir = os.path.join(self.dir, 'vassals')
+        deploy(self.dir, vassals_dir, 'site-name', 8080, port_range=(4000, 4010))
+        for name, port in (('vassal1.ini', 4000), ('vassal2.ini', 4001), ('vassal3.ini', 4002)):
+            vassals[name].assign_port.assert_called_once_with(port)
+        self.failUnless(
+            os.path.exists(vassals_dir + '.ports')
+        )
+
+    def test_assign_sockets(self):
+        """test the socket dir is created and sockets assigned"""
+        socket_dir = os.path.join(self.dir, 'run', 'uwsgi')
+        vassals = [mock.Mock(), mock.Mock()]
+        assign_sockets(vassals, socket_dir, '660')
+        self.failUnless(os.path.isdir(socket_dir))
+        for vassal in vassals:
+            vassal.assign_socket.assert_called_once_with(socket_dir, '660', None)
+
+    def test_provision_vassal_layers(self):
+        """test only the delta over the base layer is installed"""
+        vassal = mock.Mock()
+        layers = mock.Mock()
+        layers.link = mock.Mock(return_value=['app_pkg'])
+        self.assertEqual(provision_vassal(vassal, self.dir, layers=layers), None)
+        layers.link.assert_called_once_with(vassal)
+        self.assertEqual(
+            vassal.pip_install.call_args[1]['requirements'], ['app_pkg']
+        )
+
 
 if __name__ == '__main__':
     unittest.main()
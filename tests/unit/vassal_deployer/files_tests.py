@@ -0,0 +1,123 @@
+#!/usr/bin/env python
+"""
+files module tests
+"""
+import os
+import mock
+import errno
+import tempfile
+import unittest
+
+from vassal_deployer.files import atomic_write, atomic_symlink, makedirs, run_reload
+
+
+class FilesTests(unittest.TestCase):
+    """tests for atomic file helpers"""
+    def setUp(self):
+        """set up temp dir"""
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        """clean up tempdir"""
+        if os.path.exists(self.dir):
+            os.system('rm -rf {}'.format(self.dir))
+
+    def test_atomic_write(self):
+        """test writing and replacing a file"""
+        path = os.path.join(self.dir, 'site.conf')
+        atomic_write(path, 'one')
+        self.assertEqual(os.stat(path).st_mode & 0o777, 0o644)
+        os.chmod(path, 0o640)
+        atomic_write(path, 'two')
+        with open(path) as handle:
+            self.assertEqual(handle.read(), 'two')
+        self.assertEqual(os.stat(path).st_mode & 0o777, 0o640)
+        self.assertEqual(os.listdir(self.dir), ['site.conf'])
+
+    def test_atomic_write_stream(self):
+        """test streaming chunks and skipping unchanged content"""
+        path = os.path.join(self.dir, 'site.conf')
+        self.failUnless(atomic_write(path, (c for c in ['one', 'two'])))
+        mtime = os.stat(path).st_mtime
+        self.failIf(atomic_write(path, ['one', 'two'], only_changed=True))
+        self.assertEqual(os.stat(path).st_mtime, mtime)
+        self.assertEqual(os.listdir(self.dir), ['site.conf'])
+        self.failUnless(atomic_write(path, ['one'], only_changed=True))
+        with open(path) as handle:
+            self.assertEqual(handle.read(), 'one')
+
+    def test_atomic_write_compare(self):
+        """test unchanged content is compared without a temp file"""
+        path = os.path.join(self.dir, 'site.conf')
+        atomic_write(path, 'onetwo')
+        with mock.patch('tempfile.mkstemp') as mock_mkstemp:
+            self.failIf(atomic_write(path, iter(['one', 'two']), only_changed=True))
+            self.failIf(atomic_write(path, 'onetwo', only_changed=True))
+        self.failIf(mock_mkstemp.called)
+
+        self.failUnless(
+            atomic_write(path, (c for c in ['one', 'TWO', 'three']), only_changed=True)
+        )
+        with open(path) as handle:
+            self.assertEqual(handle.read(), 'oneTWOthree')
+        self.failUnless(atomic_write(path, ['one', 'TWO'], only_changed=True))
+        with open(path) as handle:
+            self.assertEqual(handle.read(), 'oneTWO')
+        self.failUnless(atomic_write(path, b'\xff', only_changed=True))
+        self.failUnless(atomic_write(path, 'one', only_changed=True))
+        with open(path) as handle:
+            self.assertEqual(handle.read(), 'one')
+        self.assertEqual(os.listdir(self.dir), ['site.conf'])
+
+    def test_atomic_write_failure(self):
+        """test a failed write leaves the original file alone"""
+        path = os.path.join(self.dir, 'site.conf')
+        atomic_write(path, 'one')
+        with mock.patch('vassal_deployer.files.replace', side_effect=OSError('womp')):
+            self.assertRaises(OSError, atomic_write, path, 'two')
+        with open(path) as handle:
+            self.assertEqual(handle.read(), 'one')
+        self.assertEqual(os.listdir(self.dir), ['site.conf'])
+
+    def test_makedirs(self):
+        """test creating dirs that exist or are created concurrently"""
+        path = os.path.join(self.dir, 'a', 'b')
+        makedirs(path)
+        makedirs(path)
+        self.failUnless(os.path.isdir(path))
+
+        other = os.path.join(self.dir, 'other')
+
+        def race(p):
+            os.mkdir(p)
+            raise OSError(errno.EEXIST, 'File exists', p)
+        with mock.patch('os.makedirs', side_effect=race):
+            makedirs(other)
+        self.failUnless(os.path.isdir(other))
+
+        conf = os.path.join(self.dir, 'site.conf')
+        atomic_write(conf, 'one')
+        self.assertRaises(OSError, makedirs, conf)
+
+    def test_atomic_symlink(self):
+        """test replacing files and links with a symlink"""
+        target = os.path.join(self.dir, 'target.conf')
+        other = os.path.join(self.dir, 'other.conf')
+        link = os.path.join(self.dir, 'link.conf')
+        with open(link, 'w') as handle:
+            handle.write('not a link')
+        atomic_symlink(target, link)
+        self.assertEqual(os.readlink(link), target)
+        atomic_symlink(other, link)
+        self.assertEqual(os.readlink(link), other)
+        self.assertEqual(sorted(os.listdir(self.dir)), ['link.conf'])
+
+    @mock.patch('subprocess.check_call')
+    def test_run_reload(self, mock_call):
+        """test running the reload command"""
+        run_reload('nginx -s reload')
+        mock_call.assert_called_once_with(['nginx', '-s', 'reload'])
+
+
+if __name__ == '__main__':
+    unittest.main()
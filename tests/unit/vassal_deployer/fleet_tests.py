@@ -0,0 +1,187 @@
+#!/usr/bin/env python
+"""
+fleet module tests
+
+"""
+import os
+import json
+import mock
+import tempfile
+import unittest
+
+from vassal_deployer.fleet import (
+    FleetIndex, FleetConflict, PortAllocator, parse_port_range,
+    parent_prefixes
+)
+from vassal_deployer.nginx_config import group_sites
+
+
+def make_vassal(name, socket, app_url, site=None):
+    """mock vassal with the settings the fleet checks use"""
+    unix = socket.startswith('/')
+    vassal = mock.Mock(
+        config_file='/templates/{}.ini'.format(name),
+        basename='{}.ini'.format(name),
+        uwsgi_socket=socket,
+        is_unix_socket=unix,
+        uwsgi_port=None if unix else int(socket.split(':')[1]),
+        app_url=app_url,
+        nginx_site=site,
+        nginx_port=None,
+        server_name=None
+    )
+
+    def assign_port(port):
+        vassal.uwsgi_socket = '127.0.0.1:{}'.format(port)
+        vassal.uwsgi_port = port
+    vassal.assign_port.side_effect = assign_port
+    return vassal
+
+
+class FleetIndexTests(unittest.TestCase):
+    """tests for FleetIndex"""
+
+    def test_parent_prefixes(self):
+        """test the prefixes a prefix is nested in"""
+        self.assertEqual(parent_prefixes('/a/b/c'), ['/a/b', '/a', '/'])
+        self.assertEqual(parent_prefixes('/a'), ['/'])
+        self.assertEqual(parent_prefixes('/'), [])
+
+    def test_socket_conflicts(self):
+        """test vassals binding the same socket conflict"""
+        vassals = [
+            make_vassal('app1', '127.0.0.1:3031', '/app1'),
+            make_vassal('app2', '0.0.0.0:3031', '/app2'),
+            make_vassal('app3', '/run/uwsgi/app.sock', '/app3'),
+            make_vassal('app4', '/run/uwsgi/../uwsgi/app.sock', '/app4'),
+            make_vassal('app5', '127.0.0.1:3032', '/app5'),
+        ]
+        failures = FleetIndex('site', 8080).check(vassals)
+        self.assertEqual(
+            sorted(failures), ['/templates/app2.ini', '/templates/app4.ini']
+        )
+        self.failUnless(isinstance(failures['/templates/app2.ini'], FleetConflict))
+        self.failUnless('app1.ini' in str(failures['/templates/app2.ini']))
+
+    def test_missing_settings(self):
+        """test vassals without a socket or app_url fail on their own"""
+        no_url = make_vassal('app2', '127.0.0.1:3032', None)
+        no_socket = make_vassal('app3', '127.0.0.1:3033', '/app3')
+        type(no_socket).uwsgi_port = mock.PropertyMock(side_effect=KeyError('socket'))
+        bad_port = make_vassal('app4', '127.0.0.1:3034', '/app4')
+        type(bad_port).uwsgi_port = mock.PropertyMock(side_effect=ValueError('womp'))
+        failures = FleetIndex('site', 8080).check([
+            make_vassal('app1', '127.0.0.1:3031', '/app1'),
+            no_url, no_socket, bad_port,
+            make_vassal('app5', '127.0.0.1:3035', '/app5'),
+        ])
+        self.assertEqual(sorted(failures), [
+            '/templates/app2.ini', '/templates/app3.ini', '/templates/app4.ini'
+        ])
+        self.failUnless('no app_url' in str(failures['/templates/app2.ini']))
+        self.failUnless('no valid uwsgi socket' in str(failures['/templates/app3.ini']))
+
+    def test_site_conflicts(self):
+        """test prefixes conflict within the sites group_sites builds"""
+        vassals = [
+            make_vassal('app1', '127.0.0.1:3031', '/api'),
+            make_vassal('app2', '127.0.0.1:3032', '/api', site='site'),
+            make_vassal('app3', '127.0.0.1:3033', '/x', site='hot'),
+            make_vassal('app4', '127.0.0.1:3034', '/x', site='hot'),
+            make_vassal('app5', '127.0.0.1:3035', '/api', site='hot'),
+        ]
+        vassals[2].nginx_port = 8081
+        vassals[3].nginx_port = 8082
+        failures = FleetIndex('site', 8080).check(vassals)
+        self.assertEqual(
+            sorted(failures), ['/templates/app2.ini', '/templates/app4.ini']
+        )
+
+        sites = group_sites(
+            [v for v in vassals if v.config_file not in failures], 'site', 8080
+        )
+        for site in sites:
+            urls = [v.app_url for v in site._vassals]
+            self.assertEqual(len(urls), len(set(urls)))
+
+    @mock.patch('vassal_deployer.fleet.logger')
+    def test_prefix_conflicts(self, mock_logger):
+        """test duplicate prefixes conflict and nested ones warn"""
+        vassals = [
+            make_vassal('app1', '127.0.0.1:3031', '/api/v2/'),
+            make_vassal('app2', '127.0.0.1:3032', '/api'),
+            make_vassal('app3', '127.0.0.1:3033', '/api/'),
+            make_vassal('app4', '127.0.0.1:3034', '/api', site='other'),
+            make_vassal('app5', '127.0.0.1:3035', '/api/v2/admin'),
+        ]
+        failures = FleetIndex('site', 8080).check(vassals)
+        self.assertEqual(list(failures), ['/templates/app3.ini'])
+        warnings = [c[0][0] for c in mock_logger.warning.call_args_list]
+        self.assertEqual(len(warnings), 2)
+        self.failUnless('app1.ini is nested in app_url /api of /templates/app2.ini' in warnings[0])
+        self.failUnless('app5.ini is nested in app_url /api/v2/ of /templates/app1.ini' in warnings[1])
+
+
+class PortAllocatorTests(unittest.TestCase):
+    """tests for PortAllocator"""
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.vassals_dir = os.path.join(self.dir, 'vassals')
+        os.makedirs(self.vassals_dir)
+
+    def tearDown(self):
+        """clean up tempdir"""
+        if os.path.exists(self.dir):
+            os.system('rm -rf {}'.format(self.dir))
+
+    def allocate(self, vassals, port_range=(4000, 4002)):
+        ports = PortAllocator(self.vassals_dir, port_range)
+        ports.load()
+        failures = ports.allocate(vassals)
+        ports.save()
+        return failures
+
+    def test_parse_port_range(self):
+        """test parsing port ranges"""
+        self.assertEqual(parse_port_range('4000-4999'), (4000, 4999))
+        self.assertEqual(parse_port_range('4000'), (4000, 4000))
+        self.assertRaises(ValueError, parse_port_range, '5000-4000')
+        self.assertRaises(ValueError, parse_port_range, '0-70000')
+
+    def test_allocate(self):
+        """test ports are allocated once and kept across runs"""
+        app1 = make_vassal('app1', '127.0.0.1:3031', '/app1')
+        app2 = make_vassal('app2', '127.0.0.1:3032', '/app2')
+        app3 = make_vassal('app3', '/run/uwsgi/app3.sock', '/app3')
+        self.assertEqual(self.allocate([app1, app2, app3]), {})
+        self.assertEqual((app1.uwsgi_port, app2.uwsgi_port), (4000, 4001))
+        self.failIf(app3.assign_port.called)
+        self.assertEqual(os.listdir(self.vassals_dir), [])
+        with open(self.vassals_dir + PortAllocator.SUFFIX) as handle:
+            self.assertEqual(
+                json.load(handle)['ports'], {'app1.ini': 4000, 'app2.ini': 4001}
+            )
+
+        app0 = make_vassal('app0', '127.0.0.1:3030', '/app0')
+        app2 = make_vassal('app2', '127.0.0.1:3032', '/app2')
+        self.assertEqual(self.allocate([app0, app2]), {})
+        self.assertEqual((app0.uwsgi_port, app2.uwsgi_port), (4000, 4001))
+
+        app1 = make_vassal('app1', '127.0.0.1:3031', '/app1')
+        app4 = make_vassal('app4', '127.0.0.1:3034', '/app4')
+        failures = self.allocate([app0, app1, app2, app4])
+        self.assertEqual(app1.uwsgi_port, 4002)
+        self.assertEqual(list(failures), ['/templates/app4.ini'])
+        self.failIf(app4.assign_port.called)
+
+    def test_allocate_range_changed(self):
+        """test ports outside a new range are reallocated"""
+        app1 = make_vassal('app1', '127.0.0.1:3031', '/app1')
+        app2 = make_vassal('app2', '127.0.0.1:3032', '/app2')
+        self.allocate([app1, app2])
+        self.allocate([app1, app2], (4001, 4010))
+        self.assertEqual((app1.uwsgi_port, app2.uwsgi_port), (4002, 4001))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,79 @@
+#!/usr/bin/env python
+"""
+import time tests
+
+run in a fresh interpreter so modules imported by other tests
+don't hide heavy imports creeping back into the CLI startup
+"""
+import os
+import sys
+import json
+import unittest
+import subprocess
+
+import vassal_deployer
+
+SRC_DIR = os.path.dirname(os.path.dirname(os.path.abspath(vassal_deployer.__file__)))
+
+HEAVY_MODULES = [
+    'virtualenvapi',
+    'multiprocessing',
+    'asyncio',
+    'logging.handlers',
+]
+
+# generous so the test isn't flaky on slow CI machines,
+# the startup is around 50ms
+IMPORT_BUDGET = 0.5
+
+SCRIPT = """
+import sys
+import time
+import json
+start = time.time()
+import vassal_deployer.__main__ as cli
+sys.argv = ['vassal_deployer', '-i', 'templates', '--vassals', 'vassals']
+opts = cli.build_parser()
+elapsed = time.time() - start
+import logging
+print(json.dumps({
+    'elapsed': elapsed,
+    'modules': sorted(sys.modules),
+    'handlers': len(logging.getLogger('vassal_deployer').handlers),
+}))
+"""
+
+
+class ImportTests(unittest.TestCase):
+    """tests for keeping the CLI startup cheap"""
+
+    def run_script(self):
+        env = dict(os.environ)
+        env['PYTHONPATH'] = os.pathsep.join(
+            [SRC_DIR] + [p for p in [env.get('PYTHONPATH')] if p]
+        )
+        # run from the src dir, so the vassal_deployer test package
+        # in the working dir of nosetests -w doesn't shadow the real one
+        output = subprocess.check_output(
+            [sys.executable, '-c', SCRIPT], env=env, cwd=SRC_DIR
+        )
+        return json.loads(output.decode('utf-8').strip().splitlines()[-1])
+
+    def test_no_heavy_imports(self):
+        """test parsing args doesn't import the provisioning dependencies"""
+        result = self.run_script()
+        for module in HEAVY_MODULES:
+            self.failIf(module in result['modules'], module)
+        self.assertEqual(result['handlers'], 0)
+
+    def test_import_budget(self):
+        """test the CLI imports within the time budget"""
+        result = self.run_script()
+        self.failUnless(
+            result['elapsed'] < IMPORT_BUDGET,
+            "import took {:.3f}s".format(result['elapsed'])
+        )
+
+
+if __name__ == '__main__':
+    unittest.main()
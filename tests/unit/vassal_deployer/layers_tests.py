@@ -0,0 +1,147 @@
+#!/usr/bin/env python
+"""
+layers module tests
+"""
+import os
+import sys
+import mock
+import tempfile
+import unittest
+
+from vassal_deployer.layers import (
+    plan_layers, LayerManager, PTH_FILE, site_packages
+)
+
+
+def make_vassal(name, reqs, python='python', venv=None):
+    """mock a loaded VassalConfig"""
+    return mock.Mock(
+        config_file=name,
+        app_python=python,
+        requirements_list=reqs,
+        pip_options=[],
+        uwsgi_virtualenv=venv
+    )
+
+
+class LayersTests(unittest.TestCase):
+    """tests for base layer planning, building and linking"""
+    def setUp(self):
+        """set up temp dir and patch virtualenv"""
+        self.dir = tempfile.mkdtemp()
+        self.layers_dir = os.path.join(self.dir, 'layers')
+        self.patch_venv = mock.patch('virtualenvapi.manage.VirtualEnvironment')
+        self.mock_venv = self.patch_venv.start()
+
+    def tearDown(self):
+        """clean up tempdir and stop patchers"""
+        self.patch_venv.stop()
+        if os.path.exists(self.dir):
+            os.system('rm -rf {}'.format(self.dir))
+
+    def test_site_packages(self):
+        """test the site-packages of built and unbuilt virtualenvs"""
+        venv = os.path.join(self.dir, 'venv')
+        self.assertEqual(
+            site_packages(venv, 'python3.7'),
+            os.path.join(venv, 'lib', 'python3.7', 'site-packages')
+        )
+        self.assertEqual(
+            site_packages(venv, sys.executable),
+            os.path.join(
+                venv, 'lib', 'python{}.{}'.format(*sys.version_info[:2]),
+                'site-packages'
+            )
+        )
+        built = os.path.join(venv, 'lib', 'python3.9', 'site-packages')
+        os.makedirs(built)
+        self.assertEqual(site_packages(venv, 'python3.7'), built)
+
+    def test_plan_layers(self):
+        """test finding shared requirement subsets"""
+        vassals = [
+            make_vassal('a', ['flask', 'requests', 'sqlalchemy', 'a_app']),
+            make_vassal('b', ['flask', 'requests', 'sqlalchemy', 'b_app']),
+            make_vassal('c', ['flask', 'requests', 'c_app']),
+            make_vassal('d', ['flask', 'requests', 'c_app']),
+            make_vassal('e', ['flask', 'requests', 'sqlalchemy'], python='python3'),
+            make_vassal('f', ['pytz']),
+        ]
+        plan = plan_layers(vassals, self.layers_dir)
+        self.assertEqual(
+            plan['a'].requirements_list, ['flask', 'requests', 'sqlalchemy']
+        )
+        self.failUnless(plan['a'] is plan['b'])
+        self.assertEqual(
+            plan['c'].requirements_list, ['c_app', 'flask', 'requests']
+        )
+        self.failUnless(plan['c'] is plan['d'])
+        self.failIf('e' in plan)
+        self.failIf('f' in plan)
+
+    def test_plan_layers_fallback(self):
+        """test vassals fall back to the largest layer they contain"""
+        vassals = [
+            make_vassal('a', ['flask', 'requests']),
+            make_vassal('b', ['flask', 'requests']),
+            make_vassal('c', ['flask', 'requests', 'arrow']),
+            make_vassal('d', ['arrow', 'pytz']),
+        ]
+        plan = plan_layers(vassals, self.layers_dir)
+        self.assertEqual(plan['a'].requirements_list, ['flask', 'requests'])
+        self.failUnless(plan['c'] is plan['a'])
+        self.failIf('d' in plan)
+
+    def test_build_and_link(self):
+        """test building a layer and linking it into a vassal venv"""
+        venv = os.path.join(self.dir, 'app', 'venv')
+        os.makedirs(os.path.join(venv, 'lib', 'python3.11', 'site-packages'))
+        vassals = [
+            make_vassal('a', ['flask', 'requests', 'a_app'], venv=venv),
+            make_vassal('b', ['flask', 'requests']),
+        ]
+        mock_env = mock.Mock()
+
+        def create():
+            os.makedirs(os.path.join(self.layers_dir, layer.key))
+        mock_env.open_or_create.side_effect = create
+        self.mock_venv.return_value = mock_env
+
+        manager = LayerManager(self.layers_dir)
+        manager.plan(vassals)
+        layer = manager.layer_for(vassals[0])
+        manager.build()
+        mock_env._execute_pip.assert_called_once_with(
+            ['install', 'flask', 'requests']
+        )
+        self.failUnless(layer.is_built)
+        manager.build()
+        self.assertEqual(mock_env._execute_pip.call_count, 1)
+
+        delta = manager.link(vassals[0])
+        self.assertEqual(delta, ['a_app'])
+        pth = os.path.join(venv, 'lib', 'python3.11', 'site-packages', PTH_FILE)
+        with open(pth) as handle:
+            self.failUnless(layer.site_packages in handle.read())
+
+        manager.assignments = {}
+        self.assertEqual(manager.link(vassals[0]), vassals[0].requirements_list)
+        self.failIf(os.path.exists(pth))
+
+    def test_build_failure(self):
+        """test vassals of failed layers install everything"""
+        mock_env = mock.Mock()
+        mock_env._execute_pip.side_effect = RuntimeError('womp')
+        self.mock_venv.return_value = mock_env
+        vassals = [
+            make_vassal('a', ['flask']),
+            make_vassal('b', ['flask']),
+        ]
+        manager = LayerManager(self.layers_dir)
+        manager.plan(vassals)
+        manager.build()
+        self.assertEqual(manager.assignments, {})
+
+
+if __name__ == '__main__':
+    unittest.main()
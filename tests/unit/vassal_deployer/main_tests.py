@@ -6,7 +6,7 @@ import sys
 import unittest
 import mock
 
-from vassal_deployer.__main__ import build_parser, main
+from vassal_deployer.__main__ import build_parser, main, megabytes
 
 
 class MainTests(unittest.TestCase):
@@ -20,8 +20,44 @@ class MainTests(unittest.TestCase):
                 '--input-vassals', 'IN'
                 ]):
             opts = build_parser()
-            self.assertEqual(opts.vassals_in, 'IN')
+            self.assertEqual(opts.vassals_in, ['IN'])
             self.assertEqual(opts.vassals_out, 'OUT')
+            self.assertEqual(opts.jobs, 1)
+
+    def test_parser_discovery(self):
+        with mock.patch.object(
+            sys, 'argv', [
+                'vassal_deployer',
+                '--vassals', 'OUT',
+                '-i', 'IN1', '-i', 'IN2', '-r',
+                '--include', 'app*.ini',
+                '--exclude', 'disabled'
+                ]):
+            opts = build_parser()
+            self.assertEqual(opts.vassals_in, ['IN1', 'IN2'])
+            self.failUnless(opts.recursive)
+            self.assertEqual(opts.include, ['app*.ini'])
+            self.assertEqual(opts.exclude, ['disabled'])
+
+    def test_parser_port_range(self):
+        with mock.patch.object(
+            sys, 'argv', [
+                'vassal_deployer', '--vassals', 'OUT', '-i', 'IN',
+                '--port-range', '4000-4999'
+                ]):
+            opts = build_parser()
+            self.assertEqual(opts.port_range, (4000, 4999))
+
+    def test_parser_jobs(self):
+        with mock.patch.object(
+            sys, 'argv', [
+                'vassal_deployer',
+                '--vassals', 'OUT',
+                '--input-vassals', 'IN',
+                '--jobs', '4'
+                ]):
+            opts = build_parser()
+            self.assertEqual(opts.jobs, 4)
 
     @mock.patch('vassal_deployer.__main__.deploy')
     def test_main(self, mock_dep):
@@ -36,15 +72,124 @@ class MainTests(unittest.TestCase):
             main()
             mock_dep.assert_has_calls([
                 mock.call(
-                    'IN',
+                    ['IN'],
                     'OUT',
                     'uwsgi_vassals',
                     8080,
                     '/etc/nginx/sites-available',
-                    '/etc/nginx/sites-enabled'
+                    '/etc/nginx/sites-enabled',
+                    jobs=1,
+                    venv_cache=None,
+                    venv_cache_size=None,
+                    venv_cache_hardlink=False,
+                    pip_mode='each',
+                    incremental=False,
+                    wheelhouse=None,
+                    offline=False,
+                    reload_command=None,
+                    timings_out=None,
+                    layers_dir=None,
+                    layer_min_vassals=2,
+                    backend='threads',
+                    host_limit=2,
+                    state_dir=None,
+                    recursive=False,
+                    include=None,
+                    exclude=None,
+                    parse_cache=None,
+                    nginx_includes=False,
+                    nginx_cache_dir=None,
+                    auto_size=False,
+                    socket_dir=None,
+                    socket_mode='660',
+                    socket_owner=None,
+                    port_range=None
                 )
             ])
 
+    @mock.patch('vassal_deployer.watch.WatchDeployer')
+    @mock.patch('vassal_deployer.__main__.deploy')
+    def test_main_watch(self, mock_dep, mock_watch_cls):
+        """test watch mode runs the watch deployer"""
+        with mock.patch.object(
+            sys, 'argv', [
+                'vassal_deployer',
+                '--vassals', 'OUT',
+                '--input-vassals', 'IN',
+                '--watch', '--debounce', '5'
+                ]):
+            main()
+        self.failIf(mock_dep.called)
+        args, kwargs = mock_watch_cls.call_args
+        self.assertEqual(args[:2], (['IN'], 'OUT'))
+        self.assertEqual(kwargs['debounce'], 5.0)
+        self.assertEqual(kwargs['interval'], 1.0)
+        self.failUnless(mock_watch_cls.return_value.run.called)
+
+    @mock.patch('vassal_deployer.plan.plan')
+    @mock.patch('vassal_deployer.__main__.deploy')
+    def test_main_plan(self, mock_dep, mock_plan):
+        """test plan mode prints the plan instead of deploying"""
+        mock_plan.return_value.report.return_value = 'nothing to do\n'
+        with mock.patch.object(
+            sys, 'argv', [
+                'vassal_deployer',
+                '--vassals', 'OUT',
+                '--input-vassals', 'IN',
+                '--plan'
+                ]):
+            with mock.patch.object(sys, 'stdout') as mock_stdout:
+                main()
+        self.failIf(mock_dep.called)
+        args, kwargs = mock_plan.call_args
+        self.assertEqual(args[:2], (['IN'], 'OUT'))
+        self.assertEqual(kwargs['incremental'], False)
+        self.assertEqual(kwargs['recursive'], False)
+        mock_stdout.write.assert_has_calls([mock.call('nothing to do\n')])
+
+    @mock.patch('vassal_deployer.venv_cache.VenvCache')
+    @mock.patch('vassal_deployer.__main__.deploy')
+    def test_main_cache(self, mock_dep, mock_cache_cls):
+        """test cache subcommand dispatch"""
+        mock_cache = mock.Mock()
+        mock_cache.prune = mock.Mock(return_value=['a', 'b'])
+        mock_cache_cls.return_value = mock_cache
+        with mock.patch.object(
+            sys, 'argv', [
+                'vassal_deployer', 'cache', 'prune',
+                '--venv-cache', 'CACHE',
+                '--max-size', '10'
+                ]):
+            main()
+        self.failIf(mock_dep.called)
+        mock_cache_cls.assert_has_calls([mock.call('CACHE')])
+        mock_cache.prune.assert_has_calls([mock.call(megabytes(10))])
+
+    @mock.patch('vassal_deployer.state.StateStore')
+    @mock.patch('vassal_deployer.__main__.deploy')
+    def test_main_status(self, mock_dep, mock_store_cls):
+        """test status subcommand dispatch"""
+        mock_store = mock_store_cls.return_value
+        mock_store.vassal_status.return_value = [{
+            'name': 'app.ini', 'host': 'node1', 'result': 'ok',
+            'duration': 2.0, 'average': 3.0, 'runs': 4,
+            'template_hash': 'abc', 'venv_fingerprint': None, 'drift': True
+        }]
+        mock_store.runs.return_value = []
+        with mock.patch.object(
+            sys, 'argv', [
+                'vassal_deployer', 'status', '--state-dir', 'STATE', '--runs', '5'
+                ]):
+            with mock.patch.object(sys, 'stdout') as mock_stdout:
+                main()
+        self.failIf(mock_dep.called)
+        mock_store_cls.assert_has_calls([mock.call('STATE')])
+        mock_store.vassal_status.assert_called_once_with(5)
+        output = ''.join(c[0][0] for c in mock_stdout.write.call_args_list)
+        self.failUnless('app.ini  node1  ok' in output)
+        self.failUnless('DRIFT' in output)
+        self.failUnless('1 vassals, 1 drifted, last run never' in output)
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,96 @@
+#!/usr/bin/env python
+"""
+manifest module tests
+"""
+import os
+import mock
+import tempfile
+import unittest
+
+from vassal_deployer.manifest import DeployManifest
+from vassal_deployer.deploy import provision_vassal
+
+
+class DeployManifestTests(unittest.TestCase):
+    """tests for DeployManifest class"""
+    def setUp(self):
+        """set up temp dir and a deployed vassal"""
+        self.dir = tempfile.mkdtemp()
+        self.venv = os.path.join(self.dir, 'app', 'venv')
+        os.makedirs(self.venv)
+        self.vassals_dir = os.path.join(self.dir, 'vassals')
+        os.makedirs(self.vassals_dir)
+        with open(os.path.join(self.vassals_dir, 'app.ini'), 'w') as handle:
+            handle.write('[uwsgi]\n')
+        self.vassal = mock.Mock(
+            basename='app.ini',
+            config_file='/templates/app.ini',
+            template_hash='abc',
+            uwsgi_virtualenv=self.venv
+        )
+
+    def tearDown(self):
+        """clean up tempdir"""
+        if os.path.exists(self.dir):
+            os.system('rm -rf {}'.format(self.dir))
+
+    def test_round_trip(self):
+        """test recording, saving and reloading the manifest"""
+        manifest = DeployManifest(self.vassals_dir)
+        manifest.load()
+        self.failIf(manifest.is_current(self.vassal))
+        manifest.record(self.vassal)
+        manifest.save()
+        self.assertEqual(manifest.path, self.vassals_dir + '.manifest')
+        self.assertEqual(os.listdir(self.vassals_dir), ['app.ini'])
+
+        manifest = DeployManifest(self.vassals_dir)
+        manifest.load()
+        self.failUnless(manifest.is_current(self.vassal))
+
+        self.vassal.template_hash = 'def'
+        self.failIf(manifest.is_current(self.vassal))
+        self.vassal.template_hash = 'abc'
+        os.rmdir(self.venv)
+        self.failIf(manifest.is_current(self.vassal))
+
+    def test_retain(self):
+        """test dropping vassals that are no longer deployed"""
+        manifest = DeployManifest(self.vassals_dir)
+        manifest.record(self.vassal)
+        manifest.retain([])
+        self.assertEqual(manifest.vassals, {})
+
+    def test_unreadable(self):
+        """test a corrupt manifest is ignored"""
+        manifest = DeployManifest(self.vassals_dir)
+        with open(manifest.path, 'w') as handle:
+            handle.write('{womp')
+        manifest.load()
+        self.assertEqual(manifest.vassals, {})
+
+    def test_provision_incremental(self):
+        """test unchanged vassals are skipped by provision_vassal"""
+        manifest = DeployManifest(self.vassals_dir)
+        provision_vassal(self.vassal, self.vassals_dir, manifest=manifest)
+        self.failUnless(self.vassal.make_virtualenv.called)
+        self.failUnless(manifest.is_current(self.vassal))
+
+        vassal = mock.Mock(
+            basename='app.ini',
+            template_hash='abc',
+            uwsgi_virtualenv=self.venv
+        )
+        provision_vassal(vassal, self.vassals_dir, manifest=manifest)
+        self.failIf(vassal.make_virtualenv.called)
+        self.failIf(vassal.pip_install.called)
+        self.failIf(vassal.write.called)
+
+        vassal.template_hash = 'def'
+        vassal.pip_install.side_effect = RuntimeError('pip broke')
+        provision_vassal(vassal, self.vassals_dir, manifest=manifest)
+        self.failIf('app.ini' in manifest.vassals)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -7,7 +7,7 @@ import mock
 import tempfile
 import unittest
 
-from vassal_deployer.nginx_config import NginxSite
+from vassal_deployer.nginx_config import NginxSite, SiteRegistry, group_sites
 
 
 class NginxSiteTests(unittest.TestCase):
@@ -31,19 +31,166 @@ class NginxSiteTests(unittest.TestCase):
         mock_vassal.nginx_config = mock.Mock(return_value="{VASSAL1}")
         conf = NginxSite("site", 8080, self.available, self.enabled)
         for i in range(1, 4):
-            mock_vassal = mock.Mock()
+            mock_vassal = mock.Mock(cache_zone=None)
             mock_vassal.nginx_config = mock.Mock(return_value="VASSAL{}".format(i))
+            mock_vassal.nginx_upstream = mock.Mock(return_value="UPSTREAM{}".format(i))
             conf.add_vassal(mock_vassal)
         conf_str = conf.configuration()
         self.failUnless('server_name site;' in conf_str)
         for i in range(1, 4):
             self.failUnless("VASSAL{}".format(i) in conf_str)
+            self.failUnless("UPSTREAM{}".format(i) in conf_str)
+        # upstreams go in the http context, before the server block
+        self.failUnless(conf_str.index("UPSTREAM3") < conf_str.index("server {"))
 
         conf.write_available()
         conf.link_enabled()
         self.failUnless('site.conf' in os.listdir(self.available))
         self.failUnless('site.conf' in os.listdir(self.enabled))
 
+    def make_vassal(self, name, port, cache_zone=None, **settings):
+        return mock.Mock(
+            upstream_name='vassal_{}'.format(name),
+            cache_zone=cache_zone,
+            nginx_cache_path=mock.Mock(return_value='CACHE {}\n'.format(cache_zone)),
+            nginx_upstream=mock.Mock(return_value='UPSTREAM {} {}\n'.format(name, port)),
+            nginx_config=mock.Mock(return_value='LOCATION {}\n'.format(name)),
+            **settings
+        )
+
+    def test_nginx_site_includes(self):
+        """test include mode only rewrites changed files"""
+        site_file = os.path.join(self.available, 'site.conf')
+        include_dir = os.path.join(self.available, 'site.d')
+        conf = NginxSite("site", 8080, self.available, self.enabled, includes=True)
+        for i in range(1, 4):
+            conf.add_vassal(self.make_vassal('app{}'.format(i), 3030 + i))
+        written = conf.write_available()
+        self.assertEqual(len(written), 7)
+        self.assertEqual(sorted(os.listdir(include_dir)), [
+            'vassal_app1.location.conf', 'vassal_app1.upstream.conf',
+            'vassal_app2.location.conf', 'vassal_app2.upstream.conf',
+            'vassal_app3.location.conf', 'vassal_app3.upstream.conf',
+        ])
+        with open(site_file) as handle:
+            content = handle.read()
+        self.failUnless(
+            content.startswith('include {};'.format(
+                os.path.join(include_dir, '*.upstream.conf')
+            ))
+        )
+        self.failUnless('    include {};\n'.format(
+            os.path.join(include_dir, '*.location.conf')
+        ) in content)
+        self.failIf('UPSTREAM' in content)
+        self.assertEqual(conf.write_available(), [])
+
+        conf = NginxSite("site", 8080, self.available, self.enabled, includes=True)
+        conf.add_vassal(self.make_vassal('app1', 3031))
+        conf.add_vassal(self.make_vassal('app2', 4000))
+        written = conf.write_available()
+        self.assertEqual(written, [
+            os.path.join(include_dir, 'vassal_app2.upstream.conf'),
+            os.path.join(include_dir, 'vassal_app3.location.conf'),
+            os.path.join(include_dir, 'vassal_app3.upstream.conf'),
+        ])
+        with open(os.path.join(include_dir, 'vassal_app2.upstream.conf')) as handle:
+            self.assertEqual(handle.read(), 'UPSTREAM app2 4000\n')
+
+    def test_write_unchanged(self):
+        """test the single file site isn't rewritten when unchanged"""
+        conf = NginxSite("site", 8080, self.available, self.enabled)
+        conf.add_vassal(self.make_vassal('app1', 3031))
+        self.assertEqual(
+            conf.write_available(), [os.path.join(self.available, 'site.conf')]
+        )
+        self.assertEqual(conf.write_available(), [])
+        with open(os.path.join(self.available, 'site.conf')) as handle:
+            self.assertEqual(handle.read(), conf.configuration())
+
+    def test_cache_zones(self):
+        """test each cache zone is defined once, ahead of the upstreams"""
+        conf = NginxSite("site", 8080, self.available, self.enabled)
+        conf.add_vassal(self.make_vassal('app1', 3031, 'api'))
+        conf.add_vassal(self.make_vassal('app2', 3032))
+        conf.add_vassal(self.make_vassal('app3', 3033, 'api'))
+        conf.add_vassal(self.make_vassal('app4', 3034, 'pages'))
+        self.failUnless(
+            conf.configuration().startswith('CACHE api\nCACHE pages\n\nUPSTREAM app1')
+        )
+        conf._vassals[0].nginx_cache_path.assert_called_once_with(
+            NginxSite.DEFAULT_CACHE_DIR
+        )
+        self.failIf(conf._vassals[2].nginx_cache_path.called)
+
+        conf.includes = True
+        conf.external_zones.add('pages')
+        self.failUnless(
+            conf.include_configuration().startswith('CACHE api\n\ninclude ')
+        )
+
+    def test_write_cache_dir(self):
+        """test the cache dir is created for the cache zones"""
+        cache_dir = os.path.join(self.dir, 'cache', 'nginx')
+        conf = NginxSite("site", 8080, self.available, self.enabled, cache_dir=cache_dir)
+        conf.add_vassal(self.make_vassal('app1', 3031))
+        self.failIf(conf.needs_cache_dir())
+        conf.write_available()
+        self.failIf(os.path.exists(cache_dir))
+
+        conf.add_vassal(self.make_vassal('app2', 3032, 'api'))
+        self.failUnless(conf.needs_cache_dir())
+        conf.write_available()
+        self.failUnless(os.path.isdir(cache_dir))
+        self.failIf(conf.needs_cache_dir())
+
+    def test_group_sites_cache_zones(self):
+        """test a cache zone shared by sites is defined by the first"""
+        site = dict(nginx_site=None, nginx_port=None, server_name=None)
+        other = dict(nginx_site='other', nginx_port=8081, server_name=None)
+        sites = group_sites([
+            self.make_vassal('app1', 3031, **site),
+            self.make_vassal('app2', 3032, 'api', **other),
+            self.make_vassal('app3', 3033, 'api', **site),
+            self.make_vassal('app4', 3034, 'pages', **site),
+        ], 'site', 8080, self.available, self.enabled, cache_dir='/cache')
+        self.assertEqual([s.site_name for s in sites], ['site', 'other'])
+        self.assertEqual(sites[0].external_zones, set(['api']))
+        self.assertEqual(sites[1].external_zones, set())
+        self.assertEqual(sites[0].cache_paths(), 'CACHE pages\n')
+        self.assertEqual(sites[1].cache_paths(), 'CACHE api\n')
+        self.assertEqual(sites[1].cache_dir, '/cache')
+
+    def test_site_registry(self):
+        """test the files of sites no longer built are retired"""
+        hot = NginxSite("hot", 8081, self.available, self.enabled, includes=True)
+        hot.add_vassal(self.make_vassal('app2', 3032))
+        site = NginxSite("site", 8080, self.available, self.enabled)
+        site.add_vassal(self.make_vassal('app1', 3031))
+        registry = SiteRegistry(self.available)
+        registry.load()
+        for conf in (site, hot):
+            conf.write_available()
+            conf.link_enabled()
+        self.assertEqual(registry.retire([site, hot]), [])
+        registry.save()
+        self.failUnless(os.path.exists(self.available + SiteRegistry.SUFFIX))
+
+        registry = SiteRegistry(self.available)
+        registry.load()
+        site.add_vassal(self.make_vassal('app2', 3032))
+        expected = [
+            os.path.join(self.enabled, 'hot.conf'),
+            os.path.join(self.available, 'hot.conf'),
+            os.path.join(self.available, 'hot.d'),
+        ]
+        self.assertEqual(registry.stale([site]), expected)
+        self.assertEqual(registry.retire([site]), expected)
+        self.assertEqual(os.listdir(self.available), ['site.conf'])
+        self.assertEqual(os.listdir(self.enabled), ['site.conf'])
+        self.assertEqual(list(registry.sites), ['site'])
+        self.assertEqual(registry.stale([site]), [])
+
 
 if __name__ == '__main__':
     unittest.main()
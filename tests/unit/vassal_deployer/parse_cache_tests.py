@@ -0,0 +1,103 @@
+#!/usr/bin/env python
+"""
+parse_cache module tests
+"""
+import os
+import mock
+import marshal
+import tempfile
+import unittest
+
+from vassal_deployer.parse_cache import ParseCache, cache_stamp
+from vassal_deployer.vassal_config import VassalConfig
+
+
+TEMPLATE = """
+[uwsgi]
+home=/opt/app
+socket=127.0.0.1:{port}
+module=app:APP
+
+[vassaldeployer]
+app_url=/app
+requirements=flask,requests
+"""
+
+
+class ParseCacheTests(unittest.TestCase):
+    """tests for the parsed template cache"""
+    def setUp(self):
+        """set up temp dir with a template"""
+        self.dir = tempfile.mkdtemp()
+        self.template = os.path.join(self.dir, 'app.ini')
+        self.cache_file = os.path.join(self.dir, 'cache', 'parse.cache')
+        self.write_template(3030)
+
+    def tearDown(self):
+        """clean up tempdir"""
+        if os.path.exists(self.dir):
+            os.system('rm -rf {}'.format(self.dir))
+
+    def write_template(self, port):
+        with open(self.template, 'w') as handle:
+            handle.write(TEMPLATE.format(port=port))
+
+    def load(self):
+        cache = ParseCache(self.cache_file)
+        cache.load()
+        vassal = VassalConfig(self.template)
+        vassal.load(cache=cache)
+        cache.save()
+        return vassal
+
+    def test_cached_load(self):
+        """test unchanged templates load without configparser"""
+        first = self.load()
+        self.failUnless(os.path.exists(self.cache_file))
+        with mock.patch(
+                'vassal_deployer.vassal_config.configparser.RawConfigParser',
+                side_effect=AssertionError('parsed')):
+            second = self.load()
+        self.assertEqual(dict(first), dict(second))
+        self.assertEqual(first.template_hash, second.template_hash)
+        self.assertEqual(second.uwsgi_port, 3030)
+        self.assertEqual(second.requirements_list, ['flask', 'requests'])
+
+    def test_changed_template(self):
+        """test a changed template is parsed again"""
+        self.load()
+        self.write_template(3031)
+        self.assertEqual(self.load().uwsgi_port, 3031)
+        self.assertEqual(self.load().uwsgi_port, 3031)
+
+    def test_stale_stamp(self):
+        """test caches from another parser version are discarded"""
+        self.load()
+        with open(self.cache_file, 'rb') as handle:
+            data = marshal.load(handle)
+        self.assertEqual(data['stamp'], cache_stamp())
+        data['stamp'] = (0, 0, (2, 7))
+        with open(self.cache_file, 'wb') as handle:
+            marshal.dump(data, handle)
+        cache = ParseCache(self.cache_file)
+        cache.load()
+        self.assertEqual(cache.entries, {})
+
+        with open(self.cache_file, 'wb') as handle:
+            handle.write(b'womp')
+        cache.load()
+        self.assertEqual(cache.entries, {})
+
+    def test_prune(self):
+        """test entries of templates not loaded are dropped on save"""
+        self.load()
+        cache = ParseCache(self.cache_file)
+        cache.load()
+        self.assertEqual(list(cache.entries), [self.template])
+        cache.save()
+        cache.load()
+        self.assertEqual(cache.entries, {})
+
+
+if __name__ == '__main__':
+    unittest.main()
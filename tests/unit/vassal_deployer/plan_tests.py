@@ -0,0 +1,208 @@
+#!/usr/bin/env python
+"""
+plan module tests
+"""
+import os
+import tempfile
+import unittest
+
+from vassal_deployer.plan import (
+    plan, parse_requirement, installed_packages, missing_requirements
+)
+from vassal_deployer.layers import PTH_FILE
+
+
+TEMPLATE = """
+[uwsgi]
+home={home}
+socket=127.0.0.1:{port}
+module=app:APP
+
+[vassaldeployer]
+app_url=/{name}
+python=python3
+requirements=Flask==1.0.2,requests
+"""
+
+
+class PlanTests(unittest.TestCase):
+    """tests for the dry run deploy plan"""
+    def setUp(self):
+        """set up templates, vassals and nginx dirs"""
+        self.dir = tempfile.mkdtemp()
+        self.templates = os.path.join(self.dir, 'templates')
+        self.vassals = os.path.join(self.dir, 'vassals')
+        self.available = os.path.join(self.dir, 'available')
+        self.enabled = os.path.join(self.dir, 'enabled')
+        for d in (self.templates, self.vassals, self.available, self.enabled):
+            os.makedirs(d)
+        self.home = os.path.join(self.dir, 'app')
+        with open(os.path.join(self.templates, 'app.ini'), 'w') as handle:
+            handle.write(TEMPLATE.format(home=self.home, port=3030, name='app'))
+
+    def tearDown(self):
+        """clean up tempdir"""
+        if os.path.exists(self.dir):
+            os.system('rm -rf {}'.format(self.dir))
+
+    def make_plan(self):
+        return plan(
+            self.templates, self.vassals, 'site', 8080,
+            self.available, self.enabled
+        )
+
+    def make_venv(self, venv, *dists):
+        site = os.path.join(venv, 'lib', 'python3.6', 'site-packages')
+        os.makedirs(os.path.join(venv, 'bin'))
+        open(os.path.join(venv, 'bin', 'python'), 'w').close()
+        for dist in dists:
+            os.makedirs(os.path.join(site, dist))
+        return site
+
+    def test_parse_requirement(self):
+        """test requirement names and pins"""
+        self.assertEqual(parse_requirement('Flask==1.0.2'), ('flask', '1.0.2'))
+        self.assertEqual(parse_requirement('zope.interface>=4'), ('zope-interface', None))
+        self.assertEqual(parse_requirement('requests[security]'), ('requests', None))
+
+    def test_installed_packages(self):
+        """test scanning dist-info dirs, including a linked layer"""
+        venv = os.path.join(self.dir, 'venv')
+        site = self.make_venv(venv, 'Flask-1.0.2.dist-info', 'six-1.11.0-py3.6.egg-info')
+        layer = os.path.join(self.dir, 'layer')
+        os.makedirs(os.path.join(layer, 'requests-2.19.1.dist-info'))
+        with open(os.path.join(site, PTH_FILE), 'w') as handle:
+            handle.write("import site; site.addsitedir({!r})\n".format(layer))
+        installed = installed_packages(venv)
+        self.assertEqual(
+            installed,
+            {'flask': '1.0.2', 'six': '1.11.0', 'requests': '2.19.1'}
+        )
+        self.assertEqual(
+            missing_requirements(['Flask==1.0.3', 'six', 'pytz'], installed),
+            ['Flask==1.0.3', 'pytz']
+        )
+
+    def test_plan_fresh(self):
+        """test planning a first deploy"""
+        result = self.make_plan()
+        venv = os.path.join(self.home, 'venv')
+        actions = [a[:2] for a in result.actions]
+        self.assertEqual(actions, [
+            ('create', venv),
+            ('install', venv),
+            ('write', os.path.join(self.vassals, 'app.ini')),
+            ('write', os.path.join(self.available, 'site.conf')),
+            ('link', os.path.join(self.enabled, 'site.conf')),
+        ])
+        self.failUnless(result.changed)
+        report = result.report()
+        self.failUnless('+socket=127.0.0.1:3030\n' in report)
+        self.failUnless('+    uwsgi_pass vassal_app;\n' in report)
+        self.assertEqual(os.listdir(self.vassals), [])
+        self.assertEqual(os.listdir(self.available), [])
+        self.failIf(os.path.exists(self.home))
+
+    def test_plan_parse_cache(self):
+        """test the parse cache is read but never written"""
+        from vassal_deployer.parse_cache import ParseCache
+        cache_file = os.path.join(self.dir, 'cache', 'parse.cache')
+        plan(
+            self.templates, self.vassals, 'site', 8080,
+            self.available, self.enabled, parse_cache=cache_file
+        )
+        self.failIf(os.path.exists(os.path.dirname(cache_file)))
+
+        cache = ParseCache(cache_file)
+        cache.put('/templates/gone.ini', (0, 0, ''), {})
+        cache.save()
+        mtime = int(os.stat(cache_file).st_mtime)
+        os.utime(cache_file, (mtime - 10, mtime - 10))
+        result = plan(
+            self.templates, self.vassals, 'site', 8080,
+            self.available, self.enabled, parse_cache=cache_file
+        )
+        self.assertEqual(result.actions[0][:2], ('create', os.path.join(self.home, 'venv')))
+        self.assertEqual(os.stat(cache_file).st_mtime, mtime - 10)
+
+    def test_plan_includes(self):
+        """test planning an include mode site"""
+        include_dir = os.path.join(self.available, 'site.d')
+        os.makedirs(include_dir)
+        stale = os.path.join(include_dir, 'vassal_gone.location.conf')
+        open(stale, 'w').close()
+        result = plan(
+            self.templates, self.vassals, 'site', 8080,
+            self.available, self.enabled, nginx_includes=True
+        )
+        actions = [a[:2] for a in result.actions]
+        self.assertEqual(actions[3:], [
+            ('write', os.path.join(self.available, 'site.conf')),
+            ('write', os.path.join(include_dir, 'vassal_app.upstream.conf')),
+            ('write', os.path.join(include_dir, 'vassal_app.location.conf')),
+            ('remove', stale),
+            ('link', os.path.join(self.enabled, 'site.conf')),
+        ])
+        self.failUnless(os.path.exists(stale))
+
+    def test_plan_cache_dir(self):
+        """test the nginx cache dir is planned for vassal cache zones"""
+        cache_dir = os.path.join(self.dir, 'cache')
+        with open(os.path.join(self.templates, 'app.ini'), 'a') as handle:
+            handle.write('cache_zone=api\n')
+        result = plan(
+            self.templates, self.vassals, 'site', 8080,
+            self.available, self.enabled, nginx_cache_dir=cache_dir
+        )
+        self.failUnless(
+            ('create', cache_dir, 'nginx cache dir') in result.actions
+        )
+        self.failIf(os.path.exists(cache_dir))
+
+    def test_plan_retired_site(self):
+        """test the files of a site no longer built are reported for removal"""
+        from vassal_deployer.nginx_config import NginxSite, SiteRegistry
+        hot = NginxSite('hot', 8081, self.available, self.enabled)
+        hot.write_available()
+        hot.link_enabled()
+        registry = SiteRegistry(self.available)
+        registry.retire([hot])
+        registry.save()
+        result = self.make_plan()
+        self.assertEqual(result.actions[-2:], [
+            ('remove', os.path.join(self.enabled, 'hot.conf'), 'retired site'),
+            ('remove', os.path.join(self.available, 'hot.conf'), 'retired site'),
+        ])
+        self.failUnless(os.path.exists(os.path.join(self.enabled, 'hot.conf')))
+
+    def test_plan_up_to_date(self):
+        """test nothing to do once the deploy has been made"""
+        venv = os.path.join(self.home, 'venv')
+        self.make_venv(venv, 'Flask-1.0.2.dist-info', 'requests-2.19.1.dist-info')
+        from vassal_deployer.deploy import make_vassals, load_vassals
+        from vassal_deployer.nginx_config import NginxSite
+        vassals, _ = load_vassals(make_vassals(self.templates))
+        site = NginxSite('site', 8080, self.available, self.enabled)
+        for vassal in vassals:
+            vassal.uwsgi_virtualenv
+            vassal.write(self.vassals)
+            site.add_vassal(vassal)
+        site.write_available()
+        site.link_enabled()
+
+        result = self.make_plan()
+        self.assertEqual(result.actions, [])
+        self.failIf(result.changed)
+        self.assertEqual(result.report(), 'nothing to do\n')
+
+        with open(os.path.join(self.templates, 'app.ini'), 'w') as handle:
+            handle.write(TEMPLATE.format(home=self.home, port=3031, name='app'))
+        result = self.make_plan()
+        self.assertEqual([a[0] for a in result.actions], ['write', 'write'])
+        report = result.report()
+        self.failUnless('-socket=127.0.0.1:3030\n' in report)
+        self.failUnless('+    server 127.0.0.1:3031;\n' in report)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,110 @@
+#!/usr/bin/env python
+"""
+sizing module tests
+"""
+import os
+import mock
+import tempfile
+import unittest
+
+from vassal_deployer.sizing import (
+    cgroup_cpus, cpu_count, memory_limit, WorkerSizing
+)
+
+MB = 1024 * 1024
+
+
+def make_vassal(weight=1.0, min_workers=1, max_workers=None,
+                workers_per_cpu=2.0, worker_memory=None, threads=1):
+    """mock a loaded VassalConfig"""
+    return mock.Mock(
+        weight=weight,
+        min_workers=min_workers,
+        max_workers=max_workers,
+        workers_per_cpu=workers_per_cpu,
+        worker_memory=worker_memory,
+        threads=threads
+    )
+
+
+class SizingTests(unittest.TestCase):
+    """tests for worker sizing"""
+    def setUp(self):
+        """set up a fake cgroup dir"""
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        """clean up tempdir"""
+        if os.path.exists(self.dir):
+            os.system('rm -rf {}'.format(self.dir))
+
+    def write(self, relpath, content):
+        path = os.path.join(self.dir, relpath)
+        if not os.path.exists(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path, 'w') as handle:
+            handle.write(content)
+        return path
+
+    def test_cgroup_v2(self):
+        """test cgroup v2 cpu and memory limits"""
+        self.assertEqual(cgroup_cpus(self.dir), None)
+        self.write('cpu.max', 'max 100000\n')
+        self.assertEqual(cgroup_cpus(self.dir), None)
+        self.write('cpu.max', '150000 100000\n')
+        self.assertEqual(cgroup_cpus(self.dir), 1.5)
+        with mock.patch('os.sched_getaffinity', create=True, return_value=set(range(8))):
+            self.assertEqual(cpu_count(self.dir), 1.5)
+
+        meminfo = self.write('meminfo', 'MemTotal:       16384000 kB\nMemFree: 1 kB\n')
+        self.assertEqual(memory_limit(self.dir, meminfo), 16384000 * 1024)
+        self.write('memory.max', '{}\n'.format(512 * MB))
+        self.assertEqual(memory_limit(self.dir, meminfo), 512 * MB)
+        self.write('memory.max', 'max\n')
+        self.assertEqual(memory_limit(self.dir, meminfo), 16384000 * 1024)
+
+    def test_cgroup_v1(self):
+        """test cgroup v1 cpu and memory limits"""
+        self.write('cpu/cpu.cfs_quota_us', '-1\n')
+        self.write('cpu/cpu.cfs_period_us', '100000\n')
+        self.assertEqual(cgroup_cpus(self.dir), None)
+        with mock.patch('os.sched_getaffinity', create=True, return_value=set([0, 1])):
+            self.assertEqual(cpu_count(self.dir), 2.0)
+        self.write('cpu/cpu.cfs_quota_us', '400000\n')
+        self.assertEqual(cgroup_cpus(self.dir), 4.0)
+        with mock.patch('os.sched_getaffinity', create=True, return_value=set([0, 1])):
+            self.assertEqual(cpu_count(self.dir), 2.0)
+        self.write('memory/memory.limit_in_bytes', '9223372036854771712\n')
+        self.assertEqual(memory_limit(self.dir, os.path.join(self.dir, 'none')), None)
+        self.write('memory/memory.limit_in_bytes', '{}\n'.format(256 * MB))
+        self.assertEqual(memory_limit(self.dir, os.path.join(self.dir, 'none')), 256 * MB)
+
+    def test_workers(self):
+        """test splitting cpus and memory by weight"""
+        hot = make_vassal(weight=3, min_workers=2, threads=4)
+        cold = make_vassal(weight=1, max_workers=2)
+        small = make_vassal(weight=1, worker_memory=512)
+        sizing = WorkerSizing(cpus=5, memory=2048 * MB)
+        sizing.plan([hot, cold, small])
+        self.assertEqual(sizing.total_weight, 5)
+        self.assertEqual(sizing.workers_for(hot), 6)
+        self.assertEqual(sizing.workers_for(cold), 2)
+        # 2 workers for the cpu share, but 409MB fits none
+        self.assertEqual(sizing.workers_for(small), 1)
+
+        settings = sizing.settings_for(hot)
+        self.assertEqual(list(settings.items()), [
+            ('workers', 6),
+            ('threads', 4),
+            ('enable-threads', 'true'),
+            ('cheaper-algo', 'spare'),
+            ('cheaper', 2),
+            ('cheaper-initial', 2),
+            ('cheaper-step', 1),
+        ])
+        settings = sizing.settings_for(small)
+        self.assertEqual(dict(settings), {'workers': 1, 'threads': 1})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,127 @@
+#!/usr/bin/env python
+"""
+state module tests
+
+"""
+import os
+import mock
+import tempfile
+import unittest
+
+from vassal_deployer.timing import DeployTimings
+from vassal_deployer.state import (
+    StateStore, resolved_requirements, venv_fingerprint
+)
+
+
+class StateStoreTests(unittest.TestCase):
+    """tests for StateStore"""
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.state_dir = os.path.join(self.dir, 'state')
+        self.venv = os.path.join(self.dir, 'venv')
+        self.install('Flask', '1.0.2')
+
+    def tearDown(self):
+        """clean up tempdir"""
+        if os.path.exists(self.dir):
+            os.system('rm -rf {}'.format(self.dir))
+
+    def install(self, name, version):
+        """fake an installed package in the venv"""
+        os.makedirs(os.path.join(
+            self.venv, 'lib', 'python3.9', 'site-packages',
+            '{}-{}.dist-info'.format(name, version)
+        ))
+
+    def make_vassal(self, name, template_hash='abc'):
+        return mock.Mock(
+            basename=name,
+            config_file='/templates/{}'.format(name),
+            template_hash=template_hash,
+            uwsgi_virtualenv=self.venv,
+            requirements_list=['flask==1.0.2', 'requests']
+        )
+
+    def record(self, vassals, failures=None, host='node1', duration=1.0):
+        timings = DeployTimings()
+        for vassal in vassals:
+            timings.record(vassal.basename, 'make_virtualenv', duration)
+            timings.record(vassal.basename, 'write', 0.5)
+        timings.record('site', 'nginx_write', 0.1)
+        return StateStore(self.state_dir).record_run(
+            vassals, failures or {}, timings, host=host
+        )
+
+    def test_resolved_requirements(self):
+        """test requirement versions are looked up by project name"""
+        self.assertEqual(
+            resolved_requirements(
+                ['Flask==1.0.2', 'python_dateutil', 'git+https://host/repo'],
+                {'flask': '1.0.3', 'python-dateutil': '2.8'}
+            ),
+            {'flask': '1.0.3', 'python-dateutil': '2.8'}
+        )
+        self.assertNotEqual(
+            venv_fingerprint({'flask': '1.0.2'}), venv_fingerprint({'flask': '1.0.3'})
+        )
+
+    def test_record_run(self):
+        """test runs, vassals and phases are recorded"""
+        app1 = self.make_vassal('app1.ini')
+        run_id = self.record(
+            [app1], {'/templates/broken.ini': ValueError('bad template')}
+        )
+        store = StateStore(self.state_dir)
+        self.assertEqual(os.listdir(self.state_dir), [StateStore.FILENAME])
+        runs = store.runs()
+        self.assertEqual(len(runs), 1)
+        self.assertEqual(runs[0]['id'], run_id)
+        self.assertEqual((runs[0]['vassals'], runs[0]['failures']), (2, 1))
+
+        statuses = dict((s['name'], s) for s in store.vassal_status())
+        self.assertEqual(statuses['app1.ini']['result'], 'ok')
+        self.assertEqual(statuses['app1.ini']['duration'], 1.5)
+        self.assertEqual(
+            statuses['app1.ini']['requirements'],
+            {'flask': '1.0.2', 'requests': None}
+        )
+        self.assertEqual(
+            statuses['app1.ini']['venv_fingerprint'],
+            venv_fingerprint({'flask': '1.0.2'})
+        )
+        self.assertEqual(statuses['broken.ini']['result'], 'error')
+        self.assertEqual(statuses['broken.ini']['error'], 'bad template')
+
+        history = store.history('app1.ini')
+        self.assertEqual(history[0]['phases'], [
+            ('make_virtualenv', 1.0, 'ok'), ('write', 0.5, 'ok')
+        ])
+
+    def test_status(self):
+        """test average durations and virtualenv drift"""
+        self.record([self.make_vassal('app1.ini'), self.make_vassal('app2.ini')])
+        self.record([self.make_vassal('app1.ini')], duration=3.0)
+        statuses = StateStore(self.state_dir).vassal_status()
+        self.assertEqual([s['name'] for s in statuses], ['app1.ini', 'app2.ini'])
+        self.assertEqual(statuses[0]['average'], 2.5)
+        self.assertEqual(statuses[0]['runs'], 2)
+        self.failIf(any(s['drift'] for s in statuses))
+
+        self.install('requests', '2.20.0')
+        self.record([self.make_vassal('app2.ini', 'def')])
+        statuses = StateStore(self.state_dir).vassal_status()
+        self.failIf(any(s['drift'] for s in statuses))
+
+        self.record([self.make_vassal('app1.ini')])
+        self.record([self.make_vassal('app2.ini', 'def')], host='node2')
+        statuses = dict(
+            ((s['host'], s['name']), s) for s in StateStore(self.state_dir).vassal_status()
+        )
+        self.failUnless(statuses[('node1', 'app1.ini')]['drift'])
+        self.failIf(statuses[('node1', 'app2.ini')]['drift'])
+        self.failIf(statuses[('node2', 'app2.ini')]['drift'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,60 @@
+#!/usr/bin/env python
+"""
+timing module tests
+"""
+import unittest
+
+from vassal_deployer.timing import DeployTimings
+
+
+class DeployTimingsTests(unittest.TestCase):
+    """tests for DeployTimings class"""
+
+    def test_report(self):
+        """test phases are grouped per vassal"""
+        timings = DeployTimings()
+        timings.record('app1.ini', 'load', 0.1)
+        timings.record('app2.ini', 'load', 0.2)
+        timer = timings.timer('app1.ini')
+        with timer('pip_install requests'):
+            pass
+        with self.assertRaises(RuntimeError):
+            with timer('pip_install arrow'):
+                raise RuntimeError('womp')
+
+        report = timings.report()
+        self.assertEqual(list(report['vassals']), ['app1.ini', 'app2.ini'])
+        app1 = report['vassals']['app1.ini']
+        self.assertEqual(
+            [(p['phase'], p['result']) for p in app1['phases']],
+            [
+                ('load', 'ok'),
+                ('pip_install requests', 'ok'),
+                ('pip_install arrow', 'error'),
+            ]
+        )
+        self.assertEqual(app1['result'], 'error')
+        self.failUnless(app1['total'] >= 0.1)
+
+    def test_summary(self):
+        """test the summary table groups pip installs"""
+        timings = DeployTimings()
+        timings.record('app1.ini', 'load', 0.5)
+        timings.record('app1.ini', 'pip_install requests', 1.0)
+        timings.record('app1.ini', 'pip_install arrow', 2.0)
+        timings.record('app2.ini', 'load', 0.25)
+        timings.record('site', 'nginx_write', 0.01)
+        lines = timings.summary().splitlines()
+        self.assertEqual(lines[0].split(), [
+            'vassal', 'load', 'pip_install', 'nginx_write', 'total', 'result'
+        ])
+        self.assertEqual(lines[1].split(), [
+            'app1.ini', '0.50', '3.00', '-', '3.50', 'ok'
+        ])
+        self.assertEqual(lines[2].split()[0], 'app2.ini')
+        self.assertEqual(lines[3].split()[0], 'site')
+        self.failUnless(lines[4].startswith('deploy took'))
+
+
+if __name__ == '__main__':
+    unittest.main()
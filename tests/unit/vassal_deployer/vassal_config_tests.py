@@ -3,11 +3,14 @@
 tests for vassal_config module
 """
 import os
+import re
 import unittest
 import tempfile
 import mock
 
-from vassal_deployer.vassal_config import VassalConfig
+from virtualenvapi.exceptions import PackageInstallationException
+
+from vassal_deployer.vassal_config import VassalConfig, PipInstallError
 
 
 FIXTURE1 = \
@@ -43,6 +46,9 @@ virtualenv={home}/app2/venv
 [vassaldeployer]
 app_url=/app2
 python=python2.7
+keepalive=16
+max_fails=3
+fail_timeout=30s
 requirements=some_package=0.1.2,some_dep==1.2.3
 pip_options= --extra-index=mypypi:8080 --trusted-host mypypi
 """
@@ -83,7 +89,7 @@ class VassalConfigTests(unittest.TestCase):
         with open(self.file3, 'w') as handle:
             handle.write(FIXTURE3.format(home=self.outputs))
 
-        self.patch_venv = mock.patch('vassal_deployer.vassal_config.VirtualEnvironment')
+        self.patch_venv = mock.patch('virtualenvapi.manage.VirtualEnvironment')
         self.mock_venv = self.patch_venv.start()
 
     def tearDown(self):
@@ -111,7 +117,11 @@ class VassalConfigTests(unittest.TestCase):
         self.assertEqual(vc.app_url, '/app1')
         nginx_conf = vc.nginx_config()
         self.failUnless(vc.app_url in nginx_conf)
-        self.failUnless(vc.uwsgi_socket in nginx_conf)
+        self.failUnless('uwsgi_pass vassal_file1;' in nginx_conf)
+        upstream = vc.nginx_upstream()
+        self.failUnless(upstream.startswith('upstream vassal_file1 {'))
+        self.failUnless('server {};'.format(vc.uwsgi_socket) in upstream)
+        self.failIf('keepalive' in upstream)
 
         self.failUnless(self.mock_venv.called)
         self.failUnless(mock_v.open_or_create.called)
@@ -122,6 +132,159 @@ class VassalConfigTests(unittest.TestCase):
 
         self.failUnless('file1.ini' in os.listdir(self.outputs))
 
+    def test_compact(self):
+        """test only the used sections are kept, interned and slotted"""
+        with open(self.file1, 'a') as handle:
+            handle.write("[other]\nsetting=1\n")
+        vc1 = VassalConfig(self.file1)
+        vc1.load()
+        vc2 = VassalConfig(self.file2)
+        vc2.load()
+        self.assertEqual(sorted(vc1), ['uwsgi', 'vassaldeployer'])
+        self.failIf(hasattr(vc1, '__dict__'))
+        self.failIf(hasattr(vc1, 'parser'))
+        self.failUnless(
+            vc1['uwsgi']['module'] is vc2['uwsgi']['module']
+        )
+        self.failUnless(
+            list(vc1['uwsgi'])[0] is list(vc2['uwsgi'])[0]
+        )
+        self.assertEqual(vc2.pip_options, [
+            '--extra-index=mypypi:8080', '--trusted-host', 'mypypi'
+        ])
+
+    def test_site_settings(self):
+        """test the nginx site settings"""
+        with open(self.file2, 'a') as handle:
+            handle.write("site=hot\nsite_port=8081\nserver_name=hot.example.com\n")
+        vc = VassalConfig(self.file2)
+        vc.load()
+        self.assertEqual(vc.nginx_site, 'hot')
+        self.assertEqual(vc.nginx_port, 8081)
+        self.assertEqual(vc.server_name, 'hot.example.com')
+        vc = VassalConfig(self.file1)
+        vc.load()
+        self.assertEqual(
+            (vc.nginx_site, vc.nginx_port, vc.server_name), (None, None, None)
+        )
+
+    def test_cache_settings(self):
+        """test the nginx cache directives"""
+        vc = VassalConfig(self.file1)
+        vc.load()
+        self.assertEqual(vc.cache_zone, None)
+        self.failIf('uwsgi_cache' in vc.nginx_config())
+        with open(self.file2, 'a') as handle:
+            handle.write(
+                "cache_zone=api\ncache_valid=200 302 10m, 404 1m\n"
+                "cache_bypass=$cookie_session\ncache_max_size=1g\n"
+            )
+        vc = VassalConfig(self.file2)
+        vc.load()
+        self.assertEqual(vc.cache_valid, ['200 302 10m', '404 1m'])
+        self.assertEqual(vc.cache_key, '$scheme$host$request_uri')
+        config = vc.nginx_config()
+        self.failUnless('    uwsgi_cache api;\n' in config)
+        self.failUnless('    uwsgi_cache_key $scheme$host$request_uri;\n' in config)
+        self.failUnless('    uwsgi_cache_valid 200 302 10m;\n' in config)
+        self.failUnless('    uwsgi_cache_valid 404 1m;\n' in config)
+        self.failUnless('    uwsgi_cache_bypass $cookie_session;\n' in config)
+        self.failUnless('    uwsgi_no_cache $cookie_session;\n' in config)
+        self.failUnless(config.endswith(';\n}\n'))
+        self.assertEqual(
+            vc.nginx_cache_path('/var/cache/nginx'),
+            "uwsgi_cache_path /var/cache/nginx/api levels=1:2 "
+            "keys_zone=api:10m max_size=1g use_temp_path=off;\n"
+        )
+
+    def test_static_locations(self):
+        """test static files are served by nginx ahead of uwsgi"""
+        vc = VassalConfig(self.file1)
+        vc.load()
+        self.assertEqual(vc.static_locations, [])
+        self.failUnless(vc.nginx_config().startswith('location '))
+        site_packages = os.path.join(
+            vc.uwsgi_virtualenv, 'lib', 'python3.9', 'site-packages'
+        )
+        os.makedirs(site_packages)
+        with open(self.file1, 'a') as handle:
+            handle.write(
+                "static=/static:/srv/static/, /media/:pkg:some_package/media\n"
+                "static_expires=30d\n"
+            )
+        vc = VassalConfig(self.file1)
+        vc.load()
+        media = os.path.join(site_packages, 'some_package', 'media')
+        self.assertEqual(vc.static_locations, [
+            ('/static', '/srv/static/'), ('/media/', media)
+        ])
+        config = vc.nginx_config()
+        self.failUnless(config.startswith(
+            "location ^~ /static/ {{\n"
+            "    alias /srv/static/;\n"
+            "    sendfile on;\n"
+            "    expires 30d;\n"
+            "    gzip_static on;\n"
+            "}}\n"
+            "location ^~ /media/ {{\n"
+            "    alias {}/;\n".format(media)
+        ))
+        self.failUnless(
+            config.index('uwsgi_pass') > config.index('alias {}/;'.format(media))
+        )
+
+    def test_unix_socket(self):
+        """test unix socket paths are passed to nginx"""
+        with open(self.file3, 'w') as handle:
+            handle.write(FIXTURE3.format(home=self.outputs).replace(
+                'socket=127.0.0.1:3030', 'socket=/run/uwsgi/app3.sock'
+            ))
+        vc = VassalConfig(self.file3)
+        vc.load()
+        self.failUnless(vc.is_unix_socket)
+        self.assertEqual(vc.uwsgi_port, None)
+        self.assertEqual(vc.nginx_server, 'unix:/run/uwsgi/app3.sock')
+        self.failUnless('    server unix:/run/uwsgi/app3.sock;\n' in vc.nginx_upstream())
+        vc.assign_socket('/run/other', '660', 'www-data')
+        self.assertEqual(vc.uwsgi_socket, '/run/uwsgi/app3.sock')
+
+    def test_assign_socket(self):
+        """test assigning unix sockets to tcp vassals"""
+        vc = VassalConfig(self.file1)
+        vc.load()
+        self.failIf(vc.is_unix_socket)
+        self.assertEqual(vc.nginx_server, '127.0.0.1:3030')
+        vc.assign_socket('/run/uwsgi', '660', 'www-data:www-data')
+        self.assertEqual(vc.uwsgi_socket, '/run/uwsgi/file1.sock')
+        self.assertEqual(vc.nginx_server, 'unix:/run/uwsgi/file1.sock')
+        config = vc.uwsgi_config()
+        self.failUnless('socket=/run/uwsgi/file1.sock' in config)
+        self.failUnless('chmod-socket=660' in config)
+        self.failUnless('chown-socket=www-data:www-data' in config)
+
+    def test_upstream_name(self):
+        """test upstream names are unique per template file name"""
+        names = [
+            VassalConfig(os.path.join(self.inputs, f)).upstream_name
+            for f in ('app_1.ini', 'app-1.ini', 'app.1.ini', 'app_1.conf')
+        ]
+        self.assertEqual(names[0], 'vassal_app_1')
+        self.assertEqual(len(set(names)), 4)
+        for name in names[1:]:
+            self.failUnless(re.match(r'^vassal_app_1_[0-9a-f]{8}$', name))
+
+    def test_assign_port(self):
+        """test assigning tcp ports keeps the host"""
+        vc = VassalConfig(self.file1)
+        vc.load()
+        vc.assign_port(4000)
+        self.assertEqual(vc.uwsgi_socket, '127.0.0.1:4000')
+        self.assertEqual(vc.uwsgi_port, 4000)
+        del vc['uwsgi']['socket']
+        self.failIf(vc.is_unix_socket)
+        vc.assign_port(4001)
+        self.assertEqual(vc.nginx_server, '127.0.0.1:4001')
+
     def test_fixture2(self):
         """test processing fixture2"""
         mock_v = mock.Mock()
@@ -152,6 +315,11 @@ class VassalConfigTests(unittest.TestCase):
             )
         ])
         self.failUnless('file2.ini' in os.listdir(self.outputs))
+        upstream = vc.nginx_upstream()
+        self.failUnless(
+            'server 127.0.0.1:3030 max_fails=3 fail_timeout=30s;' in upstream
+        )
+        self.failUnless('keepalive 16;' in upstream)
 
     def test_fixture3(self):
         """test processing fixture3"""
@@ -178,6 +346,88 @@ class VassalConfigTests(unittest.TestCase):
             mock.call('pkg3==3.4.5', options=[])
         ])
 
+    def test_pip_install_batch(self):
+        """test installing all requirements in one pip run"""
+        mock_v = mock.Mock()
+        self.mock_venv.return_value = mock_v
+
+        vc = VassalConfig(self.file2)
+        vc.load()
+        vc.pip_install(mode='batch')
+        self.failIf(mock_v.install.called)
+        mock_v._execute_pip.assert_has_calls([
+            mock.call([
+                'install', 'some_package=0.1.2', 'some_dep==1.2.3',
+                '--extra-index=mypypi:8080', '--trusted-host', 'mypypi'
+            ])
+        ])
+
+    def test_pip_install_file(self):
+        """test installing from a generated requirements file"""
+        mock_v = mock.Mock()
+        self.mock_venv.return_value = mock_v
+
+        vc = VassalConfig(self.file3)
+        vc.load()
+        os.makedirs(vc.uwsgi_virtualenv)
+        vc.pip_install(mode='file')
+        req_file = os.path.join(vc.uwsgi_virtualenv, 'vassal-requirements.txt')
+        mock_v.install.assert_has_calls([
+            mock.call('-r {}'.format(req_file), options=[])
+        ])
+        with open(req_file) as handle:
+            self.assertEqual(
+                handle.read(), 'pkg1==0.1.2\npkg2==1.2.3\npkg3==3.4.5\n'
+            )
+
+    def test_pip_install_batch_failure(self):
+        """test batch failures are retried and reported per requirement"""
+        mock_v = mock.Mock()
+        mock_v._execute_pip.side_effect = PackageInstallationException(
+            (1, 'boom', 'pkg1==0.1.2,pkg2==1.2.3,pkg3==3.4.5')
+        )
+
+        def install(req, options):
+            if req == 'pkg2==1.2.3':
+                raise PackageInstallationException((1, 'nope', req))
+        mock_v.install.side_effect = install
+        self.mock_venv.return_value = mock_v
+
+        vc = VassalConfig(self.file3)
+        vc.load()
+        with self.assertRaises(PipInstallError) as ctx:
+            vc.pip_install(mode='batch')
+        self.assertEqual(list(ctx.exception.failures), ['pkg2==1.2.3'])
+        self.assertEqual(mock_v.install.call_count, 3)
+
+    def test_template_hash(self):
+        """test template hash only changes with the template"""
+        vc1 = VassalConfig(self.file1)
+        vc1.load()
+        vc2 = VassalConfig(self.file1)
+        vc2.load()
+        vc3 = VassalConfig(self.file2)
+        vc3.load()
+        self.assertEqual(vc1.template_hash, vc2.template_hash)
+        self.assertNotEqual(vc1.template_hash, vc3.template_hash)
+
+    def test_pip_install_requirements(self):
+        """test installing a subset of the requirements"""
+        mock_v = mock.Mock()
+        self.mock_venv.return_value = mock_v
+        vc = VassalConfig(self.file3)
+        vc.load()
+        vc.pip_install(requirements=['pkg3==3.4.5'])
+        mock_v.install.assert_called_once_with('pkg3==3.4.5', options=[])
+        vc.pip_install(requirements=[])
+        self.assertEqual(mock_v.install.call_count, 1)
+
+    def test_pip_install_bad_mode(self):
+        """test unknown pip modes are rejected"""
+        vc = VassalConfig(self.file3)
+        vc.load()
+        self.assertRaises(ValueError, vc.pip_install, mode='womp')
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,113 @@
+#!/usr/bin/env python
+"""
+venv_cache module tests
+"""
+import os
+import mock
+import tempfile
+import unittest
+
+from vassal_deployer.venv_cache import VenvCache
+
+
+def make_venv(path):
+    """build a fake virtualenv tree at path"""
+    os.makedirs(os.path.join(path, 'bin'))
+    os.makedirs(os.path.join(path, 'lib', 'site-packages'))
+    with open(os.path.join(path, 'bin', 'activate'), 'w') as handle:
+        handle.write('VIRTUAL_ENV="{}"\n'.format(path))
+    with open(os.path.join(path, 'lib', 'site-packages', 'pkg.py'), 'w') as handle:
+        handle.write('X = 1\n' * 100)
+    os.symlink('lib', os.path.join(path, 'lib64'))
+
+
+def make_vassal(venv, reqs='requests,arrow'):
+    """mock a loaded VassalConfig"""
+    return mock.Mock(
+        app_python='python',
+        requirements_list=reqs.split(','),
+        pip_options=[],
+        uwsgi_virtualenv=venv
+    )
+
+
+class VenvCacheTests(unittest.TestCase):
+    """tests for VenvCache class"""
+    def setUp(self):
+        """set up temp dir"""
+        self.dir = tempfile.mkdtemp()
+        self.cache_dir = os.path.join(self.dir, 'cache')
+        self.venv1 = os.path.join(self.dir, 'app1', 'venv')
+        self.venv2 = os.path.join(self.dir, 'app2', 'venv')
+        make_venv(self.venv1)
+
+    def tearDown(self):
+        """clean up tempdir"""
+        if os.path.exists(self.dir):
+            os.system('rm -rf {}'.format(self.dir))
+
+    def test_cache_key(self):
+        """test key is independent of requirement order"""
+        k1 = VenvCache.cache_key('python', ['a', 'b'], ['--pre'])
+        k2 = VenvCache.cache_key('python', ['b', 'a'], ['--pre'])
+        k3 = VenvCache.cache_key('python', ['a', 'b'], [])
+        self.assertEqual(k1, k2)
+        self.assertNotEqual(k1, k3)
+
+    def test_store_restore(self):
+        """test storing a venv and restoring it to a new location"""
+        cache = VenvCache(self.cache_dir)
+        v1 = make_vassal(self.venv1)
+        v2 = make_vassal(self.venv2)
+        self.failIf(cache.restore(v2))
+        cache.store(v1)
+        self.failUnless(cache.key_for(v1) in cache)
+
+        self.failUnless(cache.restore(v2))
+        with open(os.path.join(self.venv2, 'bin', 'activate')) as handle:
+            self.assertEqual(handle.read(), 'VIRTUAL_ENV="{}"\n'.format(self.venv2))
+        self.failUnless(
+            os.path.exists(os.path.join(self.venv2, 'lib', 'site-packages', 'pkg.py'))
+        )
+        self.failUnless(os.path.islink(os.path.join(self.venv2, 'lib64')))
+        # existing venvs are left alone
+        self.failIf(cache.restore(v2))
+
+    def test_hardlink_restore(self):
+        """test restoring with hardlinks"""
+        cache = VenvCache(self.cache_dir, hardlink=True)
+        cache.store(make_vassal(self.venv1))
+        self.failUnless(cache.restore(make_vassal(self.venv2)))
+        pkg = os.path.join(self.venv2, 'lib', 'site-packages', 'pkg.py')
+        self.failUnless(os.stat(pkg).st_nlink > 1)
+        activate = os.path.join(self.venv2, 'bin', 'activate')
+        self.assertEqual(os.stat(activate).st_nlink, 1)
+
+    def test_prune(self):
+        """test LRU eviction"""
+        cache = VenvCache(self.cache_dir)
+        v1 = make_vassal(self.venv1, 'a')
+        v2 = make_vassal(self.venv1, 'b')
+        cache.store(v1)
+        cache.store(v2)
+        self.assertEqual(len(cache.entries()), 2)
+        # touch v1 so v2 becomes least recently used
+        cache.restore(make_vassal(self.venv2, 'a'))
+
+        evicted = cache.prune(cache.size() - 1)
+        self.assertEqual(evicted, [cache.key_for(v2)])
+        self.failUnless(cache.key_for(v1) in cache)
+        self.failIf(cache.key_for(v2) in cache)
+
+        cache.clear()
+        self.assertEqual(cache.entries(), [])
+
+    def test_max_size(self):
+        """test the size cap is enforced on store"""
+        cache = VenvCache(self.cache_dir, max_size=1)
+        cache.store(make_vassal(self.venv1))
+        self.assertEqual(cache.entries(), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
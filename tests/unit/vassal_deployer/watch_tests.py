@@ -0,0 +1,166 @@
+#!/usr/bin/env python
+"""
+watch module tests
+"""
+import os
+import mock
+import tempfile
+import unittest
+
+from vassal_deployer.deploy import DeployError
+from vassal_deployer.watch import (
+    snapshot, diff_snapshots, TemplateWatcher, WatchDeployer
+)
+
+
+class WatchTests(unittest.TestCase):
+    """tests for watch module"""
+    def setUp(self):
+        """set up templates and vassals dirs"""
+        self.dir = tempfile.mkdtemp()
+        self.templates = os.path.join(self.dir, 'templates')
+        self.vassals = os.path.join(self.dir, 'vassals')
+        os.makedirs(self.templates)
+        os.makedirs(self.vassals)
+        for i in range(1, 4):
+            self.write_template('vassal{}.ini'.format(i), 'womp')
+
+    def tearDown(self):
+        """clean up tempdir"""
+        if os.path.exists(self.dir):
+            os.system('rm -rf {}'.format(self.dir))
+
+    def write_template(self, name, content):
+        path = os.path.join(self.templates, name)
+        with open(path, 'w') as handle:
+            handle.write(content)
+        return path
+
+    def test_diff_snapshots(self):
+        """test detecting added, changed and removed templates"""
+        old = snapshot(self.templates)
+        self.assertEqual(len(old), 3)
+        v1 = os.path.join(self.templates, 'vassal1.ini')
+        v2 = os.path.join(self.templates, 'vassal2.ini')
+        os.remove(v1)
+        self.write_template('vassal2.ini', 'womp womp')
+        v4 = self.write_template('vassal4.ini', 'womp')
+        self.assertEqual(
+            diff_snapshots(old, snapshot(self.templates)),
+            ([v4], [v2], [v1])
+        )
+
+    def test_polling_watcher(self):
+        """test polling for changes"""
+        watcher = TemplateWatcher(self.templates, interval=0.01, use_inotify=False)
+        self.failIf(watcher.wait(0.05))
+        self.write_template('vassal4.ini', 'womp')
+        self.failUnless(watcher.wait(0.05))
+        watcher.wait_quiet(0.02)
+        watcher.close()
+
+    @mock.patch('vassal_deployer.watch.deploy')
+    def test_sync(self, mock_deploy):
+        """test only changed templates are redeployed"""
+        watcher = WatchDeployer(
+            self.templates, self.vassals, 'site', 8080, jobs=2
+        )
+        watcher.snapshot = snapshot(self.templates)
+        self.failIf(watcher.sync())
+        self.failIf(mock_deploy.called)
+
+        rendered = os.path.join(self.vassals, 'vassal1.ini')
+        with open(rendered, 'w') as handle:
+            handle.write('[uwsgi]\n')
+        os.remove(os.path.join(self.templates, 'vassal1.ini'))
+        v4 = self.write_template('vassal4.ini', 'womp')
+        mock_deploy.side_effect = DeployError({v4: RuntimeError('boom')})
+
+        self.failUnless(watcher.sync())
+        self.failIf(os.path.exists(rendered))
+        mock_deploy.assert_has_calls([
+            mock.call(
+                self.templates, self.vassals, 'site', 8080, None, None,
+                only=set([v4]), jobs=2
+            )
+        ])
+        self.assertEqual(watcher.failed, set([v4]))
+
+        # failed templates are retried along with the next change
+        mock_deploy.side_effect = None
+        v2 = self.write_template('vassal2.ini', 'womp womp')
+        self.failUnless(watcher.sync())
+        self.assertEqual(mock_deploy.call_args[1]['only'], set([v2, v4]))
+        self.assertEqual(watcher.failed, set())
+
+    @mock.patch('vassal_deployer.watch.deploy')
+    def test_sync_duplicate_names(self, mock_deploy):
+        """test removing a template keeps the config of its namesake"""
+        other = os.path.join(self.dir, 'other')
+        os.makedirs(other)
+        duplicate = os.path.join(other, 'vassal1.ini')
+        with open(duplicate, 'w') as handle:
+            handle.write('womp')
+        watcher = WatchDeployer(
+            [self.templates, other], self.vassals, 'site', 8080
+        )
+        watcher.snapshot = snapshot([self.templates, other])
+        rendered = os.path.join(self.vassals, 'vassal1.ini')
+        with open(rendered, 'w') as handle:
+            handle.write('[uwsgi]\n')
+
+        live = os.path.join(self.templates, 'vassal1.ini')
+        os.remove(duplicate)
+        self.failUnless(watcher.sync())
+        self.failUnless(os.path.exists(rendered))
+        self.assertEqual(mock_deploy.call_args[1]['only'], set([live]))
+
+        with open(duplicate, 'w') as handle:
+            handle.write('womp')
+        watcher.sync()
+        os.remove(live)
+        self.failUnless(watcher.sync())
+        self.failUnless(os.path.exists(rendered))
+        self.assertEqual(mock_deploy.call_args[1]['only'], set([duplicate]))
+
+    @mock.patch('vassal_deployer.watch.deploy')
+    def test_run(self, mock_deploy):
+        """test run deploys everything then syncs on changes"""
+        watcher = mock.Mock()
+        watcher.wait = mock.Mock(side_effect=[True, KeyboardInterrupt])
+        deployer = WatchDeployer(self.templates, self.vassals, 'site', 8080)
+        with mock.patch.object(deployer, 'sync') as mock_sync:
+            deployer.run(watcher)
+            self.assertEqual(mock_sync.call_count, 1)
+        self.assertEqual(mock_deploy.call_args[1]['only'], None)
+        watcher.wait_quiet.assert_has_calls([mock.call(2.0)])
+        self.failUnless(watcher.close.called)
+
+
+    @mock.patch('vassal_deployer.watch.deploy')
+    def test_run_errors(self, mock_deploy):
+        """test unexpected deploy errors don't stop the watch"""
+        mock_deploy.side_effect = [OSError('read only'), None]
+        watcher = mock.Mock()
+        watcher.wait = mock.Mock(side_effect=[True, True, KeyboardInterrupt])
+        deployer = WatchDeployer(self.templates, self.vassals, 'site', 8080)
+        with mock.patch.object(deployer, 'sync') as mock_sync:
+            mock_sync.side_effect = [RuntimeError('boom'), True]
+            deployer.run(watcher)
+            self.assertEqual(mock_sync.call_count, 2)
+        self.assertEqual(deployer.failed, set(snapshot(self.templates)))
+        self.assertEqual(len(deployer.failed), 3)
+
+        v1 = os.path.join(self.templates, 'vassal1.ini')
+        v2 = self.write_template('vassal2.ini', 'womp womp')
+        mock_deploy.side_effect = RuntimeError('reload failed')
+        deployer.failed = set([v1])
+        deployer.deploy(only=[v2])
+        self.assertEqual(deployer.failed, set([v1, v2]))
+        mock_deploy.side_effect = None
+        deployer.deploy(only=[])
+        self.assertEqual(mock_deploy.call_args[1]['only'], set([v1, v2]))
+        self.assertEqual(deployer.failed, set())
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,115 @@
+#!/usr/bin/env python
+"""
+wheelhouse module tests
+"""
+import os
+import mock
+import tempfile
+import unittest
+
+from vassal_deployer.wheelhouse import (
+    Wheelhouse, collect_requirements, strip_index_options
+)
+
+
+def make_vassal(python, reqs, pip_options=()):
+    """mock a loaded VassalConfig"""
+    return mock.Mock(
+        app_python=python,
+        requirements_list=reqs,
+        pip_options=list(pip_options)
+    )
+
+
+class WheelhouseTests(unittest.TestCase):
+    """tests for Wheelhouse class"""
+    def setUp(self):
+        """set up temp dir and patch virtualenv"""
+        self.dir = tempfile.mkdtemp()
+        self.patch_venv = mock.patch('virtualenvapi.manage.VirtualEnvironment')
+        self.mock_venv = self.patch_venv.start()
+        self.vassals = [
+            make_vassal('python2.7', ['requests', 'flask']),
+            make_vassal('python2.7', ['requests', 'arrow']),
+            make_vassal('/usr/bin/python3', ['requests']),
+            make_vassal('python2.7', ['private'], ['--extra-index-url', 'http://pypi']),
+        ]
+
+    def tearDown(self):
+        """clean up tempdir and stop patchers"""
+        self.patch_venv.stop()
+        if os.path.exists(self.dir):
+            os.system('rm -rf {}'.format(self.dir))
+
+    def test_collect_requirements(self):
+        """test requirements are merged per interpreter and options"""
+        groups = collect_requirements(self.vassals)
+        self.assertEqual(list(groups.items()), [
+            (('python2.7', ()), ['requests', 'flask', 'arrow']),
+            (('/usr/bin/python3', ()), ['requests']),
+            (('python2.7', ('--extra-index-url', 'http://pypi')), ['private']),
+        ])
+
+    def test_prefetch(self):
+        """test wheels are built once per group"""
+        mock_env = mock.Mock()
+        self.mock_venv.return_value = mock_env
+        wheelhouse = Wheelhouse(self.dir)
+        wheelhouse.prefetch(self.vassals)
+
+        py27 = os.path.join(self.dir, 'python2.7')
+        py3 = os.path.join(self.dir, 'usr_bin_python3')
+        self.assertEqual(mock_env._execute_pip.call_count, 3)
+        mock_env._execute_pip.assert_has_calls([
+            mock.call(['wheel', '--wheel-dir', py27, 'requests', 'flask', 'arrow']),
+            mock.call(['wheel', '--wheel-dir', py3, 'requests']),
+            mock.call([
+                'wheel', '--wheel-dir', py27,
+                '--extra-index-url', 'http://pypi', 'private'
+            ]),
+        ])
+        self.assertEqual(
+            wheelhouse.install_options(self.vassals[2]),
+            ['--no-index', '--find-links', py3]
+        )
+
+    def test_strip_index_options(self):
+        """test only the index options are replaced by the wheelhouse"""
+        self.assertEqual(
+            strip_index_options([
+                '--pre', '-i', 'http://pypi/simple', '--extra-index=mypypi:8080',
+                '--trusted-host', 'mypypi', '--find-links', '/wheels', '-f', 'x',
+                '--no-index', '--no-deps', '--no-binary=:all:', '--index-url=x'
+            ]),
+            ['--pre', '--trusted-host', 'mypypi', '--no-deps', '--no-binary=:all:']
+        )
+        vassal = make_vassal('python2.7', ['pre'], ['--pre', '--index-url', 'http://pypi'])
+        wheelhouse = Wheelhouse(self.dir, offline=True)
+        wheelhouse.prefetch([vassal])
+        self.assertEqual(wheelhouse.install_options(vassal), [
+            '--pre', '--no-index', '--find-links', os.path.join(self.dir, 'python2.7')
+        ])
+
+    def test_prefetch_failure(self):
+        """test groups that fail to prefetch install from their index"""
+        mock_env = mock.Mock()
+        mock_env._execute_pip.side_effect = [None, RuntimeError('offline'), None]
+        self.mock_venv.return_value = mock_env
+        wheelhouse = Wheelhouse(self.dir)
+        wheelhouse.prefetch(self.vassals)
+        self.failIf(wheelhouse.install_options(self.vassals[0]) is None)
+        self.failUnless(wheelhouse.install_options(self.vassals[2]) is None)
+
+    def test_offline(self):
+        """test offline wheelhouses don't build anything"""
+        wheelhouse = Wheelhouse(self.dir, offline=True)
+        wheelhouse.prefetch(self.vassals)
+        self.failIf(self.mock_venv.called)
+        self.assertEqual(
+            wheelhouse.install_options(self.vassals[0]),
+            ['--no-index', '--find-links', os.path.join(self.dir, 'python2.7')]
+        )
+
+
+if __name__ == '__main__':
+    unittest.main()